@@ -9,30 +9,51 @@ This script creates an AI agent that:
 5. Uses LangGraph for potential future extensions
 """
 
-import os
+import time
+import logging
 import telebot
 from openai import OpenAI
-from langgraph.graph import StateGraph
-from dotenv import load_dotenv
+from langgraph.graph import StateGraph, END
 from typing import TypedDict, Dict, Any, List
+from config.settings import get_settings, install_reload_handler
+from utils.logger import setup_logging
+from utils.recorder import recorder
+from utils.delivery import deliver
+from utils.accounting import (
+    BudgetExceeded, accountant, register_stats_command, usage_scope)
+from agents.session_manager import SessionManager
+from utils.deadline import request_deadline, run_stage, stage_timeout
 
-# Load environment variables from .env file
-load_dotenv()
+# Load settings once (.env + environment)
+settings = get_settings()
 
-# Get API keys from environment variables
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_API_BASE_URL = os.getenv("OPENAI_API_BASE_URL")
-OPENAI_API_MODEL = os.getenv("OPENAI_API_MODEL")
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+logger = logging.getLogger(__name__)
 
 # Initialize the Telegram Bot
-bot = telebot.TeleBot(TELEGRAM_TOKEN)
+bot = telebot.TeleBot(settings.telegram_bot_token)
 
 # Initialize OpenAI client
-openai_client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_API_BASE_URL)
+openai_client = OpenAI(api_key=settings.openai_api_key, base_url=settings.openai_api_base_url or None,
+                       timeout=settings.llm_timeout, max_retries=settings.llm_max_retries)
 
-# Dictionary to store conversation history for each user
-conversation_history: Dict[int, List[Dict[str, str]]] = {}
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful assistant. Maintain a natural conversational style."}
+
+
+def new_history() -> List[Dict[str, str]]:
+    """Start a conversation with the system message"""
+    return [dict(SYSTEM_MESSAGE)]
+
+
+def trim_history(messages: List[Dict[str, str]]) -> None:
+    """Keep the system message and the last session_max_turns exchanges"""
+    limit = 2 * get_settings().session_max_turns
+    if len(messages) > limit + 1:
+        del messages[1:len(messages) - limit]
+
+
+# Conversation history per user: created lazily, trimmed after every
+# message, idle users evicted; users don't wait for each other
+conversation_history = SessionManager(new_history, trim=trim_history, name="agent_claude")
 
 # Define state type for our graph
 class AgentState(TypedDict):
@@ -42,34 +63,37 @@ class AgentState(TypedDict):
     context: Dict[str, Any]
     messages: List[Dict[str, str]]
 
-# Function to get conversation history for a user
-def get_user_history(user_id: int) -> List[Dict[str, str]]:
-    """Get conversation history for a specific user"""
-    if user_id not in conversation_history:
-        # Initialize with system message if this is a new user
-        conversation_history[user_id] = [
-            {"role": "system", "content": "You are a helpful assistant. Maintain a natural conversational style."}
-        ]
-    return conversation_history[user_id]
-
 # Define nodes for our LangGraph
 def process_with_openai(state: AgentState) -> AgentState:
     """Process user input with OpenAI API using conversation history"""
-    user_id = state["user_id"]
-    
-    # Get existing conversation history
-    messages = get_user_history(user_id)
+    # Conversation history of this user's session
+    messages = state["messages"]
     
     # Add the new user message to history
     messages.append({"role": "user", "content": state["user_input"]})
     
     try:
-        # Send the entire conversation history to OpenAI
-        response = openai_client.chat.completions.create(
-            model=OPENAI_API_MODEL,
-            messages=messages
-        )
-        
+        # Pick the model within the user's token budget
+        model = accountant.choose_model(get_settings().openai_api_model)
+
+        # Send the entire conversation history to OpenAI within the answer budget
+        def complete():
+            started_at = time.perf_counter()
+            response = openai_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                timeout=stage_timeout("answer", get_settings().llm_timeout)
+            )
+            accountant.record_openai(response, time.perf_counter() - started_at)
+            return response
+
+        response = run_stage("answer", complete, fallback=lambda: None)
+        if response is None:
+            # Drop the unanswered message so the history stays consistent
+            messages.pop()
+            state["agent_response"] = "⏱️ The model didn't answer in time, please try again."
+            return state
+
         # Get the assistant's response
         assistant_message = response.choices[0].message.content
         
@@ -79,12 +103,11 @@ def process_with_openai(state: AgentState) -> AgentState:
         # Add the assistant's response to the conversation history
         messages.append({"role": "assistant", "content": assistant_message})
         
-        # Update the conversation history for this user
-        conversation_history[user_id] = messages
-        
-        # Store the current messages in the state
-        state["messages"] = messages
-        
+    except BudgetExceeded as e:
+        # Drop the unanswered message so the history stays consistent
+        messages.pop()
+        state["agent_response"] = f"⛔ {e}"
+
     except Exception as e:
         error_message = f"Error processing your request: {str(e)}"
         state["agent_response"] = error_message
@@ -97,15 +120,9 @@ def process_with_openai(state: AgentState) -> AgentState:
 # Function to clear conversation history
 def clear_history(state: AgentState) -> AgentState:
     """Clear conversation history for a user"""
-    user_id = state["user_id"]
-    
     # Reset conversation history to just the system message
-    conversation_history[user_id] = [
-        {"role": "system", "content": "You are a helpful assistant. Maintain a natural conversational style."}
-    ]
-    
+    state["messages"] = new_history()
     state["agent_response"] = "Conversation history has been cleared."
-    state["messages"] = conversation_history[user_id]
     
     return state
 
@@ -125,9 +142,8 @@ def create_agent_graph():
             return "clear_history"
         return "process_input"
     
-    # Define the edges with conditional routing
-    workflow.add_conditional_edges(
-        "",
+    # Route the entry point by the message: clear history or process input
+    workflow.set_conditional_entry_point(
         should_clear_history,
         {
             "process_input": "process_input",
@@ -135,8 +151,9 @@ def create_agent_graph():
         }
     )
     
-    # Define the entry point
-    workflow.set_entry_point("")
+    # Both branches finish the run
+    workflow.add_edge("process_input", END)
+    workflow.add_edge("clear_history", END)
     
     # Compile the graph
     return workflow.compile()
@@ -144,6 +161,9 @@ def create_agent_graph():
 # Create our agent graph
 agent_graph = create_agent_graph()
 
+# Admin-only /stats must be registered before the catch-all handler
+register_stats_command(bot)
+
 # Handle incoming messages
 @bot.message_handler(func=lambda message: True)
 def handle_message(message):
@@ -155,20 +175,26 @@ def handle_message(message):
     # Let user know the agent is processing
     bot.send_message(chat_id, "Processing your request...")
     
-    # Initialize state with user input and user ID
-    initial_state: AgentState = {
-        "user_input": user_input,
-        "agent_response": "",
-        "user_id": user_id,
-        "context": {},
-        "messages": get_user_history(user_id)
-    }
-    
-    # Run the graph
-    final_state = agent_graph.invoke(initial_state)
+    # The session lock serializes messages of one user only
+    with conversation_history.session(user_id) as history:
+        # Initialize state with user input and user ID
+        initial_state: AgentState = {
+            "user_input": user_input,
+            "agent_response": "",
+            "user_id": user_id,
+            "context": {},
+            "messages": history
+        }
+
+        # Run the graph, attributing LLM usage to this user and chat
+        with usage_scope(user_id, chat_id, "agent_claude"), request_deadline():
+            final_state = agent_graph.invoke(initial_state)
+
+        # Store the updated (or cleared) history in the session
+        history[:] = final_state["messages"]
     
-    # Send the response back to the user
-    bot.send_message(chat_id, final_state["agent_response"])
+    # Send the response back to the user (split or as a file when too long)
+    deliver(bot, chat_id, final_state["agent_response"])
 
 # Extension point: Add tools function
 def add_tool(name, function):
@@ -178,9 +204,13 @@ def add_tool(name, function):
     pass
 
 if __name__ == "__main__":
-    print("Starting Telegram AI Agent with context memory...")
+    setup_logging()
+    recorder.install()  # Record or replay external calls (RECORDER_MODE)
+    logger.info("Starting Telegram AI Agent with context memory...")
+    # Reload settings on SIGHUP without restarting
+    install_reload_handler()
     try:
         # Start the bot
         bot.polling(none_stop=True)
     except Exception as e:
-        print(f"Error during bot execution: {e}")
+        logger.error("Error during bot execution: %s", e)
@@ -1,35 +1,258 @@
 import os
-from github import Github
+import time
+import base64
+import logging
+import threading
+from typing import Mapping, Optional
+from github import (
+    Github, GithubException, InputGitTreeElement,
+    RateLimitExceededException, UnknownObjectException)
 from github.Repository import Repository
-from dotenv import load_dotenv
+from config.settings import get_settings
+from utils.deadline import stage_timeout
 
-load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Текстовые файлы до этого размера передаются прямо в дереве, без отдельного blob
+INLINE_TEXT_LIMIT = 512 * 1024
+# Предел размера двоичного файла: PyGithub передаёт blob одним JSON-телом
+# (base64 в памяти, +33 %), а GitHub принимает blob до 100 МБ
+BLOB_SIZE_LIMIT = 50 * 1024 * 1024
+
+
+class RateLimitWait(Exception):
+    """Ожидание лимита GitHub не укладывается в бюджет запроса."""
+
+
+class RateLimitScheduler:
+    """
+    Планировщик запросов к GitHub с учётом лимитов.
+
+    Первичный лимит берётся из заголовков последнего ответа (без отдельных
+    запросов к /rate_limit): когда запас падает до reserve, ждём сброса окна.
+    Вторичный лимит: запросы на запись идут строго по одному
+    и не чаще write_interval секунд, ответы 403/429 с Retry-After
+    повторяются после указанной паузы, ответы 5xx — с нарастающей паузой.
+
+    Это единственный уровень повторов (сам PyGithub не повторяет). Любая
+    пауза ограничена бюджетом стадии tools текущего запроса: если ждать
+    дольше, сразу выбрасывается RateLimitWait.
+    """
+
+    def __init__(self, reserve: int = 50, write_interval: float = 1.0,
+                 max_retries: Optional[int] = None) -> None:
+        self.reserve = reserve
+        self.write_interval = write_interval
+        self._max_retries = max_retries
+        self._write_lock = threading.Lock()
+        self._last_write = 0.0
+
+    @property
+    def max_retries(self) -> int:
+        return (self._max_retries if self._max_retries is not None
+                else get_settings().github_max_retries)
+
+    def call(self, github: Github, func, *args, write: bool = False, **kwargs):
+        """
+        Выполняет запрос с ожиданием лимитов и повтором при их превышении.
+
+        :param github: Клиент, по заголовкам которого считается запас
+        :param func: Метод PyGithub
+        :param write: Запрос создаёт контент (вторичный лимит)
+        :return: Результат func
+        :raises RateLimitWait: Пауза не укладывается в бюджет стадии tools
+        """
+        for attempt in range(self.max_retries + 1):
+            self._wait_primary(github)
+            try:
+                if not write:
+                    return func(*args, **kwargs)
+                with self._write_lock:
+                    pause = self.write_interval - (time.monotonic() - self._last_write)
+                    if pause > 0:
+                        self._sleep(pause)
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        self._last_write = time.monotonic()
+            except GithubException as e:
+                delay = self._retry_delay(github, e, attempt)
+                if delay is None or attempt == self.max_retries:
+                    raise
+                self._sleep(delay, "⏳ GitHub ответил %s, повтор через %.0f с", e.status, delay)
+
+    @staticmethod
+    def _sleep(delay: float, message: str = "", *args) -> None:
+        """Пауза, если она укладывается в бюджет стадии tools (вне запроса — любая)."""
+        budget = stage_timeout("tools", delay)
+        if budget < delay:
+            raise RateLimitWait(
+                f"лимит GitHub: нужно ждать {delay:.0f} с, бюджет запроса {budget:.1f} с")
+        if message:
+            logger.warning(message, *args)
+        time.sleep(delay)
+
+    def _wait_primary(self, github: Github) -> None:
+        requester = github.requester
+        remaining, limit = requester.rate_limiting
+        if limit < 0 or remaining > self.reserve:
+            return
+        delay = (requester.rate_limiting_resettime or 0) - time.time()
+        if delay > 0:
+            self._sleep(delay + 1, "⏳ Осталось %s запросов к GitHub, ждём сброса %.0f с",
+                        remaining, delay)
+
+    @staticmethod
+    def _retry_delay(github: Github, error: GithubException,
+                     attempt: int = 0) -> Optional[float]:
+        headers = {k.lower(): v for k, v in (error.headers or {}).items()}
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+        if isinstance(error, RateLimitExceededException) or (
+                error.status in (403, 429) and headers.get("x-ratelimit-remaining") == "0"):
+            reset = float(headers.get("x-ratelimit-reset",
+                                      github.requester.rate_limiting_resettime or 0))
+            return max(reset - time.time(), 0) + 1
+        if error.status in (403, 429) and "secondary rate limit" in str(error.data).lower():
+            return 60.0
+        if error.status in (500, 502, 503, 504):
+            return float(2 ** attempt)
+        return None
+
+
+# Клиенты, логины и репозитории общие для всех экземпляров агента
+_clients: dict[str, Github] = {}
+_logins: dict[str, str] = {}
+_repos: dict[str, tuple[Repository, float]] = {}
+_cache_lock = threading.Lock()
+scheduler = RateLimitScheduler()
 
 
 class GitHubAgent:
     """
     Агент для взаимодействия с GitHub API.
-    Позволяет загружать файлы и создавать репозитории.
+    Позволяет загружать файлы (в том числе пачкой одним коммитом),
+    создавать репозитории и issue.
     """
 
     def __init__(self) -> None:
-        self.token = os.getenv("GITHUB_TOKEN")
-        self.github = Github(self.token)
-        self.user = self.github.get_user()
+        settings = get_settings()
+        self.token = settings.github_token
+        with _cache_lock:
+            if self.token not in _clients:
+                # Повторы — только в scheduler: PyGithub по умолчанию повторял бы
+                # каждый запрос до 10 раз, умножая попытки планировщика
+                _clients[self.token] = Github(
+                    self.token, timeout=int(settings.github_timeout), retry=None)
+            self.github = _clients[self.token]
+
+    @property
+    def login(self) -> str:
+        """Логин владельца токена (запрашивается один раз на процесс)."""
+        if self.token not in _logins:
+            user = self.github.get_user()
+            _logins[self.token] = scheduler.call(self.github, lambda: user.login)
+        return _logins[self.token]
 
     def get_or_create_repo(self, repo_name: str) -> Repository:
         """
         Получает репозиторий или создаёт новый.
 
+        Объект репозитория кешируется; по истечении github_repo_cache_ttl он
+        перепроверяется условным запросом (If-None-Match), ответ 304
+        не расходует лимит.
+
         :param repo_name: Название репозитория
         :return: Объект репозитория
         """
+        full_name = f"{self.login}/{repo_name}"
+        cache_key = f"{self.token}:{full_name}"
+        cached = _repos.get(cache_key)
+
+        if cached is not None:
+            repo, checked_at = cached
+            if time.monotonic() - checked_at < get_settings().github_repo_cache_ttl:
+                return repo
+            try:
+                scheduler.call(self.github, repo.update)
+                _repos[cache_key] = (repo, time.monotonic())
+                return repo
+            except UnknownObjectException:
+                _repos.pop(cache_key, None)
+
         try:
-            repo = self.github.get_repo(f"{self.user.login}/{repo_name}")
-        except Exception:
-            repo = self.user.create_repo(repo_name, private=False)
+            repo = scheduler.call(self.github, self.github.get_repo, full_name)
+        except UnknownObjectException:
+            user = self.github.get_user()
+            repo = scheduler.call(
+                self.github, user.create_repo, repo_name,
+                private=False, auto_init=True, write=True)
+            logger.info("📁 Создан репозиторий %s", full_name)
+
+        _repos[cache_key] = (repo, time.monotonic())
         return repo
 
+    def commit_files(
+            self, repo_name: str, files: Mapping[str, str],
+            commit_message: str = "Добавлены новые файлы",
+            branch: Optional[str] = None) -> str:
+        """
+        Загружает несколько файлов одним коммитом через Git Data API.
+
+        Небольшие текстовые файлы передаются прямо в дереве, остальные
+        читаются в двоичном режиме и отправляются как blob (не больше
+        BLOB_SIZE_LIMIT).
+        Итого: ссылка, коммит-родитель, дерево, коммит и обновление
+        ссылки плюс по запросу на каждый двоичный файл.
+
+        :param repo_name: Название репозитория
+        :param files: Путь в репозитории -> локальный путь к файлу
+        :param commit_message: Сообщение коммита
+        :param branch: Ветка (по умолчанию — ветка репозитория по умолчанию)
+        :return: SHA созданного коммита
+        :raises ValueError: Файл больше BLOB_SIZE_LIMIT
+        """
+        repo = self.get_or_create_repo(repo_name)
+        branch = branch or repo.default_branch
+
+        ref = scheduler.call(self.github, repo.get_git_ref, f"heads/{branch}")
+        parent = scheduler.call(self.github, repo.get_git_commit, ref.object.sha)
+
+        elements = [self._tree_element(repo, path, local_path)
+                    for path, local_path in files.items()]
+
+        tree = scheduler.call(
+            self.github, repo.create_git_tree, elements, parent.tree, write=True)
+        commit = scheduler.call(
+            self.github, repo.create_git_commit, commit_message, tree, [parent],
+            write=True)
+        scheduler.call(self.github, ref.edit, commit.sha, write=True)
+
+        logger.info("✅ %s файлов загружено в %s одним коммитом %s",
+                    len(elements), repo_name, commit.sha[:7])
+        return commit.sha
+
+    def upload_directory(
+            self, repo_name: str, dir_path: str,
+            commit_message: str = "Добавлены новые файлы",
+            prefix: str = "") -> str:
+        """
+        Загружает содержимое каталога одним коммитом.
+
+        :param repo_name: Название репозитория
+        :param dir_path: Локальный каталог
+        :param commit_message: Сообщение коммита
+        :param prefix: Каталог внутри репозитория
+        :return: SHA созданного коммита
+        """
+        files = {}
+        for root, _, names in os.walk(dir_path):
+            for name in names:
+                local_path = os.path.join(root, name)
+                rel_path = os.path.relpath(local_path, dir_path).replace(os.sep, "/")
+                files[f"{prefix.strip('/')}/{rel_path}".lstrip("/")] = local_path
+        return self.commit_files(repo_name, files, commit_message)
+
     def upload_file(
             self, repo_name: str, file_path: str,
             commit_message: str = "Добавлен новый файл") -> None:
@@ -40,14 +263,49 @@ class GitHubAgent:
         :param file_path: Локальный путь к файлу
         :param commit_message: Сообщение коммита
         """
-        repo = self.get_or_create_repo(repo_name)
         file_name = os.path.basename(file_path)
+        try:
+            self.commit_files(repo_name, {file_name: file_path}, commit_message)
+            logger.info("✅ Файл %s успешно загружен в %s", file_name, repo_name)
+        except Exception as e:
+            logger.error("❌ Ошибка загрузки файла: %s", e)
 
-        with open(file_path, "r", encoding="utf-8") as file:
-            content = file.read()
+    def create_issue(self, repo_name: str, title: str, body: str = "") -> str:
+        """
+        Создаёт issue в репозитории.
 
+        :param repo_name: Название репозитория
+        :param title: Заголовок issue
+        :param body: Текст issue
+        :return: Ссылка на созданный issue
+        :raises Exception: Issue не создан (шаг задачи повторится)
+        """
         try:
-            repo.create_file(file_name, commit_message, content)
-            print(f"✅ Файл {file_name} успешно загружен в {repo_name}")
+            repo = self.get_or_create_repo(repo_name)
+            issue = scheduler.call(
+                self.github, repo.create_issue, title=title, body=body, write=True)
         except Exception as e:
-            print(f"❌ Ошибка загрузки файла: {e}")
+            logger.error("❌ Ошибка создания issue: %s", e)
+            raise
+        logger.info("✅ Создан issue #%s в %s", issue.number, repo_name)
+        return issue.html_url
+
+    def _tree_element(self, repo: Repository, path: str,
+                      local_path: str) -> InputGitTreeElement:
+        """Готовит элемент дерева: текст — inline, остальное — через blob."""
+        size = os.path.getsize(local_path)
+        if size > BLOB_SIZE_LIMIT:
+            raise ValueError(f"{local_path}: {size} байт, предел blob — {BLOB_SIZE_LIMIT}")
+
+        with open(local_path, "rb") as file:
+            data = file.read()
+        if size <= INLINE_TEXT_LIMIT:
+            try:
+                return InputGitTreeElement(path, "100644", "blob", content=data.decode("utf-8"))
+            except UnicodeDecodeError:
+                pass
+
+        blob = scheduler.call(
+            self.github, repo.create_git_blob,
+            base64.b64encode(data).decode("ascii"), "base64", write=True)
+        return InputGitTreeElement(path, "100644", "blob", sha=blob.sha)
@@ -1,50 +1,95 @@
 import logging
 import json
-import os
 import re
-from dotenv import load_dotenv
+import time
+import functools
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from langchain_core.runnables import RunnableLambda
 from langchain.prompts import PromptTemplate
 from langchain.memory import ConversationBufferMemory
 from langchain_deepseek import ChatDeepSeek
 from agents.telegram_agent import TelegramAgent
 from agents.github_agent import GitHubAgent
-from agents.tavily_agent import TavilyAgent
-
-# Загружаем переменные окружения
-load_dotenv()
+from agents.twitter_agent import TwitterAgent
+from agents.web_retriever import WebRetriever, format_context
+from config.settings import DEEPSEEK_API_BASE, get_settings, stage_params
+from agents.task_ledger import TaskLedger
+from agents.local_router import local_router, provider_breaker
+from agents.prefetch import prefetcher
+from agents.session_manager import SessionManager, trim_memory
+from utils.accounting import BudgetExceeded, accountant, usage_callback
+from utils.deadline import run_stage, stage_timeout
 
 logger = logging.getLogger(__name__)
 
-# Загружаем ключи API
-DEEPSEEK_API_KEY = os.getenv("OPENAI_API_KEY")
-DEEPSEEK_BASE_URL = os.getenv("OPENAI_API_BASE_URL", "https://api.deepseek.com/v1")
-DEEPSEEK_MODEL = os.getenv("OPENAI_API_MODEL", "deepseek-chat")
+settings = get_settings()
 
-# Создаем LLM модель DeepSeek
+# Создаем LLM модель DeepSeek (модель и температура задаются по стадиям)
 llm = ChatDeepSeek(
-    model=DEEPSEEK_MODEL,
-    api_key=DEEPSEEK_API_KEY,
-    temperature=0.7,
-    api_base=DEEPSEEK_BASE_URL
+    model=settings.openai_api_model,
+    api_key=settings.openai_api_key,
+    temperature=settings.answer_temperature,
+    api_base=settings.openai_api_base_url or DEEPSEEK_API_BASE,
+    request_timeout=settings.llm_timeout,
+    max_retries=settings.llm_max_retries,
+    callbacks=[usage_callback],  # токены и задержка каждого вызова
 )
 
-# Определяем память
-memory = ConversationBufferMemory(memory_key="history")
+
+def stage_llm(stage: str):
+    """
+    LLM с параметрами стадии (см. stage_params), моделью по бюджету
+    текущего пользователя (см. utils.accounting) и таймаутом в пределах
+    бюджета стадии (см. utils.deadline).
+
+    :param stage: "analysis" или "answer"
+    :raises BudgetExceeded: Пользователь исчерпал дневной лимит токенов
+    """
+    params = stage_params(stage)
+    params["model"] = accountant.choose_model(params["model"])
+    params["timeout"] = stage_timeout(stage, get_settings().llm_timeout)
+    return llm.bind(**params)
+
+
+# Память диалога — своя у каждого чата/пользователя (session_id задачи)
+sessions = SessionManager(
+    lambda: ConversationBufferMemory(memory_key="history"),
+    trim=trim_memory(), name="langchain_agent")
+
+# Журнал задач: дедупликация и результаты шагов
+ledger = TaskLedger()
 
 
 # --- Декоратор для логирования шагов ---
 def log_step(step_name):
     def decorator(func):
         def wrapper(*args, **kwargs):
-            logger.info(f"🔹 Начинаем шаг: {step_name}")
+            logger.info("🔹 Начинаем шаг: %s", step_name)
+            started_at = time.perf_counter()
             result = func(*args, **kwargs)
-            logger.info(f"✅ Завершен шаг: {step_name}, результат: {result}")
+            logger.info("✅ Завершен шаг: %s за %.3f с", step_name,
+                        time.perf_counter() - started_at)
+            # Результат целиком — только на уровне DEBUG
+            logger.debug("Результат шага %s: %s", step_name, result)
             return result
         return wrapper
     return decorator
 
 
+# --- Декоратор для сохранения результата шага в журнале задач ---
+def ledger_step(step_name):
+    """Пропускает шаг, если его результат для task_id уже есть в журнале."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(inputs):
+            task_id = inputs.get("task_id")
+            if not task_id:
+                return func(inputs)
+            return ledger.run_step(task_id, step_name, lambda: func(inputs))
+        return wrapper
+    return decorator
+
+
 # --- 1. Анализ задачи ---
 def clean_and_parse_response(response):
     """Очищает JSON-ответ от <think>...<think> и парсит его."""
@@ -57,12 +102,12 @@ def clean_and_parse_response(response):
         # Декодируем JSON
         parsed_json = json.loads(clean_json)
 
-        logger.info(f"📊 Анализ задачи: {parsed_json}")  # Логируем результат анализа
+        logger.info("📊 Анализ задачи: %s", parsed_json)  # Логируем результат анализа
 
         return parsed_json
     
     except json.JSONDecodeError:
-        logger.error(f"❌ Ошибка JSON: {response.content}")
+        logger.error("❌ Ошибка JSON: %s", response.content)
         return {"summary": "Ошибка анализа", "tools": []}  # Безопасный fallback
 
 
@@ -85,37 +130,92 @@ analyze_prompt = PromptTemplate(
 )
 
 
-def parse_analysis_response(response):
-    """Парсит JSON-ответ от модели, сохраняя исходный task_description."""
+def parse_analysis_response(response, task_description, fallback=None):
+    """
+    Парсит JSON-ответ от модели, сохраняя исходный task_description.
+
+    :param fallback: Анализ на случай некорректного ответа (по умолчанию — без инструментов)
+    """
     try:
         content = response.content.strip()
         clean_json = re.sub(r"<think>.*?</think>", "", content, flags=re.DOTALL).strip()
         parsed_json = json.loads(clean_json)
+        if not isinstance(parsed_json.get("tools"), list):
+            raise ValueError(f"нет списка tools: {parsed_json}")
         
-        logger.info(f"📊 Разобранный анализ: {parsed_json}")
+        logger.info("📊 Разобранный анализ: %s", parsed_json)
         
         return {
-            # Сохраняем исходный task_description из контекста
-            "task_description": response.task_description,  
+            "task_description": task_description,
             "analysis": parsed_json
         }
     except Exception as e:
-        logger.error(f"❌ Ошибка парсинга: {e}")
+        logger.error("❌ Ошибка парсинга: %s", e)
         return {
-            "task_description": response.task_description,
-            "analysis": {"summary": "Ошибка анализа", "tools": []}
+            "task_description": task_description,
+            "analysis": fallback or {"summary": "Ошибка анализа", "tools": []}
         }
 
 
-analyze_chain = (
-    RunnableLambda(lambda x: {"input_task": x})
-    | analyze_prompt
-    | llm
-    | RunnableLambda(lambda response: parse_analysis_response(
-        # Передаем исходное описание задачи в парсер
-        response.with_task_description(response.context["input_task"])
-    ))
-)
+@log_step("Анализ задачи")
+@ledger_step("analyze")
+def analyze_task(inputs):
+    """
+    Определяет нужные инструменты. Результат сохраняется в журнале задач.
+
+    Явные задачи («напиши твит», «создай issue») решает локальный
+    маршрутизатор без LLM; он же подменяет модель, когда провайдер
+    недоступен или ответ не разобран. Пока модель думает, может
+    выполняться упреждающий поиск (см. agents.prefetch).
+    """
+    task_description = inputs["task_description"]
+    analysis = None
+    try:
+        analysis = choose_tools(task_description)
+    finally:
+        # Упреждающий поиск не нужен или анализ оборвался (например, BudgetExceeded)
+        if analysis is None or "tavily" not in analysis.get("tools", []):
+            prefetcher.discard(task_description)
+    return {"task_description": task_description, "analysis": analysis,
+            "task_id": inputs.get("task_id")}
+
+
+def choose_tools(task_description):
+    """Анализ задачи: локально, через LLM или запасной локальный вариант."""
+    decision = local_router.route(task_description)
+
+    if decision.fast:
+        logger.info("⚡ Локальная маршрутизация: %s (%.2f)",
+                    decision.tools, decision.confidence)
+        return decision.as_analysis()
+
+    if not provider_breaker.allow():
+        return decision.as_analysis("провайдер недоступен")
+
+    prefetcher.speculate(task_description, decision.probabilities.get("tavily", 0.0))
+    try:
+        chain = analyze_prompt | stage_llm("analysis")
+        response = run_stage(
+            "analysis", lambda: chain.invoke({"task_description": task_description}),
+            fallback=lambda: None)
+    except BudgetExceeded:
+        raise
+    except Exception as e:
+        provider_breaker.failure()
+        logger.error("❌ Ошибка LLM при анализе, используем локальную маршрутизацию: %s", e)
+        return decision.as_analysis("ошибка LLM")
+
+    if response is None:
+        # Медленный провайдер — такой же сбой, как ошибка
+        provider_breaker.failure()
+        return decision.as_analysis("LLM не уложилась в бюджет анализа")
+
+    provider_breaker.success()
+    fallback = decision.as_analysis("ответ LLM не разобран")
+    return parse_analysis_response(response, task_description, fallback)["analysis"]
+
+
+analyze_chain = RunnableLambda(analyze_task)
 
 
 # analyze_chain = analyze_prompt | llm | RunnableLambda(lambda response: {"analysis": clean_and_parse_response(response)})
@@ -132,71 +232,265 @@ analyze_chain = (
 
 # --- 2. Поиск в интернете ---
 @log_step("Поиск в интернете")
+@ledger_step("search")
 def search_internet(inputs):
     """Поиск информации, если Tavily включен в список инструментов."""
     analysis = inputs.get("analysis", {})
     task_description = inputs["task_description"]
+    task_id = inputs.get("task_id")
 
-    logger.info(f"📥 Входные данные в поиск: {inputs}")
+    logger.debug("📥 Входные данные в поиск: %s", inputs)
 
     if not analysis.get("tools"):
         logger.warning("⚠️ Внимание: список инструментов пуст! Анализ может быть некорректным.")
     
     if not task_description:
         logger.error("❌ Ошибка: `task_description` пустой, невозможно выполнить поиск.")
-        return {"analysis": analysis, "task_description": task_description, "internet_results": []}
+        return {"analysis": analysis, "task_description": task_description,
+                "task_id": task_id, "internet_results": []}
 
-    tavily_agent = TavilyAgent()
+    def retrieve():
+        # Результаты упреждающего поиска, если он был запущен при анализе
+        found = prefetcher.take(task_description)
+        # Скачиваем найденные страницы и оставляем лучшие фрагменты в бюджете токенов
+        return WebRetriever().retrieve(task_description, found)
 
+    degraded = False
     try:
-        search_results = tavily_agent.search(task_description) if "tavily" in analysis.get("tools", []) else []
+        if "tavily" in analysis.get("tools", []):
+            search_results = run_stage("search", retrieve, fallback=lambda: None)
+            if search_results is None:
+                # Не уложились в бюджет поиска — отвечаем без материалов
+                search_results, degraded = [], True
+        else:
+            search_results = []
     except Exception as e:
-        logger.error(f"❌ Ошибка при выполнении поиска: {e}")
+        logger.error("❌ Ошибка при выполнении поиска: %s", e)
         search_results = []
 
-    return {"analysis": analysis, "task_description": task_description, "internet_results": search_results}
+    result = {"analysis": analysis, "task_description": task_description,
+              "task_id": task_id, "internet_results": search_results}
+    if degraded:
+        result["degraded"] = True
+    return result
 
 # --- 3. Выполнение задачи ---
+def notify_telegram(task_description):
+    """Уведомление в Telegram."""
+    telegram_agent = TelegramAgent()
+    result = telegram_agent.send_message(f"🔔 Выполняю задачу: {task_description}")
+    return f"📢 Telegram: {result}"
+
+
+def create_github_issue(task_description):
+    """Создание issue в GitHub."""
+    github_agent = GitHubAgent()
+    repo_name = "ai-agent-tasks"
+    result = github_agent.create_issue(repo_name, "AI Task", task_description)
+    return f"🔧 GitHub Issue: {result}"
+
+
+def post_to_twitter(content):
+    """
+    Публикация треда в Twitter без блокировки задачи.
+
+    :param content: Подготовленный текст (ответ на задачу), а не сама задача
+    """
+    if not content:
+        # Ответ не подготовлен (например, заменён запасным) — публиковать нечего
+        raise ValueError("нет подготовленного текста для публикации")
+    future = TwitterAgent().submit_thread(content)
+    try:
+        # Сколько ждать публикации, прежде чем отчитаться об очереди
+        report = future.result(timeout=get_settings().twitter_submit_wait)
+    except FutureTimeoutError:
+        # Тред опубликуется в фоне, задачу не блокируем
+        return "🐦 Twitter: тред поставлен в очередь на публикацию"
+    if report["error"] and not report["tweet_ids"]:
+        # Ничего не опубликовано — шаг не сохраняется и повторится
+        raise RuntimeError(report["error"])
+    ids = ", ".join(report["tweet_ids"]) or "—"
+    status = f"ошибка: {report['error']}" if report["error"] else "опубликовано"
+    return (f"🐦 Twitter: {status}, твиты: {ids} "
+            f"(очередь {report['queue_seconds']:.1f} с, "
+            f"публикация {report['post_seconds']:.1f} с)")
+
+
+# Инструменты с побочными эффектами
+TOOL_HANDLERS = {
+    "telegram": notify_telegram,
+    "github": create_github_issue,
+    "twitter": post_to_twitter,
+}
+
+# Инструменты, которые публикуют подготовленный ответ, а не текст задачи
+CONTENT_TOOLS = {"twitter"}
+
+
+# Результат инструмента, не уложившегося в бюджет стадии tools
+TOOL_TIMEOUT_SUFFIX = ": не дождались результата, действие завершается в фоне"
+
+
+def run_tool(task_id, tool, task_description, content=None):
+    """
+    Выполняет один инструмент.
+
+    Инструменты из CONTENT_TOOLS получают content — ответ на задачу
+    (запасной ответ по таймауту не публикуется, передаётся None).
+
+    Каждый инструмент — отдельный шаг журнала: при повторе задачи
+    побочные эффекты не дублируются. Ошибка инструмента в журнал не
+    попадает, поэтому при повторе задачи он выполнится снова. Если
+    инструмент не уложился в бюджет стадии tools, задача не ждёт его:
+    шаг завершится в фоне и попадёт в журнал, а вместо результата
+    вернётся строка с TOOL_TIMEOUT_SUFFIX (см. summarize_result).
+    """
+    argument = content if tool in CONTENT_TOOLS else task_description
+    func = lambda: TOOL_HANDLERS[tool](argument)
+    step = func if not task_id else (
+        lambda: ledger.run_step(task_id, f"execute:{tool}", func))
+    try:
+        return run_stage(
+            "tools", step,
+            fallback=lambda: f"⏱️ {tool}{TOOL_TIMEOUT_SUFFIX}")
+    except Exception as e:
+        return f"❌ {tool}: {e}"
+
+
 @log_step("Выполнение задачи")
 def execute_task(inputs):
     """Выполнение задачи с нужными инструментами."""
     analysis = inputs.get("analysis", {})
     task_description = inputs.get("task_description", "")
+    task_id = inputs.get("task_id")
     tools = analysis.get("tools", [])
 
-    logger.info(f"📥 Входные данные в выполнение: {inputs}")  # Логируем входные данные
+    logger.debug("📥 Входные данные в выполнение: %s", inputs)  # Логируем входные данные
 
     if not tools:
         logger.warning("⚠️ Внимание: нет инструментов для выполнения! Возможно, ошибка анализа.")
 
-    results = []
+    answer, content = inputs.get("answer"), None
+    degraded = bool(inputs.get("degraded"))
+    if CONTENT_TOOLS & set(tools):
+        # Публикуется ответ на задачу — готовим его до инструментов
+        if answer is None:
+            prepared = answer_task(inputs)
+            answer, degraded = prepared["answer"], bool(prepared.get("degraded"))
+        content = None if degraded else answer
+
+    results = [run_tool(task_id, tool, task_description, content)
+               for tool in TOOL_HANDLERS if tool in tools]
+
+    result = {"analysis": analysis, "task_id": task_id, "answer": answer,
+              "execution_results": results}
+    if degraded:
+        result["degraded"] = True
+    return result
+
+
+# --- 4. Ответ пользователю ---
+answer_prompt = PromptTemplate(
+    input_variables=["task_description", "context", "history"],
+    template="""
+    Ты AI-ассистент. Ответь на запрос пользователя кратко и по делу.
+    Если ниже есть материалы из интернета, опирайся на них и указывай ссылки.
+
+    Предыдущий разговор:
+    {history}
+
+    Материалы:
+    {context}
+
+    Запрос: {task_description}
+    """
+)
 
-    if "telegram" in tools:
-        telegram_agent = TelegramAgent()
-        result = telegram_agent.send_message(f"🔔 Выполняю задачу: {task_description}")
-        results.append(f"📢 Telegram: {result}")
 
-    if "github" in tools:
-        github_agent = GitHubAgent()
-        repo_name = "ai-agent-tasks"
-        result = github_agent.create_issue(repo_name, "AI Task", task_description)
-        results.append(f"🔧 GitHub Issue: {result}")
+@log_step("Ответ на запрос")
+@ledger_step("answer")
+def answer_task(inputs):
+    """
+    Генерирует ответ LLM с учётом найденных материалов и истории сессии.
 
-    return {"analysis": analysis, "execution_results": results}
+    Если ответ не уложился в бюджет стадии answer, возвращается прошлый
+    ответ на ту же задачу или частичный результат (см. answer_fallback).
+    Такой ответ, как и ответ без материалов из-за таймаута поиска,
+    помечается degraded и не сохраняется в журнале задач.
+    """
+    task_description = inputs["task_description"]
+    context = format_context(inputs.get("internet_results") or []) or "нет"
+    session_id = inputs.get("session_id")
 
+    def generate(history=""):
+        return run_stage(
+            "answer", lambda: generate_answer(task_description, context, history),
+            fallback=lambda: None)
 
-# --- 4. Формирование ответа ---
+    if session_id is None:
+        answer = generate()
+    else:
+        with sessions.session(session_id) as memory:
+            answer = generate(memory.buffer_as_str)
+            if answer is not None:
+                memory.save_context({"input": task_description}, {"output": answer})
+
+    if answer is None:
+        return {"answer": answer_fallback(inputs), "degraded": True,
+                "task_id": inputs.get("task_id")}
+    if inputs.get("degraded"):
+        # Поиск не уложился в бюджет: при повторе ответ подготовится с материалами
+        return {"answer": answer, "degraded": True, "task_id": inputs.get("task_id")}
+    return {"answer": answer, "task_id": inputs.get("task_id")}
+
+
+def generate_answer(task_description: str, context: str, history: str = "") -> str:
+    response = (answer_prompt | stage_llm("answer")).invoke(
+        {"task_description": task_description, "context": context,
+         "history": history or "нет"})
+    return re.sub(r"<think>.*?</think>", "", response.content, flags=re.DOTALL).strip()
+
+
+def answer_fallback(inputs):
+    """Ответ без LLM: прошлый ответ на ту же задачу в этом чате или найденные источники."""
+    task_id = inputs.get("task_id")
+    cached = ledger.cached_answer(task_id) if task_id else None
+    if cached:
+        return f"{cached}\n\n⏱️ Это прошлый ответ на такой же запрос: новый не успел подготовиться"
+    sources = "\n".join(f"• [{passage['title']}]({passage['url']})"
+                        for passage in inputs.get("internet_results") or [])
+    if sources:
+        return f"⏱️ Не успел сформулировать ответ. Вот что удалось найти:\n{sources}"
+    return "⏱️ Не успел сформулировать ответ, попробуйте повторить запрос позже"
+
+
+# --- 5. Формирование ответа ---
 @log_step("Формирование ответа")
+@ledger_step("summarize")
 def summarize_result(inputs):
-    """Формирует финальный ответ."""
+    """
+    Формирует финальный ответ.
+
+    Ответ помечается degraded (и не сохраняется в журнале задач), если
+    ответ запасной или какой-то инструмент ещё завершается в фоне: при
+    повторе задачи итог соберётся заново с результатом из журнала.
+    """
     execution_results = inputs.get("execution_results", [])
+    answer = inputs.get("answer")
 
-    if not execution_results:
+    if not execution_results and not answer:
         response = "⚠️ Ошибка! Никакие действия не были выполнены."
         logger.error(response)
+    elif not execution_results:
+        response = answer
     else:
         response = f"✅ Задача выполнена!\n{'\n'.join(execution_results)}"
+        if answer:
+            response = f"{answer}\n\n{response}"
 
+    if inputs.get("degraded") or any(
+            str(result).endswith(TOOL_TIMEOUT_SUFFIX) for result in execution_results):
+        return {"response": response, "degraded": True}
     return {"response": response}
 
 
@@ -204,7 +498,8 @@ def summarize_result(inputs):
 def build_agent_chain():
     """Создает цепочку обработки с логами."""
     return (
-        RunnableLambda(lambda x: {"task_description": x})  # Начало (вход)
+        # Начало (вход): строка задачи или словарь с task_description и task_id
+        RunnableLambda(lambda x: x if isinstance(x, dict) else {"task_description": x})
         | analyze_chain
         | RunnableLambda(search_internet)
         | RunnableLambda(execute_task)
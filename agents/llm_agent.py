@@ -1,16 +1,14 @@
-import os
+import time
+import logging
 import openai
-from dotenv import load_dotenv
 import re
 import json
+from config.settings import get_settings, stage_params
+from utils.accounting import accountant
+from agents.local_router import local_router, provider_breaker
+from utils.deadline import stage_timeout
 
-
-load_dotenv()
-
-# Настройки API-ключа
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_API_BASE_URL = os.getenv("OPENAI_API_BASE_URL")
-OPENAI_API_MODEL = os.getenv("OPENAI_API_MODEL")
+logger = logging.getLogger(__name__)
 
 
 class LLMAgent:
@@ -18,15 +16,15 @@ class LLMAgent:
 
     def models_list(self) -> str:
         """Возвращает список доступных моделей в виде строки."""
-        self.client = openai.OpenAI(
-            api_key=OPENAI_API_KEY, base_url=OPENAI_API_BASE_URL)
         models = self.client.models.list()
 
         return "\n".join(model.id for model in models.data)
 
     def __init__(self):
+        settings = get_settings()
         self.client = openai.OpenAI(
-            api_key=OPENAI_API_KEY, base_url=OPENAI_API_BASE_URL)
+            api_key=settings.openai_api_key, base_url=settings.openai_api_base_url or None,
+            timeout=settings.llm_timeout, max_retries=settings.llm_max_retries)
 
     def analyze_task(self, task_description: str) -> dict:
         """
@@ -35,6 +33,11 @@ class LLMAgent:
         :param task_description: Описание задачи
         :return: Словарь с анализом и рекомендациями
         """
+        # Явные задачи и недоступный провайдер — без LLM
+        decision = local_router.route(task_description)
+        if decision.fast or not provider_breaker.allow():
+            return {"think": "", **decision.as_analysis()}
+
         prompt = f"""
         Ты AI-ассистент. Получив задачу, ты должен определить,
         какие инструменты (GitHub, Twitter, Telegram, Tavily)
@@ -51,11 +54,23 @@ class LLMAgent:
         Входная задача: {task_description}
         """
 
-        response = self.client.chat.completions.create(
-            model=OPENAI_API_MODEL,
-            messages=[{"role": "system", "content": "Ты помощник AI."},
-                      {"role": "user", "content": prompt}]
-        )
+        # Выбор инструментов — модель, температура и лимит стадии analysis
+        params = stage_params("analysis")
+        params["model"] = accountant.choose_model(params["model"])
+        params["timeout"] = stage_timeout("analysis", get_settings().llm_timeout)
+        started_at = time.perf_counter()
+        try:
+            response = self.client.chat.completions.create(
+                messages=[{"role": "system", "content": "Ты помощник AI."},
+                          {"role": "user", "content": prompt}],
+                **params
+            )
+        except openai.OpenAIError as e:
+            provider_breaker.failure()
+            logger.error("❌ Ошибка LLM, используем локальную маршрутизацию: %s", e)
+            return {"think": "", **decision.as_analysis("ошибка LLM")}
+        provider_breaker.success()
+        accountant.record_openai(response, time.perf_counter() - started_at)
 
         result = response.choices[0].message.content
         # Извлекаем <think>...</think>
@@ -69,10 +84,12 @@ class LLMAgent:
         # Преобразуем JSON в словарь
         try:
             json_data = json.loads(json_text)
-        except json.JSONDecodeError:
-            print("❌ Ошибка: Модель вернула некорректный JSON!")
-            print("Ответ модели:", result)
-            json_data = {"summary": "Ошибка обработки", "tools": []}
+            if not isinstance(json_data.get("tools"), list):
+                raise ValueError("нет списка tools")
+        except ValueError:
+            logger.error("❌ Ошибка: Модель вернула некорректный JSON! Ответ модели: %s",
+                         result)
+            json_data = decision.as_analysis("ответ LLM не разобран")
 
         return {
             "think": think_text,
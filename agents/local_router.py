@@ -0,0 +1,304 @@
+"""
+Локальный выбор инструментов без LLM.
+
+Два уровня:
+  * правила — все фразы-триггеры инструментов собраны в одно заранее
+    скомпилированное регулярное выражение с именованными группами,
+    текст задачи просматривается за один проход;
+  * классификатор — наивный Байес «один против остальных» на NumPy
+    по хешированным основам слов, обученный на SEED_EXAMPLES.
+
+Решение с явным упоминанием инструмента (твит, issue, телеграм, найди...)
+и уверенностью не ниже local_router_confidence отдаётся сразу, без
+вызова модели — если в нём нет инструментов с побочными эффектами или
+для каждого из них в задаче есть явное действие. Действие засчитывается,
+только если глагол относится к самому инструменту: стоит рядом с
+триггером («создай issue», «опубликуй в Twitter», «сообщи команде в
+Telegram»), а не где-то в тексте («открой статью про GitHub», «что
+обсуждали в чате? напиши кратко»). Простое упоминание сервиса («Что
+такое GitHub Actions?», «названия для телеграм-канала») решает модель.
+
+Когда провайдер недоступен или вернул мусор, решение маршрутизатора
+используется как запасное — задача выполняется в деградированном
+режиме, а не завершается без действий. Инструменты с побочными
+эффектами без явного действия в запасном решении не запускаются.
+"""
+
+import re
+import time
+import zlib
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+import numpy as np
+from config.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+TOOLS = ("twitter", "telegram", "github", "tavily")
+
+# Явные упоминания инструментов; ключи совпадают с TOOLS
+TRIGGERS: dict[str, list[str]] = {
+    "twitter": [r"твит\w*", r"твиттер\w*", r"ретвит\w*", r"twitter", r"tweet\w*"],
+    "telegram": [r"телеграм\w*", r"телеграмм\w*", r"telegram", r"тг"],
+    "github": [r"github", r"гитхаб\w*", r"issue\w*", r"иссь?ю", r"репозитор\w*",
+               r"баг-?репорт\w*", r"pull\s+request\w*", r"пулл?-?реквест\w*"],
+    "tavily": [r"найд\w*", r"найти", r"поищ\w*", r"поиск\w*", r"загугл\w*",
+               r"в\s+интернете", r"в\s+сети", r"погод\w*", r"свеж\w*", r"search", r"google"],
+}
+
+# Инструменты с побочными эффектами: без LLM — только при явном действии
+SIDE_EFFECT_TOOLS = ("twitter", "telegram", "github")
+
+# Глагол относится к инструменту, если между ними не больше трёх слов,
+# нет конца предложения и перед триггером не стоит предлог темы
+# («открой статью про GitHub», «пост для телеграм-канала»)
+_MAX_GAP_WORDS = 3
+_TOPIC_WORDS = {"про", "о", "об", "обо", "для", "насчёт", "about", "for", "of"}
+
+# Действия с инструментами (повелительное наклонение и английские глаголы)
+ACTIONS: dict[str, list[str]] = {
+    "twitter": [r"опублику\w*", r"запост\w*", r"напиши", r"твитни", r"ретвитни",
+                r"сделай\s+тред", r"post", r"publish", r"tweet"],
+    "telegram": [r"отправ\w*", r"пришли\w*", r"уведом\w*", r"сообщи\w*", r"напиши",
+                 r"напомни\w*", r"продублируй\w*", r"перешли\w*", r"send", r"notify"],
+    "github": [r"создай\w*", r"заведи\w*", r"открой\w*", r"загрузи\w*", r"запушь\w*",
+               r"create", r"open", r"file", r"upload"],
+}
+
+# Обучающие примеры классификатора: формулировки без явных триггеров тоже
+SEED_EXAMPLES: list[tuple[str, tuple[str, ...]]] = [
+    ("Опубликуй пост в твиттере о запуске продукта", ("twitter",)),
+    ("Напиши твит с анонсом вебинара", ("twitter",)),
+    ("Запости в X короткое сообщение о скидках", ("twitter",)),
+    ("Сделай тред про итоги квартала", ("twitter",)),
+    ("Tweet about our new release", ("twitter",)),
+    ("Отправь сообщение в телеграм о начале совещания", ("telegram",)),
+    ("Уведоми команду в чате, что сервер перезапущен", ("telegram",)),
+    ("Напомни в телеге про дедлайн", ("telegram",)),
+    ("Пришли мне уведомление, когда закончишь", ("telegram",)),
+    ("Send a telegram notification about the outage", ("telegram",)),
+    ("Создай issue про утечку памяти", ("github",)),
+    ("Заведи баг в репозитории про падение тестов", ("github",)),
+    ("Открой задачу на гитхабе по рефакторингу", ("github",)),
+    ("Загрузи файл в репозиторий проекта", ("github",)),
+    ("Open a GitHub issue for the login bug", ("github",)),
+    ("Найди информацию о новом iPhone", ("tavily",)),
+    ("Какой сегодня курс доллара", ("tavily",)),
+    ("Что сейчас происходит на бирже", ("tavily",)),
+    ("Узнай расписание поездов до Казани на завтра", ("tavily",)),
+    ("Кто выиграл последний чемпионат мира", ("tavily",)),
+    ("Посмотри свежие новости про ИИ", ("tavily",)),
+    ("Какая погода будет в выходные", ("tavily",)),
+    ("Search the web for the latest Rust release", ("tavily",)),
+    ("Найди новости про SpaceX и опубликуй твит", ("tavily", "twitter")),
+    ("Узнай курс евро и отправь в телеграм", ("tavily", "telegram")),
+    ("Найди статьи про уязвимость и заведи issue", ("tavily", "github")),
+    ("Создай issue и сообщи об этом в телеграм", ("github", "telegram")),
+    ("Напиши твит и продублируй его в телеграм", ("twitter", "telegram")),
+    ("Объясни, как работает сборщик мусора в Python", ()),
+    ("Привет, как у тебя дела", ()),
+    ("Расскажи анекдот", ()),
+    ("Переведи текст на немецкий", ()),
+    ("Напиши SQL-запрос для выборки пользователей", ()),
+    ("Что такое рекурсия", ()),
+    ("Придумай слоган для кофейни", ()),
+    ("Реши уравнение x в квадрате равно 16", ()),
+    ("Сформулируй письмо с извинениями клиенту", ()),
+    ("Explain the difference between TCP and UDP", ()),
+    ("Помоги составить план тренировок", ()),
+    ("Сократи этот текст до двух предложений", ()),
+]
+
+# Размер пространства хешированных признаков
+_FEATURES = 4096
+_STEM_LENGTH = 5
+
+
+def _features(text: str) -> np.ndarray:
+    """Индексы признаков: основы слов, хешированные crc32 (стабильно между процессами)."""
+    stems = {word[:_STEM_LENGTH] for word in re.findall(r"\w{2,}", text.lower())}
+    return np.fromiter(
+        (zlib.crc32(stem.encode("utf-8")) % _FEATURES for stem in stems),
+        dtype=np.intp, count=len(stems))
+
+
+@dataclass
+class RouteDecision:
+    tools: list[str]
+    # Уверенность в наборе целиком: минимум по инструментам max(p, 1 - p)
+    confidence: float
+    # Инструменты, упомянутые явно (сработали правила)
+    triggered: list[str] = field(default_factory=list)
+    # Инструменты с побочными эффектами, для которых в задаче есть явное действие
+    actions: list[str] = field(default_factory=list)
+    # Вероятность нужности каждого инструмента
+    probabilities: dict[str, float] = field(default_factory=dict)
+
+    @property
+    def fast(self) -> bool:
+        """
+        Можно ли обойтись без LLM: есть явный триггер, высокая уверенность
+        и явное действие для каждого инструмента с побочными эффектами.
+        """
+        return bool(self.triggered) and (
+            self.confidence >= get_settings().local_router_confidence) and all(
+            tool in self.actions for tool in self.tools if tool in SIDE_EFFECT_TOOLS)
+
+    def as_analysis(self, reason: str = "локальная маршрутизация") -> dict:
+        """
+        Анализ в формате ответа модели (summary, tools).
+
+        Инструменты с побочными эффектами без явного действия отбрасываются —
+        то же правило, что и в fast, но для запасного решения без LLM.
+        """
+        selected = [tool for tool in self.tools
+                    if tool not in SIDE_EFFECT_TOOLS or tool in self.actions]
+        tools = ", ".join(selected) or "без инструментов"
+        return {"summary": f"{reason[:1].upper()}{reason[1:]}: {tools}",
+                "tools": selected, "source": "local"}
+
+
+class LocalRouter:
+    """Правила плюс наивный Байес по инструментам. Решение — за микросекунды."""
+
+    def __init__(self, examples: Iterable[tuple[str, Iterable[str]]] = SEED_EXAMPLES,
+                 threshold: float = 0.5) -> None:
+        self.threshold = threshold
+        self._pattern = re.compile(
+            "|".join(rf"(?P<{tool}>\b(?:{'|'.join(TRIGGERS[tool])})\b)" for tool in TOOLS),
+            re.IGNORECASE)
+        # Глаголы у инструментов пересекаются («напиши»), поэтому выражения раздельные
+        self._actions = {
+            tool: re.compile(rf"\b(?:{'|'.join(ACTIONS[tool])})\b", re.IGNORECASE)
+            for tool in SIDE_EFFECT_TOOLS}
+        self.fit(examples)
+
+    def fit(self, examples: Iterable[tuple[str, Iterable[str]]]) -> None:
+        """
+        Обучает классификатор.
+
+        :param examples: Пары (текст задачи, нужные инструменты)
+        """
+        counts = np.ones((len(TOOLS), 2, _FEATURES))  # сглаживание Лапласа
+        labels = np.zeros((len(TOOLS), 2))
+        for text, tools in examples:
+            features = _features(text)
+            for idx, tool in enumerate(TOOLS):
+                positive = int(tool in tools)
+                np.add.at(counts[idx, positive], features, 1)
+                labels[idx, positive] += 1
+
+        log_probs = np.log(counts / counts.sum(axis=2, keepdims=True))
+        # Логарифм отношения правдоподобий: слагаемое на каждый признак
+        self._weights = log_probs[:, 1, :] - log_probs[:, 0, :]
+        self._bias = np.log((labels[:, 1] + 1) / (labels[:, 0] + 1))
+
+    def triggers(self, text: str) -> list[str]:
+        """Инструменты, упомянутые в тексте явно, в порядке TOOLS."""
+        found = {match.lastgroup for match in self._pattern.finditer(text)}
+        return [tool for tool in TOOLS if tool in found]
+
+    def actions(self, text: str) -> list[str]:
+        """
+        Инструменты с побочными эффектами, для которых в тексте есть
+        действие, относящееся именно к ним (см. _governs).
+        """
+        spans: dict[str, list[tuple[int, int]]] = {}
+        for match in self._pattern.finditer(text):
+            spans.setdefault(match.lastgroup, []).append(match.span())
+        return [tool for tool in SIDE_EFFECT_TOOLS if any(
+            self._governs(text, verb.span(), trigger)
+            for verb in self._actions[tool].finditer(text)
+            for trigger in spans.get(tool, ()))]
+
+    @staticmethod
+    def _governs(text: str, verb: tuple[int, int], trigger: tuple[int, int]) -> bool:
+        """Стоит ли глагол verb перед триггером trigger как его действие."""
+        if verb[0] < trigger[1] and trigger[0] < verb[1]:
+            return True  # глагол и есть триггер: «твитни», «tweet»
+        if verb[1] > trigger[0]:
+            return False
+        gap = text[verb[1]:trigger[0]]
+        words = re.findall(r"\w+", gap)
+        return (len(words) <= _MAX_GAP_WORDS and not re.search(r"[.!?;]", gap)
+                and not (words and words[-1].lower() in _TOPIC_WORDS))
+
+    def probabilities(self, text: str) -> np.ndarray:
+        """Вероятность нужности каждого инструмента по классификатору."""
+        scores = self._weights[:, _features(text)].sum(axis=1) + self._bias
+        return 1.0 / (1.0 + np.exp(-np.clip(scores, -30, 30)))
+
+    def route(self, text: str) -> RouteDecision:
+        """
+        Выбирает инструменты для задачи.
+
+        :param text: Описание задачи
+        :return: Решение: инструменты, уверенность и сработавшие правила
+        """
+        triggered = self.triggers(text)
+        probs = self.probabilities(text)
+        for idx, tool in enumerate(TOOLS):
+            if tool in triggered:
+                probs[idx] = max(probs[idx], 0.99)
+        tools = [tool for idx, tool in enumerate(TOOLS) if probs[idx] >= self.threshold]
+        confidence = float(np.maximum(probs, 1 - probs).min())
+        return RouteDecision(tools, confidence, triggered, self.actions(text),
+                             dict(zip(TOOLS, probs.tolist())))
+
+
+class ProviderBreaker:
+    """
+    Размыкатель для LLM-провайдера.
+
+    После failures ошибок подряд вызовы модели пропускаются на cooldown
+    секунд — задачи сразу идут через локальный маршрутизатор и не ждут
+    таймаута на каждом запросе. Затем пропускается одна пробная попытка.
+    """
+
+    def __init__(self, failures: Optional[int] = None,
+                 cooldown: Optional[float] = None) -> None:
+        self._failures = failures
+        self._cooldown = cooldown
+        self._errors = 0
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def failures(self) -> int:
+        return self._failures if self._failures is not None else get_settings().provider_breaker_failures
+
+    @property
+    def cooldown(self) -> float:
+        return self._cooldown if self._cooldown is not None else get_settings().provider_breaker_cooldown
+
+    def allow(self) -> bool:
+        """Можно ли сейчас обращаться к провайдеру."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.cooldown:
+                # Пробная попытка; при новой ошибке размыкатель снова откроется
+                self._opened_at = None
+                self._errors = self.failures - 1
+                return True
+            return False
+
+    def success(self) -> None:
+        with self._lock:
+            self._errors = 0
+            self._opened_at = None
+
+    def failure(self) -> None:
+        with self._lock:
+            self._errors += 1
+            if self._errors >= self.failures and self._opened_at is None:
+                self._opened_at = time.monotonic()
+                logger.warning("🔌 Провайдер LLM недоступен (%s ошибок подряд), "
+                               "%.0f с работаем на локальной маршрутизации",
+                               self._errors, self.cooldown)
+
+
+local_router = LocalRouter()
+provider_breaker = ProviderBreaker()
@@ -0,0 +1,187 @@
+"""
+Упреждающий поиск в Tavily.
+
+Анализ задачи — полный цикл запроса к LLM, и только после него
+search_internet начинал поиск. При включённом search_prefetch поиск
+стартует одновременно с анализом: если анализ выбрал tavily, результат
+уже готов (или почти готов), и задача экономит целый запрос к Tavily.
+Если не выбрал — результат остаётся в кеше поиска и пригодится
+повторному запросу.
+
+Ограничения расходов: поиск запускается, только если локальный
+маршрутизатор оценивает его нужность не ниже
+search_prefetch_min_probability, и не чаще search_prefetch_per_minute
+раз в минуту. Уже закешированные запросы не повторяются.
+
+Каждый запущенный поиск забирается take() или отбрасывается discard();
+если задача оборвалась раньше, запись забывается через _PENDING_TTL
+(результат всё равно остаётся в кеше).
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from agents.tavily_agent import TavilyAgent
+from agents.web_retriever import ContentCache
+from config.settings import get_settings
+from utils.deadline import stage_timeout
+
+logger = logging.getLogger(__name__)
+
+# Сколько хранить незабранный упреждающий поиск, с
+_PENDING_TTL = 120.0
+
+
+class SearchCache(ContentCache):
+    """Кеш результатов поиска: размер и время жизни — search_cache_*."""
+
+    @property
+    def maxsize(self) -> int:
+        return self._maxsize if self._maxsize is not None else get_settings().search_cache_size
+
+    @property
+    def ttl(self) -> float:
+        return self._ttl if self._ttl is not None else get_settings().search_cache_ttl
+
+
+class SearchPrefetcher:
+    """Поиск через кеш с упреждающим запуском и учётом попаданий."""
+
+    def __init__(self, max_workers: int = 2) -> None:
+        self.cache = SearchCache()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="search-prefetch")
+        self._pending: dict[str, tuple[Future, float]] = {}
+        self._started: deque[float] = deque()
+        self._lock = threading.Lock()
+        self.metrics = {
+            "started": 0,      # запущено упреждающих поисков
+            "used": 0,         # пригодились: анализ выбрал tavily
+            "wasted": 0,       # не пригодились (результат остался в кеше)
+            "cache_hits": 0,   # поиск не понадобился — ответ уже в кеше
+            "skipped": 0,      # отклонено ограничением расходов
+            "saved_seconds": 0.0,
+        }
+
+    def search(self, query: str, max_results: int = 5) -> list[dict]:
+        """
+        Поиск через кеш.
+
+        :param query: Строка запроса
+        :param max_results: Количество результатов
+        :return: Результаты Tavily (url, title, content)
+        """
+        cached = self.cache.get(query)
+        if cached is not None:
+            return cached["results"]
+        results = TavilyAgent().search_results(query, max_results)
+        if results:
+            # Пустой ответ — скорее ошибка, его не кешируем
+            self.cache.put(query, {"results": results})
+        return results
+
+    def speculate(self, query: str, probability: float) -> bool:
+        """
+        Запускает поиск заранее, если это разрешено настройками и лимитом.
+
+        :param query: Строка запроса (описание задачи)
+        :param probability: Оценка нужности поиска от локального маршрутизатора
+        :return: Запущен ли поиск
+        """
+        settings = get_settings()
+        if not settings.search_prefetch:
+            return False
+        if probability < settings.search_prefetch_min_probability:
+            return False
+        if self.cache.get(query) is not None:
+            return False
+
+        now = time.monotonic()
+        with self._lock:
+            self._forget_stale(now)
+            if query in self._pending:
+                return False
+            while self._started and now - self._started[0] >= 60:
+                self._started.popleft()
+            if len(self._started) >= settings.search_prefetch_per_minute:
+                self.metrics["skipped"] += 1
+                logger.info("💸 Упреждающий поиск пропущен: лимит %s в минуту",
+                            settings.search_prefetch_per_minute)
+                return False
+            self._started.append(now)
+            self.metrics["started"] += 1
+            self._pending[query] = (self._executor.submit(self._timed_search, query), now)
+
+        logger.info("🚀 Упреждающий поиск (p=%.2f): %s", probability, query)
+        return True
+
+    def take(self, query: str, max_results: int = 5) -> list[dict]:
+        """
+        Результаты поиска для выбранного tavily: упреждающие, если были, иначе из кеша
+        или новым запросом. Упреждающий поиск ждётся не дольше таймаута Tavily
+        в пределах бюджета стадии search; не дождались — результатов нет.
+        """
+        with self._lock:
+            pending = self._pending.pop(query, None)
+        if pending is None:
+            if self.cache.get(query) is not None:
+                self._count("cache_hits")
+            return self.search(query, max_results)
+
+        future, started_at = pending
+        waited_at = time.monotonic()
+        try:
+            results, search_seconds = future.result(
+                timeout=stage_timeout("search", get_settings().search_timeout))
+        except FutureTimeoutError:
+            self._count("wasted")
+            logger.warning("⏱️ Упреждающий поиск не завершился вовремя: %s", query)
+            return []
+        # Экономия — часть поиска, прошедшая параллельно с анализом
+        saved = min(search_seconds, waited_at - started_at)
+        with self._lock:
+            self.metrics["used"] += 1
+            self.metrics["saved_seconds"] += saved
+        logger.info("🎯 Упреждающий поиск пригодился: сэкономлено %.2f с из %.2f с, %s",
+                    saved, search_seconds, self.hit_rate_text())
+        return results
+
+    def discard(self, query: str) -> None:
+        """Анализ не выбрал tavily: поиск не отменяется, результат останется в кеше."""
+        with self._lock:
+            pending = self._pending.pop(query, None)
+            if pending is None:
+                return
+            self.metrics["wasted"] += 1
+        logger.info("🗑️ Упреждающий поиск не понадобился, %s", self.hit_rate_text())
+
+    def _forget_stale(self, now: float) -> None:
+        """Забывает поиски, которые никто не забрал (под self._lock)."""
+        stale = [query for query, (_, started_at) in self._pending.items()
+                 if now - started_at > _PENDING_TTL]
+        for query in stale:
+            del self._pending[query]
+        self.metrics["wasted"] += len(stale)
+
+    def _timed_search(self, query: str) -> tuple[list[dict], float]:
+        started_at = time.monotonic()
+        results = self.search(query)
+        return results, time.monotonic() - started_at
+
+    def hit_rate(self) -> float:
+        """Доля упреждающих поисков, которые пригодились."""
+        finished = self.metrics["used"] + self.metrics["wasted"]
+        return self.metrics["used"] / finished if finished else 0.0
+
+    def hit_rate_text(self) -> str:
+        return (f"попаданий {self.metrics['used']} из "
+                f"{self.metrics['used'] + self.metrics['wasted']} ({self.hit_rate():.0%})")
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.metrics[name] += 1
+
+
+prefetcher = SearchPrefetcher()
@@ -0,0 +1,140 @@
+"""
+Изолированные сессии (память диалога) по пользователю или чату.
+
+Раньше память была одна на процесс: истории всех пользователей
+смешивались, а промпт каждого рос вместе со всей аудиторией. Теперь
+у каждого ключа (chat_id, user_id) своя сессия:
+  * создаётся лениво при первом обращении;
+  * ограничена по размеру — после каждого использования вызывается trim;
+  * простаивающие дольше session_idle_ttl сессии удаляются, а при
+    превышении session_max_sessions вытесняются давно не использованные;
+  * у каждой сессии свой замок: разные пользователи работают
+    параллельно, общий замок держится только на время поиска в словаре.
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Hashable, Iterator, Optional
+from config.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+class _Session:
+    __slots__ = ("value", "lock", "last_used")
+
+    def __init__(self, value: Any) -> None:
+        self.value = value
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+
+class SessionManager:
+    """Сессии по ключу с ленивым созданием, ограничением размера и вытеснением."""
+
+    def __init__(self, factory: Callable[[], Any],
+                 trim: Optional[Callable[[Any], None]] = None,
+                 max_sessions: Optional[int] = None,
+                 idle_ttl: Optional[float] = None, name: str = "sessions") -> None:
+        """
+        :param factory: Создаёт содержимое новой сессии (память, список сообщений)
+        :param trim: Ограничивает размер сессии; вызывается после каждого использования
+        :param max_sessions: Максимум сессий (по умолчанию session_max_sessions)
+        :param idle_ttl: Время простоя до удаления, с (по умолчанию session_idle_ttl)
+        :param name: Имя для логов
+        """
+        self.factory = factory
+        self.trim = trim
+        self.name = name
+        self._max_sessions = max_sessions
+        self._idle_ttl = idle_ttl
+        self._sessions: OrderedDict[Hashable, _Session] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_sessions(self) -> int:
+        return self._max_sessions if self._max_sessions is not None else get_settings().session_max_sessions
+
+    @property
+    def idle_ttl(self) -> float:
+        return self._idle_ttl if self._idle_ttl is not None else get_settings().session_idle_ttl
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    @contextmanager
+    def session(self, key: Hashable) -> Iterator[Any]:
+        """
+        Монопольный доступ к сессии ключа (создаётся при необходимости).
+
+        :param key: ID пользователя или чата
+        :return: Содержимое сессии
+        """
+        while True:
+            entry = self._get_or_create(key)
+            entry.lock.acquire()
+            # Сессию могли вытеснить, пока ждали замок, — берём актуальную
+            if self._sessions.get(key) is entry:
+                break
+            entry.lock.release()
+        try:
+            yield entry.value
+        finally:
+            try:
+                if self.trim is not None:
+                    self.trim(entry.value)
+            finally:
+                entry.last_used = time.monotonic()
+                entry.lock.release()
+
+    def reset(self, key: Hashable) -> None:
+        """Удаляет сессию ключа (следующее обращение создаст новую)."""
+        with self._lock:
+            self._sessions.pop(key, None)
+
+    def _get_or_create(self, key: Hashable) -> _Session:
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is not None:
+                self._sessions.move_to_end(key)
+                return entry
+            self._evict()
+            entry = self._sessions[key] = _Session(self.factory())
+            return entry
+
+    def _evict(self) -> None:
+        """Удаляет простаивающие сессии и вытесняет старые сверх лимита (под self._lock)."""
+        now, idle_ttl = time.monotonic(), self.idle_ttl
+        expired = [key for key, entry in self._sessions.items()
+                   if now - entry.last_used > idle_ttl and not entry.lock.locked()]
+        for key in expired:
+            del self._sessions[key]
+
+        overflow = len(self._sessions) - self.max_sessions + 1
+        evicted = 0
+        for key in list(self._sessions):
+            if evicted >= overflow:
+                break
+            if not self._sessions[key].lock.locked():
+                del self._sessions[key]
+                evicted += 1
+        if expired or evicted:
+            logger.info("🧹 %s: удалено %s простаивающих и %s вытесненных сессий",
+                        self.name, len(expired), evicted)
+
+
+def trim_memory(max_turns: Optional[int] = None) -> Callable[[Any], None]:
+    """
+    Ограничитель для памяти LangChain: оставляет последние max_turns обменов.
+
+    :param max_turns: Пар «запрос — ответ» (по умолчанию session_max_turns)
+    """
+    def trim(memory) -> None:
+        limit = 2 * (get_settings().session_max_turns if max_turns is None else max_turns)
+        messages = memory.chat_memory.messages
+        if len(messages) > limit:
+            del messages[:len(messages) - limit]
+    return trim
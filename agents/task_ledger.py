@@ -0,0 +1,261 @@
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+from config.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Статусы задачи в журнале
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id TEXT PRIMARY KEY,
+    description TEXT NOT NULL,
+    status TEXT NOT NULL,
+    response TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    content_key TEXT
+);
+CREATE TABLE IF NOT EXISTS steps (
+    task_id TEXT NOT NULL,
+    step TEXT NOT NULL,
+    result TEXT NOT NULL,
+    finished_at REAL NOT NULL,
+    PRIMARY KEY (task_id, step)
+);
+CREATE TABLE IF NOT EXISTS aliases (
+    alias TEXT PRIMARY KEY,
+    task_id TEXT NOT NULL
+);
+"""
+
+
+@dataclass
+class TaskTicket:
+    """
+    Результат регистрации задачи в журнале.
+
+    status:
+      - "new" — задача зарегистрирована впервые;
+      - "resumed" — задача была прервана и продолжится с последнего шага;
+      - "running" — такая же задача выполняется прямо сейчас;
+      - "done" — задача уже выполнена, в response сохранённый ответ.
+    """
+    task_id: str
+    status: str
+    response: Optional[str] = None
+
+
+class TaskLedger:
+    """
+    Журнал задач на SQLite.
+
+    Связывает задачу с ID апдейта Telegram и с хешем содержимого,
+    хранит результаты выполненных шагов. Повторная доставка апдейта
+    или повторная отправка той же /task не запускает побочные эффекты
+    заново: возвращается сохранённый результат или выполнение
+    продолжается с последнего завершённого шага.
+    """
+
+    def __init__(self, path: Optional[str] = None,
+                 dedupe_window: Optional[float] = None) -> None:
+        settings = get_settings()
+        self.path = path or settings.task_ledger_path
+        self._dedupe_window = dedupe_window
+
+        self._lock = threading.Lock()
+        # Задачи, которые выполняются в этом процессе
+        self._active: set[str] = set()
+
+        self._conn = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(tasks)")}
+        if "content_key" not in columns:
+            # Журнал, созданный до появления content_key
+            self._conn.execute("ALTER TABLE tasks ADD COLUMN content_key TEXT")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS tasks_content_key ON tasks (content_key)")
+
+    @property
+    def dedupe_window(self) -> float:
+        """Окно дедупликации по содержимому, секунды."""
+        return self._dedupe_window if self._dedupe_window is not None else get_settings().task_ledger_dedupe_window
+
+    @staticmethod
+    def content_key(chat_id: Any, task_description: str) -> str:
+        """
+        Ключ дедупликации по содержимому задачи.
+
+        :param chat_id: ID чата, из которого пришла задача
+        :param task_description: Описание задачи
+        :return: Ключ вида content:<sha256>
+        """
+        normalized = " ".join(task_description.lower().split())
+        digest = hashlib.sha256(f"{chat_id}:{normalized}".encode("utf-8")).hexdigest()
+        return f"content:{digest}"
+
+    @staticmethod
+    def update_key(chat_id: Any, message_id: Any) -> str:
+        """Ключ дедупликации по апдейту Telegram (повторная доставка)."""
+        return f"update:{chat_id}:{message_id}"
+
+    def begin(self, task_description: str, chat_id: Any = None,
+              message_id: Any = None) -> TaskTicket:
+        """
+        Регистрирует задачу или находит уже существующую.
+
+        :param task_description: Описание задачи
+        :param chat_id: ID чата
+        :param message_id: ID сообщения с задачей
+        :return: TaskTicket с ID задачи и её статусом
+        """
+        content_alias = self.content_key(chat_id, task_description)
+        update_alias = (self.update_key(chat_id, message_id)
+                        if message_id is not None else None)
+        now = time.time()
+
+        with self._lock:
+            task = None
+            if update_alias:
+                task = self._find_task(update_alias)
+            if task is None:
+                task = self._find_task(content_alias)
+                if task is not None and now - task["created_at"] > self.dedupe_window:
+                    task = None
+
+            if task is None:
+                task_id = uuid.uuid4().hex
+                self._conn.execute(
+                    "INSERT INTO tasks (task_id, description, status, created_at, "
+                    "updated_at, content_key) VALUES (?, ?, ?, ?, ?, ?)",
+                    (task_id, task_description, STATUS_RUNNING, now, now, content_alias))
+                self._set_alias(content_alias, task_id)
+                if update_alias:
+                    self._set_alias(update_alias, task_id)
+                self._active.add(task_id)
+                logger.info("🆕 Задача %s зарегистрирована", task_id)
+                return TaskTicket(task_id, "new")
+
+            task_id = task["task_id"]
+            if update_alias:
+                self._set_alias(update_alias, task_id)
+
+            if task["status"] == STATUS_DONE:
+                logger.info("♻️ Задача %s уже выполнена, отдаём сохранённый ответ", task_id)
+                return TaskTicket(task_id, "done", task["response"])
+
+            if task_id in self._active:
+                logger.info("⏳ Задача %s уже выполняется", task_id)
+                return TaskTicket(task_id, "running")
+
+            self._active.add(task_id)
+            logger.info("🔁 Задача %s была прервана, продолжаем", task_id)
+            return TaskTicket(task_id, "resumed")
+
+    def run_step(self, task_id: str, step: str, func: Callable[[], Any]) -> Any:
+        """
+        Выполняет шаг задачи или возвращает его сохранённый результат.
+
+        Результат шага должен сериализоваться в JSON. Если func выбросила
+        исключение или вернула словарь с пометкой degraded (запасной
+        результат по таймауту), результат не сохраняется: при повторе
+        задачи шаг выполнится снова.
+
+        :param task_id: ID задачи
+        :param step: Имя шага
+        :param func: Функция без аргументов, выполняющая шаг
+        :return: Результат шага
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM steps WHERE task_id = ? AND step = ?",
+                (task_id, step)).fetchone()
+        if row is not None:
+            logger.info("⏭️ Шаг %s задачи %s уже выполнен, пропускаем", step, task_id)
+            return json.loads(row[0])
+
+        result = func()
+        if isinstance(result, dict) and result.get("degraded"):
+            logger.info("⏱️ Шаг %s задачи %s выполнен по запасному варианту, не сохраняем",
+                        step, task_id)
+            return result
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?)",
+                (task_id, step, json.dumps(result, ensure_ascii=False, default=str),
+                 time.time()))
+            self._conn.execute(
+                "UPDATE tasks SET updated_at = ? WHERE task_id = ?",
+                (time.time(), task_id))
+        return result
+
+    def finish(self, task_id: str, response: str) -> None:
+        """
+        Отмечает задачу выполненной и сохраняет итоговый ответ.
+
+        :param task_id: ID задачи
+        :param response: Ответ, отправленный пользователю
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE tasks SET status = ?, response = ?, updated_at = ? "
+                "WHERE task_id = ?",
+                (STATUS_DONE, response, time.time(), task_id))
+            self._active.discard(task_id)
+
+    def cached_answer(self, task_id: str) -> Optional[str]:
+        """
+        Последний полноценный ответ (шаг answer) на такую же задачу из того же чата.
+
+        Задачи сравниваются по content_key: ответ учитывает историю сессии,
+        поэтому ответы из других чатов не подходят. Запасной ответ,
+        подставленный по таймауту, не учитывается.
+
+        :param task_id: ID текущей задачи
+        :return: Текст ответа или None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT s.result FROM tasks cur "
+                "JOIN tasks t ON t.content_key = cur.content_key "
+                "JOIN steps s ON s.task_id = t.task_id "
+                "WHERE cur.task_id = ? AND s.step = 'answer' "
+                "AND json_extract(s.result, '$.degraded') IS NULL "
+                "ORDER BY s.finished_at DESC LIMIT 1", (task_id,)).fetchone()
+        return json.loads(row[0]).get("answer") if row else None
+
+    def release(self, task_id: str) -> None:
+        """
+        Снимает отметку о выполнении в этом процессе.
+
+        Если задача не завершена, при следующей попытке она продолжится
+        с последнего сохранённого шага.
+        """
+        with self._lock:
+            self._active.discard(task_id)
+
+    def _find_task(self, alias: str) -> Optional[dict]:
+        row = self._conn.execute(
+            "SELECT t.task_id, t.status, t.response, t.created_at "
+            "FROM aliases a JOIN tasks t ON t.task_id = a.task_id "
+            "WHERE a.alias = ?", (alias,)).fetchone()
+        if row is None:
+            return None
+        return {"task_id": row[0], "status": row[1],
+                "response": row[2], "created_at": row[3]}
+
+    def _set_alias(self, alias: str, task_id: str) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO aliases VALUES (?, ?)", (alias, task_id))
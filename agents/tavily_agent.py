@@ -1,10 +1,7 @@
-import os
 import logging
 from tavily import TavilyClient
-from dotenv import load_dotenv
-
-# Загружаем переменные окружения
-load_dotenv()
+from config.settings import get_settings
+from utils.deadline import stage_timeout
 
 # Настраиваем логирование
 logger = logging.getLogger(__name__)
@@ -14,26 +11,40 @@ class TavilyAgent:
     """Агент для поиска информации в интернете с помощью Tavily."""
 
     def __init__(self) -> None:
-        self.api_key = os.getenv("TAVILY_API_KEY")
+        settings = get_settings()
+        self.api_key = settings.tavily_api_key
         if not self.api_key:
             raise ValueError(
                 "❌ Не указан API-ключ Tavily. ")
-        self.client = TavilyClient(self.api_key)
+        self.client = TavilyClient(
+            self.api_key, api_base_url=settings.tavily_api_base_url or None)
 
-    def search(self, query: str, max_results: int = 5) -> list[str]:
+    def search_results(self, query: str, max_results: int = 5) -> list[dict]:
         """
-        Выполняет поиск информации в интернете.
+        Выполняет поиск и возвращает результаты целиком.
 
         :param query: Строка запроса.
         :param max_results: Количество результатов (по умолчанию 5).
-        :return: Список URL с найденными источниками.
+        :return: Список словарей с url, title и content.
         """
         try:
-            logger.info(f"🔍 Выполняем поиск в Tavily: {query}")
-            results = self.client.search(query, max_results=max_results)
-            urls = [result["url"] for result in results.get("results", [])]
-            logger.info(f"✅ Найдено {len(urls)} результатов.")
-            return urls
+            logger.info("🔍 Выполняем поиск в Tavily: %s", query)
+            results = self.client.search(
+                query, max_results=max_results,
+                timeout=stage_timeout("search", get_settings().search_timeout))
+            found = results.get("results", [])
+            logger.info("✅ Найдено %s результатов.", len(found))
+            return found
         except Exception as e:
-            logger.error(f"❌ Ошибка при поиске: {e}")
+            logger.error("❌ Ошибка при поиске: %s", e)
             return []
+
+    def search(self, query: str, max_results: int = 5) -> list[str]:
+        """
+        Выполняет поиск информации в интернете.
+
+        :param query: Строка запроса.
+        :param max_results: Количество результатов (по умолчанию 5).
+        :return: Список URL с найденными источниками.
+        """
+        return [result["url"] for result in self.search_results(query, max_results)]
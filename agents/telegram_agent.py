@@ -1,41 +1,40 @@
-import os
 import logging
 import telebot
-from dotenv import load_dotenv
+from config.settings import get_settings
+from utils.logger import setup_logging
+from utils.delivery import deliver
+from utils.accounting import register_stats_command
 
-load_dotenv()
-
-# Настраиваем логирование
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Глобальный бот для обработки команд
-bot = telebot.TeleBot(os.getenv("TELEGRAM_BOT_TOKEN"))
+bot = telebot.TeleBot(get_settings().telegram_bot_token)
 
 
 class TelegramAgent:
     """Агент для отправки сообщений в Telegram через бота."""
 
     def __init__(self) -> None:
-        self.token = os.getenv("TELEGRAM_BOT_TOKEN")
-        self.chat_id = os.getenv("TELEGRAM_CHAT_ID")
+        settings = get_settings()
+        self.token = settings.telegram_bot_token
+        self.chat_id = settings.telegram_chat_id
         self.bot = bot  # Используем глобальный экземпляр бота
 
-    async def send_message(self, message: str) -> str:
+    def send_message(self, message: str) -> str:
         """
         Отправляет сообщение в Telegram.
 
         :param message: Текст сообщения
         :return: Статус отправки
+        :raises Exception: Сообщение не отправлено (шаг задачи повторится)
         """
         try:
-            self.bot.send_message(chat_id=self.chat_id, text=message)
-            logger.info(f"✅ Сообщение отправлено: {message}")
-            return "успешно отправлено"
+            deliver(self.bot, self.chat_id, message)
         except Exception as e:
-            error_msg = f"❌ Ошибка отправки сообщения: {e}"
-            logger.error(error_msg)
-            return error_msg
+            logger.error("❌ Ошибка отправки сообщения: %s", e)
+            raise
+        logger.info("✅ Сообщение отправлено: %s", message)
+        return "успешно отправлено"
 
 
 # Обработчики команд перемещены на уровень модуля
@@ -51,10 +50,15 @@ def help_command(message):
         "📜 Доступные команды:\n"
         "/start - Запуск бота\n"
         "/help - Список команд\n"
+        "/stats - Расход токенов по пользователям (для администраторов)\n"
         "/echo <текст> - Повторить ваше сообщение"
     )
 
 
+register_stats_command(bot)
+
+
 if __name__ == "__main__":
+    setup_logging()
     logger.info("🚀 Бот запущен и ожидает команды...")
     bot.polling(none_stop=True)
@@ -1,31 +1,233 @@
-import os
+import re
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Optional
 import tweepy
-from dotenv import load_dotenv
+from config.settings import get_settings
 
-load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Максимальная длина твита
+TWEET_LIMIT = 280
+
+
+def split_into_thread(text: str, limit: int = TWEET_LIMIT) -> list[str]:
+    """
+    Разбивает длинный текст на твиты для треда.
+
+    Режет по абзацам, затем по предложениям, затем по словам;
+    при нескольких частях добавляет нумерацию вида " 2/5".
+
+    :param text: Исходный текст
+    :param limit: Максимальная длина одного твита
+    :return: Список твитов
+    """
+    text = text.strip()
+    if len(text) <= limit:
+        return [text] if text else []
+
+    # Резерв под суффикс нумерации " 99/99"
+    body_limit = limit - 6
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        for sentence in re.split(r"(?<=[.!?…])\s+", paragraph.strip()):
+            while len(sentence) > body_limit:
+                cut = sentence.rfind(" ", 0, body_limit)
+                cut = cut if cut > 0 else body_limit
+                pieces.append(sentence[:cut])
+                sentence = sentence[cut:].lstrip()
+            if sentence:
+                pieces.append(sentence)
+
+    parts, current = [], ""
+    for piece in pieces:
+        candidate = f"{current} {piece}" if current else piece
+        if len(candidate) <= body_limit:
+            current = candidate
+        else:
+            parts.append(current)
+            current = piece
+    if current:
+        parts.append(current)
+
+    total = len(parts)
+    return [f"{part} {idx}/{total}" for idx, part in enumerate(parts, 1)]
+
+
+class PostQueue:
+    """
+    Фоновая очередь публикаций с учётом окна лимита.
+
+    Треды публикуются по одному в отдельном потоке; перед каждым твитом
+    очередь ждёт, пока в скользящем окне освободится место. Вызывающий
+    получает Future и не блокируется. Лимит по умолчанию — из настроек
+    twitter_posts_per_window и twitter_window_seconds.
+    """
+
+    def __init__(self, max_posts: Optional[int] = None,
+                 window: Optional[float] = None) -> None:
+        self._max_posts = max_posts
+        self._window = window
+        self._posted: deque[float] = deque()
+        self._queue: queue.Queue = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def max_posts(self) -> int:
+        return self._max_posts if self._max_posts is not None else get_settings().twitter_posts_per_window
+
+    @property
+    def window(self) -> float:
+        return self._window if self._window is not None else get_settings().twitter_window_seconds
+
+    def submit(self, client: tweepy.Client, tweets: list[str]) -> Future:
+        """
+        Ставит тред в очередь.
+
+        :param client: Клиент Twitter API v2
+        :param tweets: Твиты треда по порядку
+        :return: Future с отчётом публикации (см. _post_thread)
+        """
+        future: Future = Future()
+        self._queue.put((client, tweets, future, time.monotonic()))
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name="twitter-post-queue", daemon=True)
+                self._worker.start()
+        return future
+
+    def pending(self) -> int:
+        """Количество тредов, ожидающих публикации."""
+        return self._queue.qsize()
+
+    def _run(self) -> None:
+        while True:
+            client, tweets, future, queued_at = self._queue.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self._post_thread(client, tweets, queued_at))
+                except Exception as e:
+                    future.set_exception(e)
+            self._queue.task_done()
+
+    def _post_thread(self, client: tweepy.Client, tweets: list[str],
+                     queued_at: float) -> dict:
+        started_at = time.monotonic()
+        tweet_ids: list[str] = []
+        error = None
+
+        for text in tweets:
+            self._wait_for_slot()
+            try:
+                response = client.create_tweet(
+                    text=text, in_reply_to_tweet_id=tweet_ids[-1] if tweet_ids else None)
+            except tweepy.TooManyRequests as e:
+                # Окно на стороне API закончилось раньше нашего — ждём сброса и повторяем
+                delay = max((e.reset_time or 0) - time.time(), 0) + 1
+                logger.warning("⏳ Лимит Twitter, повтор через %.0f с", delay)
+                time.sleep(delay)
+                try:
+                    response = client.create_tweet(
+                        text=text,
+                        in_reply_to_tweet_id=tweet_ids[-1] if tweet_ids else None)
+                except Exception as retry_error:
+                    error = str(retry_error)
+                    break
+            except Exception as e:
+                error = str(e)
+                break
+            self._posted.append(time.monotonic())
+            tweet_ids.append(str(response.data["id"]))
+
+        finished_at = time.monotonic()
+        if error:
+            logger.error("❌ Ошибка при публикации треда: %s", error)
+        else:
+            logger.info("✅ Опубликован тред из %s твитов", len(tweet_ids))
+        return {
+            "tweet_ids": tweet_ids,
+            "error": error,
+            "queue_seconds": round(started_at - queued_at, 3),
+            "post_seconds": round(finished_at - started_at, 3),
+        }
+
+    def _wait_for_slot(self) -> None:
+        while True:
+            now = time.monotonic()
+            while self._posted and now - self._posted[0] >= self.window:
+                self._posted.popleft()
+            if len(self._posted) < self.max_posts:
+                return
+            delay = self.window - (now - self._posted[0])
+            logger.info("⏳ Окно публикаций заполнено, ждём %.0f с", delay)
+            time.sleep(delay)
+
+
+# Клиенты v2 переиспользуются: у каждого своя HTTP-сессия с пулом соединений
+_clients: dict[tuple, tweepy.Client] = {}
+_clients_lock = threading.Lock()
+post_queue = PostQueue()
 
 
 class TwitterAgent:
-    """Агент для работы с Twitter API. Позволяет публиковать твиты."""
+    """Агент для работы с Twitter API v2. Публикует твиты и треды."""
 
     def __init__(self) -> None:
-        self.api_key = os.getenv("TWITTER_API_KEY")
-        self.api_secret = os.getenv("TWITTER_API_SECRET")
-        self.access_token = os.getenv("TWITTER_ACCESS_TOKEN")
-        self.access_secret = os.getenv("TWITTER_ACCESS_SECRET")
+        settings = get_settings()
+        self.api_key = settings.twitter_api_key
+        self.api_secret = settings.twitter_api_secret
+        self.access_token = settings.twitter_access_token
+        self.access_secret = settings.twitter_access_secret
 
-        self.auth = tweepy.OAuthHandler(self.api_key, self.api_secret)
-        self.auth.set_access_token(self.access_token, self.access_secret)
-        self.api = tweepy.API(self.auth)
+        credentials = (self.api_key, self.api_secret,
+                       self.access_token, self.access_secret)
+        with _clients_lock:
+            if credentials not in _clients:
+                _clients[credentials] = tweepy.Client(
+                    consumer_key=self.api_key,
+                    consumer_secret=self.api_secret,
+                    access_token=self.access_token,
+                    access_token_secret=self.access_secret,
+                )
+            self.client = _clients[credentials]
 
-    def post_tweet(self, message: str) -> None:
+    def post_tweet(self, message: str) -> Optional[str]:
         """
         Публикует твит.
 
         :param message: Текст твита
+        :return: ID твита или None при ошибке
         """
         try:
-            self.api.update_status(message)
-            print(f"✅ Твит опубликован: {message}")
+            response = self.client.create_tweet(text=message)
+            tweet_id = str(response.data["id"])
+            logger.info("✅ Твит опубликован: %s", tweet_id)
+            return tweet_id
         except Exception as e:
-            print(f"❌ Ошибка при публикации твита: {e}")
+            logger.error("❌ Ошибка при публикации твита: %s", e)
+            return None
+
+    def submit_thread(self, text: str) -> Future:
+        """
+        Ставит текст в очередь на публикацию тредом, не блокируя вызывающего.
+
+        :param text: Текст любой длины
+        :return: Future с отчётом: tweet_ids, error, queue_seconds, post_seconds
+        """
+        return post_queue.submit(self.client, split_into_thread(text))
+
+    def post_thread(self, text: str, timeout: Optional[float] = None) -> dict:
+        """
+        Публикует текст тредом и ждёт результата.
+
+        :param text: Текст любой длины
+        :param timeout: Сколько ждать публикации (None — без ограничения)
+        :return: Отчёт публикации
+        """
+        return self.submit_thread(text).result(timeout=timeout)
@@ -0,0 +1,342 @@
+import re
+import math
+import time
+import hashlib
+import logging
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from html.parser import HTMLParser
+from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+from config.settings import get_settings
+from utils.deadline import stage_timeout
+
+logger = logging.getLogger(__name__)
+
+# Абзацы короче этого — меню, подписи, кнопки
+_MIN_PARAGRAPH_CHARS = 40
+# Грубый стемминг: для русского достаточно сравнивать начала слов
+_STEM_LENGTH = 6
+
+_SKIP_TAGS = {"script", "style", "noscript", "svg", "nav", "header",
+              "footer", "form", "aside", "button", "iframe"}
+_BLOCK_TAGS = {"p", "div", "li", "pre", "blockquote", "article", "section",
+               "h1", "h2", "h3", "h4", "h5", "h6", "td", "th", "tr", "br", "dd", "dt"}
+
+
+class _TextExtractor(HTMLParser):
+    """Извлекает из HTML заголовок и текстовые блоки без служебной разметки."""
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.title = ""
+        self.paragraphs: list[str] = []
+        self._buffer: list[str] = []
+        self._skip_depth = 0
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == "title":
+            self._in_title = True
+        elif tag in _BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self._skip_depth = max(self._skip_depth - 1, 0)
+        elif tag == "title":
+            self._in_title = False
+        elif tag in _BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif not self._skip_depth:
+            self._buffer.append(data)
+
+    def close(self):
+        super().close()
+        self._flush()
+
+    def _flush(self):
+        text = " ".join("".join(self._buffer).split())
+        if len(text) >= _MIN_PARAGRAPH_CHARS:
+            self.paragraphs.append(text)
+        self._buffer = []
+
+
+class ContentCache:
+    """
+    LRU-кеш извлечённого текста страниц с ограничением по времени жизни.
+
+    Размер и время жизни по умолчанию берутся из текущих настроек,
+    поэтому меняются при их перезагрузке.
+    """
+
+    def __init__(self, maxsize: Optional[int] = None, ttl: Optional[float] = None) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def maxsize(self) -> int:
+        return self._maxsize if self._maxsize is not None else get_settings().retrieval_cache_size
+
+    @property
+    def ttl(self) -> float:
+        return self._ttl if self._ttl is not None else get_settings().retrieval_cache_ttl
+
+    def get(self, url: str) -> Optional[dict]:
+        with self._lock:
+            item = self._data.get(url)
+            if item is None:
+                return None
+            stored_at, page = item
+            if time.monotonic() - stored_at > self.ttl:
+                del self._data[url]
+                return None
+            self._data.move_to_end(url)
+            return page
+
+    def put(self, url: str, page: dict) -> None:
+        maxsize = self.maxsize
+        with self._lock:
+            self._data[url] = (time.monotonic(), page)
+            self._data.move_to_end(url)
+            while len(self._data) > maxsize:
+                self._data.popitem(last=False)
+
+
+def _tokens(text: str) -> list[str]:
+    return [word[:_STEM_LENGTH] for word in re.findall(r"\w{2,}", text.lower())]
+
+
+def _detect_encoding(content_type: str, body: bytes) -> str:
+    """Кодировка из заголовка или <meta charset>, иначе UTF-8."""
+    match = (re.search(r"charset=[\"']?([\w-]+)", content_type, re.I)
+             or re.search(rb"<meta[^>]+charset=[\"']?([\w-]+)", body[:4096], re.I))
+    if match:
+        encoding = match.group(1)
+        encoding = encoding.decode("ascii") if isinstance(encoding, bytes) else encoding
+        try:
+            "".encode(encoding)
+            return encoding
+        except LookupError:
+            pass
+    return "utf-8"
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценка числа токенов без токенизатора (≈4 символа на токен)."""
+    return len(text) // 4 + 1
+
+
+# Сессия с пулом соединений и пул потоков общие для всех запросов;
+# пересоздаются, если в настройках изменился размер пула
+_session: Optional[requests.Session] = None
+_executor: Optional[ThreadPoolExecutor] = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+content_cache = ContentCache()
+
+
+def _get_pool() -> tuple[requests.Session, ThreadPoolExecutor]:
+    global _session, _executor, _pool_size
+    workers = get_settings().retrieval_fetch_workers
+    with _pool_lock:
+        if workers != _pool_size:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+            _session.headers["User-Agent"] = "Mozilla/5.0 (compatible; aiastra-agent)"
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="web-fetch")
+            _pool_size = workers
+        return _session, _executor
+
+
+class WebRetriever:
+    """
+    Извлечение контекста из результатов поиска.
+
+    Страницы скачиваются параллельно (задержка ограничена самой медленной
+    из них и retrieval_fetch_timeout), из них извлекается текст, повторы удаляются,
+    текст режется на фрагменты и ранжируется по BM25 относительно задачи.
+    В контекст LLM попадают только лучшие фрагменты в пределах бюджета токенов.
+    """
+
+    def __init__(self, token_budget: Optional[int] = None,
+                 max_passages: Optional[int] = None) -> None:
+        settings = get_settings()
+        self.token_budget = (settings.retrieval_token_budget if token_budget is None
+                             else token_budget)
+        self.max_passages = (settings.retrieval_max_passages if max_passages is None
+                             else max_passages)
+
+    def retrieve(self, query: str, results: list[dict]) -> list[dict]:
+        """
+        Возвращает лучшие фрагменты для запроса.
+
+        :param query: Текст задачи
+        :param results: Результаты Tavily (url, title, content)
+        :return: Список фрагментов: url, title, text, score
+        """
+        pages = self.fetch_all(results)
+        chunks = self._chunk(self._dedupe(pages))
+        ranked = self._rank(query, chunks)
+
+        selected, used = [], 0
+        for chunk in ranked:
+            cost = estimate_tokens(chunk["text"])
+            if used + cost > self.token_budget:
+                continue
+            selected.append(chunk)
+            used += cost
+            if len(selected) >= self.max_passages:
+                break
+
+        logger.info("📚 Отобрано %s фрагментов (~%s токенов) из %s страниц",
+                    len(selected), used, len(pages))
+        return selected
+
+    def fetch_all(self, results: list[dict]) -> list[dict]:
+        """
+        Параллельно скачивает страницы, используя кеш по URL.
+
+        Если страницу не удалось скачать, используется сниппет Tavily.
+
+        :param results: Результаты поиска
+        :return: Страницы: url, title, paragraphs
+        """
+        session, executor = _get_pool()
+        timeout = stage_timeout("search", get_settings().retrieval_fetch_timeout)
+        pages, futures = [], {}
+        for result in results:
+            url = result.get("url")
+            if not url:
+                continue
+            cached = content_cache.get(url)
+            if cached is not None:
+                pages.append(cached)
+            else:
+                futures[executor.submit(self._fetch, session, url, timeout)] = result
+
+        done, not_done = wait(futures, timeout=timeout)
+        for future, result in futures.items():
+            page = None
+            if future in done and future.exception() is None:
+                page = future.result()
+            else:
+                future.cancel()
+            if page and page["paragraphs"]:
+                page["title"] = page["title"] or result.get("title", "")
+                content_cache.put(result["url"], page)
+            else:
+                page = {
+                    "url": result["url"],
+                    "title": result.get("title", ""),
+                    "paragraphs": [result["content"]] if result.get("content") else [],
+                }
+            pages.append(page)
+
+        if not_done:
+            logger.warning("⏱️ %s страниц не успели загрузиться", len(not_done))
+        return pages
+
+    @staticmethod
+    def _fetch(session: requests.Session, url: str, timeout: float) -> Optional[dict]:
+        max_bytes = get_settings().retrieval_max_page_bytes
+        with session.get(url, timeout=(3, timeout), stream=True) as response:
+            response.raise_for_status()
+            if "html" not in response.headers.get("Content-Type", "html"):
+                return None
+            body = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                body.extend(chunk)
+                if len(body) >= max_bytes:
+                    break
+            encoding = _detect_encoding(response.headers.get("Content-Type", ""), body)
+
+        extractor = _TextExtractor()
+        extractor.feed(body.decode(encoding, errors="replace"))
+        extractor.close()
+        return {"url": url, "title": extractor.title.strip(),
+                "paragraphs": extractor.paragraphs}
+
+    @staticmethod
+    def _dedupe(pages: list[dict]) -> list[dict]:
+        seen, deduped = set(), []
+        for page in pages:
+            unique = []
+            for paragraph in page["paragraphs"]:
+                key = hashlib.md5(" ".join(_tokens(paragraph)).encode("utf-8")).digest()
+                if key not in seen:
+                    seen.add(key)
+                    unique.append(paragraph)
+            # Копия: страницы из кеша не меняем
+            deduped.append({**page, "paragraphs": unique})
+        return deduped
+
+    @staticmethod
+    def _chunk(pages: list[dict]) -> list[dict]:
+        chunk_words = get_settings().retrieval_chunk_words
+        chunks = []
+        for page in pages:
+            current, words = [], 0
+            for paragraph in page["paragraphs"]:
+                size = len(paragraph.split())
+                if current and words + size > chunk_words:
+                    chunks.append({"url": page["url"], "title": page["title"],
+                                   "text": "\n".join(current)})
+                    current, words = [], 0
+                current.append(paragraph)
+                words += size
+            if current:
+                chunks.append({"url": page["url"], "title": page["title"],
+                               "text": "\n".join(current)})
+        return chunks
+
+    @staticmethod
+    def _rank(query: str, chunks: list[dict], k1: float = 1.5,
+              b: float = 0.75) -> list[dict]:
+        """Ранжирует фрагменты по BM25."""
+        query_terms = set(_tokens(query))
+        if not chunks or not query_terms:
+            return chunks
+
+        docs = [Counter(_tokens(chunk["text"])) for chunk in chunks]
+        avg_len = sum(sum(doc.values()) for doc in docs) / len(docs) or 1
+        doc_freq = Counter(term for doc in docs for term in query_terms if term in doc)
+
+        for chunk, doc in zip(chunks, docs):
+            length = sum(doc.values())
+            score = 0.0
+            for term in query_terms:
+                tf = doc.get(term)
+                if not tf:
+                    continue
+                idf = math.log(1 + (len(docs) - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+                score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avg_len))
+            chunk["score"] = round(score, 4)
+
+        return sorted(chunks, key=lambda chunk: chunk["score"], reverse=True)
+
+
+def format_context(passages: list[dict]) -> str:
+    """
+    Форматирует фрагменты для промпта.
+
+    :param passages: Фрагменты из WebRetriever.retrieve
+    :return: Текст с нумерованными источниками
+    """
+    return "\n\n".join(
+        f"{idx}. [{passage['title']}]({passage['url']}):\n{passage['text']}"
+        for idx, passage in enumerate(passages, 1))
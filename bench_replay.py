@@ -0,0 +1,213 @@
+"""
+Прогон записанной сессии без сети: пропускная способность и задержки.
+
+Кассету пишет utils.recorder (RECORDER_MODE=record). Здесь она
+воспроизводится: все внешние вызовы — LLM, Tavily, GitHub, Telegram,
+страницы поиска — отвечают из кассеты через записанное время
+(умноженное на --speed), поэтому разница между прогонами до и после
+изменения кода — это разница самого кода.
+
+Входящие сообщения берутся из записанных ответов getUpdates (или из
+--tasks, JSONL как evals/routing_tasks.jsonl) и прогоняются через
+выбранные цели: граф main.agent_graph, цепочку build_agent_chain
+и обработчики agent_claude, openroute_troll, trololo. Печатается
+пропускная способность, задержка p50/p95/max, ошибки и сколько
+вызовов нашлось в кассете точно, приблизительно и не нашлось.
+
+    python bench_replay.py cassette.jsonl.gz
+    python bench_replay.py cassette.jsonl.gz --target graph --target trololo --speed 0
+    python bench_replay.py cassette.jsonl.gz --paced --speed 0.5 --concurrency 8
+    python bench_replay.py cassette.jsonl.gz --tasks evals/routing_tasks.jsonl --output bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import statistics
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+TARGETS = ("graph", "chain", "agent_claude", "openroute_troll", "trololo")
+
+
+def configure_environment(args, workdir: str) -> None:
+    """Воспроизведение и временные файлы — до импорта модулей приложения."""
+    os.environ.update({
+        "RECORDER_MODE": "replay",
+        "RECORDER_CASSETTE": args.cassette,
+        "TASK_LEDGER_PATH": os.path.join(workdir, "task_ledger.db"),
+        "WORKFLOW_CHECKPOINT_PATH": os.path.join(workdir, "workflow_checkpoints.db"),
+        "USAGE_STATS_DIR": os.path.join(workdir, "usage_stats"),
+    })
+    if args.speed is not None:
+        os.environ["RECORDER_SPEED"] = str(args.speed)
+    # Ключи не участвуют в подборе ответов и в сеть не уходят
+    for name, value in (("TELEGRAM_BOT_TOKEN", "1:replay"), ("OPENAI_API_KEY", "replay"),
+                        ("TAVILY_API_KEY", "replay"), ("GITHUB_TOKEN", "replay")):
+        os.environ.setdefault(name, value)
+
+
+def recorded_messages(entries: list[dict]) -> list[dict]:
+    """Входящие сообщения из записанных ответов getUpdates, по времени прихода."""
+    messages, seen = [], set()
+    for entry in entries:
+        if not entry["route"].endswith("/getUpdates") or entry["error"]:
+            continue
+        updates = json.loads(entry["content"]).get("result")
+        for update in updates if isinstance(updates, list) else []:
+            message = update.get("message")
+            if update["update_id"] in seen or not message or not message.get("text"):
+                continue
+            seen.add(update["update_id"])
+            messages.append({"at": entry["at"] + entry["seconds"], "message": message})
+    return messages
+
+
+def task_messages(path: str) -> list[dict]:
+    """Сообщения из файла задач: {"task": ...} на строку."""
+    with open(path, encoding="utf-8") as file:
+        tasks = [json.loads(line)["task"] for line in file if line.strip()]
+    return [{"at": 0.0, "message": {
+        "message_id": idx, "date": 0, "text": task,
+        "chat": {"id": 1, "type": "private"},
+        "from": {"id": 1, "is_bot": False, "first_name": "bench"}}}
+        for idx, task in enumerate(tasks, 1)]
+
+
+def runner(target: str):
+    """Функция, обрабатывающая одно сообщение telebot.types.Message."""
+    from utils.accounting import usage_scope
+    from utils.deadline import request_deadline
+
+    if target in ("graph", "chain"):
+        import main
+        from agents.langchain_agent import build_agent_chain
+        chain = build_agent_chain()
+
+        def run(message):
+            task = message.text.replace("/task", "").strip()
+            with usage_scope(message.from_user.id, message.chat.id, "bench"), \
+                    request_deadline():
+                if target == "chain":
+                    return chain.invoke(task)
+                return main.process_task(task, None, f"{message.chat.id}:{message.from_user.id}")
+        return run
+
+    module = __import__(target)
+    return module.handle_message
+
+
+def bench(target: str, messages: list[dict], args) -> dict:
+    """Прогоняет сообщения через цель и собирает задержки."""
+    from telebot.types import Message
+    from utils.recorder import recorder
+
+    handle = runner(target)
+    latencies, errors = [], Counter()
+    lock = threading.Lock()
+    metrics_before = dict(recorder.metrics)
+
+    def process(raw: dict) -> None:
+        started_at = time.perf_counter()
+        error = None
+        try:
+            handle(Message.de_json(raw))
+        except Exception as e:
+            error = f"{type(e).__name__}: {str(e)[:80]}"
+        with lock:
+            latencies.append(time.perf_counter() - started_at)
+            if error:
+                errors[error] += 1
+
+    first_at = messages[0]["at"] if messages else 0.0
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for _ in range(args.repeat):
+            for item in messages:
+                if args.paced:
+                    # Сообщения приходят с записанными интервалами (с учётом --speed)
+                    due = (item["at"] - first_at) * recorder.speed
+                    delay = due - (time.perf_counter() - started_at)
+                    if delay > 0:
+                        time.sleep(delay)
+                executor.submit(process, item["message"])
+    elapsed = time.perf_counter() - started_at
+
+    ordered = sorted(latencies)
+    return {
+        "target": target,
+        "requests": len(latencies),
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_p50": statistics.median(ordered) if ordered else 0.0,
+        "latency_p95": ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] if ordered else 0.0,
+        "latency_max": ordered[-1] if ordered else 0.0,
+        "errors": dict(errors),
+        "calls": {name: recorder.metrics[name] - metrics_before.get(name, 0)
+                  for name in ("replayed", "fuzzy", "misses")},
+    }
+
+
+def print_report(reports: list[dict]) -> None:
+    header = (f"{'цель':<18}{'запросов':>9}{'в с':>8}{'p50, с':>9}{'p95, с':>9}"
+              f"{'max, с':>9}{'ошибок':>8}{'точно':>8}{'прибл.':>8}{'нет':>6}")
+    print(header)
+    print("-" * len(header))
+    for report in reports:
+        calls = report["calls"]
+        print(f"{report['target']:<18}{report['requests']:>9}{report['throughput']:>8.2f}"
+              f"{report['latency_p50']:>9.3f}{report['latency_p95']:>9.3f}"
+              f"{report['latency_max']:>9.3f}{sum(report['errors'].values()):>8}"
+              f"{calls['replayed']:>8}{calls['fuzzy']:>8}{calls['misses']:>6}")
+    for report in reports:
+        for error, count in report["errors"].items():
+            print(f"  {report['target']}: {count} × {error}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("cassette", help="кассета utils.recorder (gzip JSONL)")
+    parser.add_argument("--target", action="append", choices=TARGETS,
+                        help="что прогонять (можно несколько раз); по умолчанию graph")
+    parser.add_argument("--tasks", help="JSONL с задачами вместо записанных сообщений")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="множитель записанных задержек (0 — без пауз); "
+                             "по умолчанию RECORDER_SPEED")
+    parser.add_argument("--paced", action="store_true",
+                        help="подавать сообщения с записанными интервалами")
+    parser.add_argument("--concurrency", type=int, default=1, help="параллельных обработчиков")
+    parser.add_argument("--repeat", type=int, default=1, help="повторов всего набора")
+    parser.add_argument("--output", help="JSON-файл с результатами")
+    args = parser.parse_args()
+
+    # Журнал задач и чекпоинты прогона удаляются вместе с каталогом
+    with tempfile.TemporaryDirectory(
+            prefix="bench-replay-", ignore_cleanup_errors=True) as workdir:
+        configure_environment(args, workdir)
+        from utils.logger import setup_logging
+        from utils.recorder import recorder
+        setup_logging()
+        recorder.install()
+
+        messages = (task_messages(args.tasks) if args.tasks
+                    else recorded_messages(recorder.entries))
+        if not messages:
+            sys.exit("❌ В кассете нет входящих сообщений (getUpdates); укажите --tasks")
+        print(f"⏳ {len(messages)} сообщений, скорость ×{recorder.speed:g}", file=sys.stderr)
+
+        reports = [bench(target, messages, args) for target in args.target or ["graph"]]
+        # Иначе запись статистики при выходе (atexit) создаст каталог заново
+        from utils.accounting import accountant
+        accountant.flush()
+    print_report(reports)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(reports, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""
+Единые настройки приложения.
+
+Настройки читаются один раз: значения по умолчанию, затем профиль
+развёртывания (APP_PROFILE), затем .env и переменные окружения.
+Результат проверяется и кешируется — модули берут его через
+get_settings() без повторного разбора окружения.
+
+По сигналу SIGHUP (см. install_reload_handler) настройки перечитываются
+без перезапуска: .env читается заново, подписчики on_reload получают
+новый объект. Если новые значения некорректны, остаются прежние.
+"""
+
+import os
+import signal
+import logging
+import threading
+from dataclasses import dataclass, field, fields
+from typing import Callable, Optional
+from dotenv import dotenv_values, find_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Адрес API для ChatDeepSeek, если OPENAI_API_BASE_URL не задан
+DEEPSEEK_API_BASE = "https://api.deepseek.com/v1"
+
+
+@dataclass(frozen=True)
+class Settings:
+    app_profile: str = "default"
+
+    # Ключи и адреса API
+    openai_api_key: str = field(default="", repr=False)
+    # Пусто — адрес клиента по умолчанию: OpenAI для openai.OpenAI,
+    # DEEPSEEK_API_BASE для ChatDeepSeek
+    openai_api_base_url: str = ""
+    openai_api_model: str = "deepseek-chat"
+
+    # Модели по стадиям (пустое имя — openai_api_model, max_tokens 0 — без
+    # ограничения). Выбор инструментов — короткая классификация: быстрая
+    # модель, детерминированно и с коротким ответом; ответ — сильная модель.
+    analysis_model: str = ""
+    analysis_temperature: float = 0.0
+    analysis_max_tokens: int = 150
+    answer_model: str = ""
+    answer_temperature: float = 0.7
+    answer_max_tokens: int = 0
+
+    # Локальная маршрутизация: уверенность, с которой задача с явным
+    # упоминанием инструмента обходится без LLM (больше 1 — всегда через
+    # LLM), и размыкатель провайдера — ошибок подряд и пауза, секунды
+    local_router_confidence: float = 0.9
+    provider_breaker_failures: int = 3
+    provider_breaker_cooldown: float = 30.0
+    telegram_bot_token: str = field(default="", repr=False)
+    telegram_chat_id: str = ""
+    github_token: str = field(default="", repr=False)
+    twitter_api_key: str = field(default="", repr=False)
+    twitter_api_secret: str = field(default="", repr=False)
+    twitter_access_token: str = field(default="", repr=False)
+    twitter_access_secret: str = field(default="", repr=False)
+    tavily_api_key: str = field(default="", repr=False)
+    tavily_api_base_url: str = ""  # пусто — https://api.tavily.com
+
+    # Журнал задач и состояние графа
+    task_ledger_path: str = "task_ledger.db"
+    task_ledger_dedupe_window: float = 3600.0
+    workflow_checkpoint_path: str = "workflow_checkpoints.db"  # пусто — в памяти
+
+    # GitHub
+    github_repo_cache_ttl: float = 300.0
+
+    # Twitter
+    twitter_posts_per_window: int = 100
+    twitter_window_seconds: float = 86400.0
+    twitter_submit_wait: float = 5.0
+
+    # Загрузка и ранжирование страниц поиска
+    retrieval_fetch_workers: int = 8
+    retrieval_fetch_timeout: float = 6.0
+    retrieval_max_page_bytes: int = 2 * 1024 * 1024
+    retrieval_cache_size: int = 256
+    retrieval_cache_ttl: float = 3600.0
+    retrieval_token_budget: int = 1500
+    retrieval_max_passages: int = 6
+    retrieval_chunk_words: int = 120
+
+    # Упреждающий поиск: Tavily запускается параллельно с анализом задачи,
+    # если локальный маршрутизатор оценивает нужность поиска не ниже
+    # min_probability; не больше per_minute упреждающих запросов в минуту.
+    # Результаты поиска кешируются по тексту запроса.
+    search_prefetch: bool = False
+    search_prefetch_min_probability: float = 0.2
+    search_prefetch_per_minute: int = 30
+    search_cache_size: int = 128
+    search_cache_ttl: float = 600.0
+
+    # Доставка ответов в Telegram: длиннее порога — файлом, повторы при 429
+    delivery_document_threshold: int = 12000
+    delivery_max_retries: int = 3
+
+    # Сессии диалога по пользователю/чату: не больше max_sessions в памяти,
+    # простаивающие дольше idle_ttl удаляются, в сессии — max_turns обменов
+    session_max_sessions: int = 1000
+    session_idle_ttl: float = 3600.0
+    session_max_turns: int = 10
+
+    # Дедлайн запроса (SLO) и бюджеты стадий, с (см. utils.deadline)
+    request_deadline: float = 60.0
+    deadline_analysis: float = 10.0
+    deadline_search: float = 15.0
+    deadline_tools: float = 20.0
+    deadline_answer: float = 40.0
+
+    # Таймауты и повторы клиентов внешних API
+    llm_timeout: float = 30.0
+    llm_max_retries: int = 1
+    search_timeout: float = 10.0
+    github_timeout: float = 15.0
+    github_max_retries: int = 3  # повторы RateLimitScheduler (PyGithub не повторяет)
+    telegram_timeout: float = 15.0
+
+    # Запись и воспроизведение внешних вызовов (см. utils.recorder):
+    # режим record/replay (пусто — выключено), файл кассеты (для записи
+    # пусто — свой файл у каждого процесса: cassette-<скрипт>-<pid>.jsonl.gz)
+    # и скорость воспроизведения (1 — как записано, 0.5 — вдвое быстрее, 0 — без пауз)
+    recorder_mode: str = ""
+    recorder_cassette: str = ""
+    recorder_speed: float = 1.0
+
+    # Логирование: формат json/text, общий уровень и уровни модулей
+    # ("agents.github_agent=DEBUG,httpx=WARNING"), предел длины аргументов
+    log_format: str = "json"
+    log_level: str = "INFO"
+    log_levels: str = ""
+    log_max_chars: int = 500
+
+    # Учёт токенов: каталог и период сброса статистики, дневной бюджет
+    # на пользователя (0 — без ограничения), доля бюджета, после которой
+    # запросы идут на дешёвую модель, и администраторы (/stats, без лимита)
+    usage_stats_dir: str = "usage_stats"
+    usage_flush_interval: float = 60.0
+    usage_daily_token_budget: int = 0
+    usage_downgrade_ratio: float = 0.8
+    usage_cheap_model: str = ""
+    admin_user_ids: str = ""
+
+
+# Профили развёртывания: размеры пулов, таймауты, кеши и конкурентность.
+# Порядок: значения по умолчанию < профиль < .env < окружение процесса.
+PROFILES: dict[str, dict] = {
+    "default": {},
+    "dev": {
+        "retrieval_fetch_workers": 4,
+        "retrieval_fetch_timeout": 10.0,
+        "retrieval_cache_size": 64,
+        "twitter_submit_wait": 10.0,
+    },
+    "prod": {
+        "retrieval_fetch_workers": 16,
+        "retrieval_fetch_timeout": 5.0,
+        "retrieval_cache_size": 1024,
+        "twitter_submit_wait": 3.0,
+        "request_deadline": 30.0,
+        "llm_timeout": 20.0,
+    },
+    "low-memory": {
+        "retrieval_fetch_workers": 2,
+        "retrieval_max_page_bytes": 512 * 1024,
+        "retrieval_cache_size": 32,
+        "retrieval_token_budget": 1000,
+    },
+}
+
+# Числовые настройки, для которых 0 означает «без ограничения»
+_ZERO_ALLOWED = {
+    "usage_daily_token_budget", "analysis_temperature", "analysis_max_tokens",
+    "answer_temperature", "answer_max_tokens", "llm_max_retries", "github_max_retries",
+    "recorder_speed",
+}
+
+_BOOL_VALUES = {"1": True, "true": True, "yes": True, "on": True,
+                "0": False, "false": False, "no": False, "off": False, "": False}
+
+# Окружение процесса до чтения .env: при перезагрузке имеет приоритет над файлом
+_process_env = dict(os.environ)
+
+_settings: Optional[Settings] = None
+_lock = threading.Lock()
+_subscribers: list[Callable[[Settings], None]] = []
+
+
+def load_settings(env: Optional[dict] = None) -> Settings:
+    """
+    Собирает и проверяет настройки.
+
+    :param env: Переменные окружения (по умолчанию .env + окружение процесса)
+    :return: Объект настроек
+    :raises ValueError: Неизвестный профиль или некорректные значения
+    """
+    if env is None:
+        env_file = _process_env.get("ENV_FILE") or find_dotenv(usecwd=True)
+        file_env = dotenv_values(env_file) if env_file else {}
+        env = {**{k: v for k, v in file_env.items() if v is not None}, **_process_env}
+
+    profile = env.get("APP_PROFILE", "default")
+    if profile not in PROFILES:
+        raise ValueError(f"❌ Неизвестный профиль настроек: {profile}")
+
+    values = {"app_profile": profile, **PROFILES[profile]}
+    errors = []
+    for item in fields(Settings):
+        raw = env.get(item.name.upper())
+        if raw is None or item.name == "app_profile":
+            continue
+        try:
+            if item.type is bool:
+                if raw.strip().lower() not in _BOOL_VALUES:
+                    raise ValueError(raw)
+                values[item.name] = _BOOL_VALUES[raw.strip().lower()]
+            else:
+                values[item.name] = item.type(raw) if item.type is not str else raw
+        except ValueError:
+            errors.append(f"{item.name.upper()}={raw!r}: ожидается {item.type.__name__}")
+
+    settings = Settings(**values)
+    for item in fields(Settings):
+        value = getattr(settings, item.name)
+        if item.type in (int, float) and item.name in _ZERO_ALLOWED and value < 0:
+            errors.append(f"{item.name.upper()}={value}: не может быть отрицательным")
+        elif item.type in (int, float) and item.name not in _ZERO_ALLOWED and value <= 0:
+            errors.append(f"{item.name.upper()}={value}: должно быть больше нуля")
+    if settings.usage_downgrade_ratio > 1:
+        errors.append(f"USAGE_DOWNGRADE_RATIO={settings.usage_downgrade_ratio}: "
+                      "ожидается доля от 0 до 1")
+    if settings.log_format not in ("json", "text"):
+        errors.append(f"LOG_FORMAT={settings.log_format!r}: ожидается json или text")
+    if settings.recorder_mode not in ("", "record", "replay"):
+        errors.append(f"RECORDER_MODE={settings.recorder_mode!r}: "
+                      "ожидается record, replay или пустое значение")
+    if settings.recorder_mode == "replay" and not settings.recorder_cassette:
+        errors.append("RECORDER_CASSETTE: для воспроизведения нужен файл кассеты")
+    if errors:
+        raise ValueError("❌ Некорректные настройки: " + "; ".join(errors))
+
+    # Переменные для сторонних библиотек, читающих окружение напрямую
+    for key, value in env.items():
+        os.environ.setdefault(key, value)
+    return settings
+
+
+def stage_params(stage: str, settings: Optional[Settings] = None) -> dict:
+    """
+    Параметры вызова модели для стадии.
+
+    :param stage: "analysis" (выбор инструментов) или "answer" (ответ пользователю)
+    :param settings: Настройки (по умолчанию текущие)
+    :return: model, temperature и max_tokens (если задан) для chat.completions
+    """
+    settings = settings or get_settings()
+    params = {
+        "model": getattr(settings, f"{stage}_model") or settings.openai_api_model,
+        "temperature": getattr(settings, f"{stage}_temperature"),
+    }
+    if getattr(settings, f"{stage}_max_tokens"):
+        params["max_tokens"] = getattr(settings, f"{stage}_max_tokens")
+    return params
+
+
+def get_settings() -> Settings:
+    """Возвращает текущие настройки (загружаются при первом обращении)."""
+    global _settings
+    if _settings is None:
+        with _lock:
+            if _settings is None:
+                _settings = load_settings()
+                logger.info("⚙️ Настройки загружены, профиль: %s", _settings.app_profile)
+    return _settings
+
+
+def reload_settings() -> Settings:
+    """
+    Перечитывает настройки и уведомляет подписчиков.
+
+    :return: Новые настройки или прежние, если новые некорректны
+    """
+    global _settings
+    try:
+        new_settings = load_settings()
+    except ValueError as e:
+        logger.error("%s — оставляем прежние настройки", e)
+        return get_settings()
+
+    with _lock:
+        _settings = new_settings
+    logger.info("🔄 Настройки перечитаны, профиль: %s", new_settings.app_profile)
+
+    for callback in list(_subscribers):
+        try:
+            callback(new_settings)
+        except Exception as e:
+            logger.error("❌ Ошибка применения настроек: %s", e)
+    return new_settings
+
+
+def on_reload(callback: Callable[[Settings], None]) -> None:
+    """Регистрирует функцию, вызываемую после перезагрузки настроек."""
+    _subscribers.append(callback)
+
+
+def install_reload_handler() -> None:
+    """Перечитывает настройки по SIGHUP (только в главном потоке, не на Windows)."""
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda sig, frame: reload_settings())
+
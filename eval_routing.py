@@ -0,0 +1,207 @@
+"""
+Оценка выбора инструментов: точность против задержки.
+
+Прогоняет размеченный набор задач (evals/routing_tasks.jsonl) через
+промпт анализа из agents.langchain_agent с разными параметрами модели
+и печатает сравнение: точное совпадение набора инструментов, средний
+Jaccard, доля ответов, которые не удалось разобрать, согласованность
+повторов, задержка p50/p95 и токены ответа. С --local в сравнение
+добавляется локальный маршрутизатор (agents.local_router) — без LLM.
+
+По умолчанию сравниваются текущие стадии analysis и answer, то есть
+маршрутизация быстрой моделью против прежней — сильной моделью:
+
+    python eval_routing.py
+    python eval_routing.py --config deepseek-chat:0:150 --config deepseek-reasoner:0.7:0
+    python eval_routing.py --repeat 3 --output routing_report.json
+    python eval_routing.py --local
+"""
+
+import sys
+import json
+import time
+import argparse
+import statistics
+from config.settings import stage_params
+from utils.logger import setup_logging
+from utils.accounting import usage_scope
+from agents.langchain_agent import analyze_prompt, llm, parse_analysis_response
+from agents.local_router import local_router
+
+KNOWN_TOOLS = {"twitter", "telegram", "github", "tavily"}
+
+
+def load_tasks(path: str) -> list[dict]:
+    """Читает размеченные задачи: {"task": ..., "tools": [...]} на строку."""
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def parse_config(spec: str) -> dict:
+    """
+    Разбирает параметры модели из строки model:temperature:max_tokens.
+
+    :param spec: Например "deepseek-chat:0:150" (max_tokens 0 — без ограничения)
+    :return: Параметры для llm.bind
+    """
+    model, temperature, max_tokens = (spec.split(":") + ["", ""])[:3]
+    params = {"model": model, "temperature": float(temperature or 0)}
+    if max_tokens and int(max_tokens):
+        params["max_tokens"] = int(max_tokens)
+    return params
+
+
+def normalize(tools) -> frozenset:
+    if not isinstance(tools, list):
+        return frozenset()
+    return frozenset(str(tool).lower() for tool in tools) & KNOWN_TOOLS
+
+
+def percentile(values: list[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)]
+
+
+def evaluate(params: dict, tasks: list[dict], repeat: int = 1) -> dict:
+    """
+    Прогоняет набор задач с одними параметрами модели.
+
+    :param params: model, temperature и, возможно, max_tokens
+    :param tasks: Размеченные задачи
+    :param repeat: Сколько раз повторять каждую задачу
+    :return: Сводные метрики и результаты по задачам
+    """
+    chain = analyze_prompt | llm.bind(**params)
+    latencies, completion_tokens, rows = [], [], []
+
+    for item in tasks:
+        expected = normalize(item["tools"])
+        predictions = []
+        for _ in range(repeat):
+            started_at = time.perf_counter()
+            try:
+                response = chain.invoke({"task_description": item["task"]})
+            except Exception as e:
+                print(f"❌ {item['task']}: {e}", file=sys.stderr)
+                predictions.append(None)
+                continue
+            latencies.append(time.perf_counter() - started_at)
+            usage = response.usage_metadata or {}
+            completion_tokens.append(usage.get("output_tokens", 0))
+            analysis = parse_analysis_response(response, item["task"])["analysis"]
+            parsed = "tools" in analysis and analysis.get("summary") != "Ошибка анализа"
+            predictions.append(normalize(analysis.get("tools")) if parsed else None)
+
+        rows.append(score(item["task"], expected, predictions))
+
+    return summarize(params, rows, latencies, completion_tokens)
+
+
+def evaluate_local(tasks: list[dict]) -> dict:
+    """
+    Прогоняет набор задач через локальный маршрутизатор.
+
+    Оцениваются инструменты, которые он действительно запустит
+    (as_analysis — и на быстром пути, и в запасном решении).
+    """
+    latencies, rows = [], []
+    for item in tasks:
+        started_at = time.perf_counter()
+        decision = local_router.route(item["task"])
+        latencies.append(time.perf_counter() - started_at)
+        rows.append(score(item["task"], normalize(item["tools"]),
+                          [normalize(decision.as_analysis()["tools"])]))
+        rows[-1]["fast"] = decision.fast
+    report = summarize({"model": "local_router", "temperature": 0}, rows, latencies, [])
+    fast = [row for row in rows if row["fast"]]
+    print(f"⚡ Без LLM решено {len(fast)} из {len(rows)} задач, верно "
+          f"{sum(row['exact'] for row in fast)}", file=sys.stderr)
+    return report
+
+
+def score(task: str, expected: frozenset, predictions: list) -> dict:
+    """Оценка одной задачи по первому предсказанию и согласованности повторов."""
+    first = predictions[0]
+    union = expected | (first or frozenset())
+    return {
+        "task": task,
+        "expected": sorted(expected),
+        "predicted": sorted(first) if first is not None else None,
+        "exact": first == expected,
+        "jaccard": len(expected & (first or frozenset())) / len(union) if union else 1.0,
+        "consistent": len(set(predictions)) == 1,
+    }
+
+
+def summarize(params: dict, rows: list[dict], latencies: list[float],
+              completion_tokens: list[int]) -> dict:
+    total = len(rows)
+    return {
+        "params": params,
+        "accuracy": sum(row["exact"] for row in rows) / total,
+        "jaccard": sum(row["jaccard"] for row in rows) / total,
+        "unparsed": sum(row["predicted"] is None for row in rows) / total,
+        "consistency": sum(row["consistent"] for row in rows) / total,
+        "latency_p50": statistics.median(latencies) if latencies else 0.0,
+        "latency_p95": percentile(latencies, 0.95) if latencies else 0.0,
+        "completion_tokens": statistics.mean(completion_tokens) if completion_tokens else 0.0,
+        "rows": rows,
+    }
+
+
+def print_report(reports: list[dict]) -> None:
+    header = (f"{'модель':<28}{'t°':>5}{'max':>6}{'точно':>8}{'jaccard':>9}"
+              f"{'не разобр.':>12}{'повторы':>9}{'p50, мс':>9}{'p95, мс':>9}{'ток.':>7}")
+    print(header)
+    print("-" * len(header))
+    for report in reports:
+        params = report["params"]
+        print(f"{params['model']:<28}{params['temperature']:>5g}"
+              f"{params.get('max_tokens', '-'):>6}{report['accuracy']:>8.0%}"
+              f"{report['jaccard']:>9.2f}{report['unparsed']:>12.0%}"
+              f"{report['consistency']:>9.0%}{report['latency_p50'] * 1000:>9.2f}"
+              f"{report['latency_p95'] * 1000:>9.2f}{report['completion_tokens']:>7.0f}")
+
+    for report in reports:
+        misses = [row for row in report["rows"] if not row["exact"]]
+        if misses:
+            print(f"\nОшибки {report['params']['model']}:")
+            for row in misses:
+                print(f"  {row['task']}\n    ожидалось {row['expected']}, "
+                      f"получено {row['predicted']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dataset", default="evals/routing_tasks.jsonl")
+    parser.add_argument("--config", action="append", metavar="MODEL:TEMP:MAX_TOKENS",
+                        help="параметры модели (можно несколько раз); "
+                             "по умолчанию — стадии analysis и answer")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="повторов на задачу для оценки согласованности")
+    parser.add_argument("--local", action="store_true",
+                        help="добавить в сравнение локальный маршрутизатор")
+    parser.add_argument("--output", help="JSON-файл с результатами по задачам")
+    args = parser.parse_args()
+
+    setup_logging()
+    tasks = load_tasks(args.dataset)
+    configs = ([parse_config(spec) for spec in args.config] if args.config
+               else [stage_params("analysis"), stage_params("answer")])
+
+    reports = []
+    with usage_scope(entry_point="eval_routing"):
+        for params in configs:
+            print(f"⏳ {params} на {len(tasks)} задачах...", file=sys.stderr)
+            reports.append(evaluate(params, tasks, args.repeat))
+    if args.local:
+        reports.append(evaluate_local(tasks))
+
+    print_report(reports)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(reports, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,57 +3,59 @@ from langchain_deepseek import ChatDeepSeek
 from langchain.memory import ConversationSummaryMemory
 from langchain.agents import initialize_agent, Tool
 from tavily import TavilyClient
-from dotenv import load_dotenv
-import os
+from agents.web_retriever import WebRetriever, format_context
+from config.settings import DEEPSEEK_API_BASE, get_settings
+from utils.logger import setup_logging
 import logging
 
 logger = logging.getLogger(__name__)
-load_dotenv()
+settings = get_settings()
 
 class TavilySearchTool:
     """Инструмент для поиска через Tavily с обработкой результатов"""
     
     def __init__(self):
-        self.client = TavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
+        self.client = TavilyClient(api_key=settings.tavily_api_key)
+        self.retriever = WebRetriever()
         
     def search(self, query: str) -> str:
         """Выполняет поиск и возвращает текстовые результаты"""
         try:
-            logger.info(f"🔍 Поиск: {query}")
+            logger.info("🔍 Поиск: %s", query)
             result = self.client.search(
                 query=query,
                 search_depth="advanced",
-                max_results=3,
+                max_results=5,
                 include_answer=True
             )
             
             if not result.get("results"):
                 return "Информация не найдена"
                 
-            # Форматируем результаты в текстовый вид
+            # В промпт идут только лучшие фрагменты страниц в пределах бюджета токенов
             response = []
             if result.get("answer"):
                 response.append(f"Ответ: {result['answer']}")
-                
-            for idx, res in enumerate(result["results"][:3], 1):
-                response.append(
-                    f"{idx}. [{res['title']}]({res['url']}): {res['content']}"
-                )
+
+            passages = self.retriever.retrieve(query, result["results"])
+            response.append(format_context(passages))
             
             return "\n\n".join(response)
             
         except Exception as e:
-            logger.error(f"❌ Ошибка поиска: {e}")
+            logger.error("❌ Ошибка поиска: %s", e)
             return "Ошибка при получении информации"
 
+setup_logging()
+
 # Инициализация моделей и инструментов
 tavily_tool = TavilySearchTool()
 
 llm = ChatDeepSeek(
-    model=os.getenv("OPENAI_API_MODEL", "deepseek-chat"),
-    api_key=os.getenv("OPENAI_API_KEY"),
+    model=settings.openai_api_model,
+    api_key=settings.openai_api_key,
     temperature=0.7,
-    api_base=os.getenv("OPENAI_API_BASE_URL", "https://api.deepseek.com/v1")
+    api_base=settings.openai_api_base_url or DEEPSEEK_API_BASE
 )
 
 tools = [
@@ -0,0 +1,186 @@
+"""
+Граф выполнения задачи на LangGraph.
+
+В отличие от линейной цепочки build_agent_chain, граф запускает только
+нужные узлы: после анализа выбираются ветки по списку инструментов.
+Поиск и инструменты с побочными эффектами выполняются параллельно,
+итог собирается узлом summarize после завершения всех веток.
+Задача без инструментов сразу идёт в answer — без поиска и лишних вызовов.
+Twitter публикует ответ, поэтому запускается после answer.
+
+                 ┌─> search ─> answer ─┬─> twitter ─┐
+    analyze ─────┤                     └────────────┼─> summarize
+                 ├─> telegram ──────────────────────┤
+                 └─> github ────────────────────────┘
+
+Состояние графа сохраняется в checkpointer по thread_id = task_id,
+поэтому прерванная задача продолжается с последнего завершённого узла.
+Состояние завершённой задачи удаляется: её результат хранит журнал задач.
+"""
+
+import uuid
+import logging
+import operator
+import sqlite3
+from typing import Annotated, Any, Optional, TypedDict
+from langgraph.graph import StateGraph, END
+from langgraph.checkpoint.memory import MemorySaver
+from agents.langchain_agent import (
+    CONTENT_TOOLS, TOOL_HANDLERS, analyze_task, answer_task, run_tool,
+    search_internet, summarize_result)
+from config.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+class TaskState(TypedDict, total=False):
+    task_id: str
+    session_id: str  # ключ памяти диалога (см. agents.session_manager)
+    task_description: str
+    analysis: dict
+    internet_results: list
+    answer: str
+    # Поиск или ответ заменены запасным вариантом по таймауту (см. utils.deadline)
+    degraded: bool
+    # Инструменты выполняются параллельно, их результаты складываются
+    execution_results: Annotated[list, operator.add]
+    response: str
+
+
+def analyze_node(state: TaskState) -> dict:
+    return {"analysis": analyze_task(state)["analysis"]}
+
+
+def search_node(state: TaskState) -> dict:
+    result = search_internet(state)
+    return {"internet_results": result["internet_results"],
+            "degraded": bool(result.get("degraded"))}
+
+
+def answer_node(state: TaskState) -> dict:
+    result = answer_task(state)
+    return {"answer": result["answer"], "degraded": bool(result.get("degraded"))}
+
+
+def summarize_node(state: TaskState) -> dict:
+    return {"response": summarize_result(state)["response"]}
+
+
+def make_tool_node(tool: str):
+    """Создаёт узел для одного инструмента из TOOL_HANDLERS."""
+    def tool_node(state: TaskState) -> dict:
+        # Запасной ответ по таймауту не публикуется
+        content = None if state.get("degraded") else state.get("answer")
+        result = run_tool(state.get("task_id"), tool, state["task_description"], content)
+        return {"execution_results": [result]}
+    return tool_node
+
+
+def _tools(state: TaskState) -> list[str]:
+    return [str(tool).lower() for tool in state.get("analysis", {}).get("tools", [])]
+
+
+def route_after_analysis(state: TaskState) -> list[str]:
+    """
+    Выбирает ветки по результату анализа.
+
+    :return: Список узлов, которые запустятся параллельно
+    """
+    tools = _tools(state)
+    branches = [tool for tool in TOOL_HANDLERS
+                if tool in tools and tool not in CONTENT_TOOLS]
+    if "tavily" in tools:
+        branches.append("search")
+    elif not branches or CONTENT_TOOLS & set(tools):
+        # Инструменты не нужны или публикуют ответ — сначала отвечаем
+        branches.append("answer")
+    logger.info("🔀 Ветки графа: %s", branches)
+    return branches
+
+
+def route_after_answer(state: TaskState) -> list[str]:
+    """Инструменты, публикующие ответ (CONTENT_TOOLS), запускаются после answer."""
+    tools = _tools(state)
+    return [tool for tool in TOOL_HANDLERS
+            if tool in tools and tool in CONTENT_TOOLS] or ["summarize"]
+
+
+def create_checkpointer():
+    """
+    SQLite-checkpointer в workflow_checkpoint_path (пакет
+    langgraph-checkpoint-sqlite); пустой путь — хранение в памяти.
+
+    :raises RuntimeError: Путь задан, а пакет не установлен — без него
+        прерванная задача не продолжится после перезапуска
+    """
+    path = get_settings().workflow_checkpoint_path
+    if not path:
+        logger.info("💾 Состояние графа хранится в памяти (WORKFLOW_CHECKPOINT_PATH пуст)")
+        return MemorySaver()
+    try:
+        from langgraph.checkpoint.sqlite import SqliteSaver
+    except ImportError as e:
+        raise RuntimeError(
+            "Не установлен langgraph-checkpoint-sqlite (см. requirements.txt); "
+            "для хранения состояния в памяти задайте WORKFLOW_CHECKPOINT_PATH=\"\"") from e
+    return SqliteSaver(sqlite3.connect(path, check_same_thread=False))
+
+
+def build_task_graph(checkpointer: Any = None):
+    """
+    Собирает граф выполнения задачи.
+
+    :param checkpointer: Хранилище состояния (по умолчанию create_checkpointer())
+    :return: Скомпилированный граф
+    """
+    workflow = StateGraph(TaskState)
+
+    workflow.add_node("analyze", analyze_node)
+    workflow.add_node("search", search_node)
+    workflow.add_node("answer", answer_node)
+    for tool in TOOL_HANDLERS:
+        workflow.add_node(tool, make_tool_node(tool))
+    # defer: ждём завершения всех запущенных веток, сколько бы их ни было
+    workflow.add_node("summarize", summarize_node, defer=True)
+
+    workflow.set_entry_point("analyze")
+    workflow.add_conditional_edges(
+        "analyze", route_after_analysis,
+        ["search", "answer", *TOOL_HANDLERS])
+    workflow.add_edge("search", "answer")
+    workflow.add_conditional_edges(
+        "answer", route_after_answer, ["summarize", *CONTENT_TOOLS])
+    for tool in TOOL_HANDLERS:
+        workflow.add_edge(tool, "summarize")
+    workflow.add_edge("summarize", END)
+
+    return workflow.compile(
+        checkpointer=checkpointer if checkpointer is not None else create_checkpointer())
+
+
+def run_task(graph, task_description: str, task_id: Optional[str] = None,
+             session_id: Optional[str] = None) -> dict:
+    """
+    Запускает задачу или продолжает прерванную с последнего узла.
+
+    :param graph: Граф из build_task_graph
+    :param task_description: Описание задачи
+    :param task_id: ID задачи (thread_id для checkpointer)
+    :param session_id: Ключ памяти диалога; None — ответ без истории
+    :return: Итоговое состояние графа
+    """
+    thread_id = task_id or uuid.uuid4().hex
+    config = {"configurable": {"thread_id": thread_id}}
+
+    snapshot = graph.get_state(config)
+    if snapshot.next:
+        logger.info("🔁 Продолжаем граф задачи %s с узлов %s", task_id, snapshot.next)
+        result = graph.invoke(None, config)
+    else:
+        result = graph.invoke(
+            {"task_description": task_description, "task_id": task_id,
+             "session_id": session_id}, config)
+
+    # Граф дошёл до конца — чекпоинты больше не нужны (прерванные остаются)
+    graph.checkpointer.delete_thread(thread_id)
+    return result
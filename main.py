@@ -1,24 +1,28 @@
 import logging
-from agents.langchain_agent import build_agent_chain
+from agents.langchain_agent import ledger
 from agents.telegram_agent import bot
+from langgraph_flow.workflow import build_task_graph, run_task
+from utils.accounting import BudgetExceeded, accountant, usage_scope
+from config.settings import get_settings, install_reload_handler
+from utils.logger import setup_logging
+from utils.recorder import recorder
+from utils.delivery import deliver
+from utils.deadline import request_deadline
 
-# Настраиваем логирование
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Создаем цепочку LangChain
-agent_chain = build_agent_chain()
+# Создаем граф выполнения задач
+agent_graph = build_task_graph()
 
 
-def process_task(task_description: str):
-    """Обрабатывает задачу с помощью цепочки LangChain."""
-    initial_input = {"task_description": task_description}
-    logger.info(f"🎯 Новая задача: {task_description}")
+def process_task(task_description: str, task_id: str | None = None,
+                 session_id: str | None = None):
+    """Обрабатывает задачу с помощью графа LangGraph в памяти сессии session_id."""
+    logger.info("🎯 Новая задача: %s", task_description)
 
-    result = agent_chain.invoke(initial_input)
+    result = run_task(agent_graph, task_description, task_id, session_id)
 
-    logger.info(f"📢 Результат выполнения: {result}")
-    print(result)
+    logger.debug("📢 Результат выполнения: %s", result)
 
     return result.get("response", "⚠️ Произошла ошибка при выполнении задачи")
 
@@ -31,14 +35,53 @@ def handle_task_command(message):
         bot.reply_to(message, "⚠️ Укажите описание задачи после команды /task")
         return
 
-    bot.reply_to(message, f"⏳ Анализирую задачу: {task_description}")
-    result = process_task(task_description)
-    bot.send_message(message.chat.id, result)
+    try:
+        # Отказываем сразу, не начиная задачу, если лимит токенов исчерпан
+        accountant.choose_model(get_settings().openai_api_model, message.from_user.id)
+    except BudgetExceeded as e:
+        bot.reply_to(message, f"⛔ {e}")
+        return
+
+    ticket = ledger.begin(
+        task_description, chat_id=message.chat.id, message_id=message.message_id)
+
+    if ticket.status == "done":
+        # Повторная доставка или дубликат — отдаём сохранённый результат
+        deliver(bot, message.chat.id, ticket.response)
+        return
+    if ticket.status == "running":
+        bot.reply_to(message, "⏳ Эта задача уже выполняется")
+        return
+
+    if ticket.status == "resumed":
+        bot.reply_to(message, f"🔁 Продолжаю прерванную задачу: {task_description}")
+    else:
+        bot.reply_to(message, f"⏳ Анализирую задачу: {task_description}")
+
+    try:
+        # Дедлайн на весь граф: стадии, не уложившиеся в бюджет, заменяются запасными
+        with usage_scope(message.from_user.id, message.chat.id, "task"), \
+                request_deadline() as deadline:
+            result = process_task(task_description, ticket.task_id,
+                                  f"{message.chat.id}:{message.from_user.id}")
+        # Ответ с запасными стадиями не сохраняется: повтор задачи продолжит её
+        # с сохранённых шагов и заново выполнит те, что не уложились в бюджет
+        if not deadline.degraded:
+            ledger.finish(ticket.task_id, result)
+    except BudgetExceeded as e:
+        # Лимит исчерпан посреди задачи — её можно будет продолжить позже
+        result = f"⛔ {e}"
+    finally:
+        ledger.release(ticket.task_id)
+    deliver(bot, message.chat.id, result)
 
 
 def main():
     """Запуск бота для обработки входящих сообщений."""
+    setup_logging()
+    recorder.install()  # Запись/воспроизведение внешних вызовов (RECORDER_MODE)
     logger.info("🚀 AI-агент запущен!")
+    install_reload_handler()  # kill -HUP <pid> — перечитать настройки без перезапуска
     bot.polling(none_stop=True)
 
 
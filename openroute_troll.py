@@ -1,19 +1,20 @@
 import time
 import re
+import logging
 import signal
 import sys
 import telebot
-from dotenv import load_dotenv
-import os
 import openai
+from config.settings import get_settings, install_reload_handler
+from utils.logger import setup_logging
+from utils.recorder import recorder
+from utils.delivery import deliver
+from utils.accounting import (
+    BudgetExceeded, accountant, register_stats_command, usage_scope)
+from utils.deadline import current_deadline, request_deadline, run_stage, stage_timeout
 
-load_dotenv()
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_API_BASE_URL = os.getenv("OPENAI_API_BASE_URL")
-OPENAI_API_MODEL = os.getenv("OPENAI_API_MODEL")
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-proxy_base_url = OPENAI_API_BASE_URL+'/chat/completions'
+settings = get_settings()
+logger = logging.getLogger(__name__)
 
 
 class LLMtrol:
@@ -21,39 +22,48 @@ class LLMtrol:
 
     def __init__(self):
         self.client = openai.OpenAI(
-            api_key=OPENAI_API_KEY, base_url=OPENAI_API_BASE_URL)
+            api_key=settings.openai_api_key, base_url=settings.openai_api_base_url or None,
+            timeout=settings.llm_timeout, max_retries=settings.llm_max_retries)
 
     def analyze_task(self, task: str) -> dict:
         """
         Анализирует задачу и определяет, какие инструменты нужны.
+
+        Повторы при пустом ответе или ошибке сети укладываются в дедлайн
+        запроса: не осталось времени — сразу запасной ответ.
         
         :param task: Запрос
         :return: Словарь think и summary
+        :raises BudgetExceeded: Пользователь исчерпал дневной лимит токенов
         """
         prompt = task
-        print(prompt)
+        logger.debug("Запрос: %s", prompt)
         
         # Добавляем счетчик попыток для предотвращения бесконечного цикла
         max_attempts = 3
-        attempts = 0
+        deadline = current_deadline()
+        result = None
         
-        while attempts < max_attempts:
-            attempts += 1
-            response = self.client.chat.completions.create(
-                model=OPENAI_API_MODEL,
-                messages=[{"role": "system", "content": "Ты AI-троль. Ты жесткий циник, можешь прямо стебаться и троллить человека. Но информацию должен давать всегда настоящую и проверенную. Отвечай коротко, много текста не нужно. Ты сидишь в чате, и развлекаешь его членов."},
-                        {"role": "user", "content": prompt}]
-            )
-            print(response)
-            
-            result = response.choices[0].message.content
+        model = accountant.choose_model(get_settings().openai_api_model)
+        for attempt in range(max_attempts):
+            try:
+                response = run_stage(
+                    "answer", lambda: self._complete(model, prompt), fallback=lambda: None)
+            except openai.APIConnectionError as e:  # в том числе таймаут клиента
+                logger.warning("⚠️ Нет ответа от LLM (попытка %s): %s", attempt + 1, e)
+                response = None
+            if response is not None:
+                result = response.choices[0].message.content
             
             # Проверяем, что result не пустой
             if result and result.strip():
                 break
             
-            # Если пустой ответ, ждем немного перед повторной попыткой
-            time.sleep(2)
+            # Если пустой ответ, ждем немного перед повторной попыткой — в пределах дедлайна
+            pause = min(2, deadline.remaining()) if deadline else 2
+            if attempt == max_attempts - 1 or pause <= 0:
+                break
+            time.sleep(pause)
         
         # Если после всех попыток результат все еще пустой, используем запасной ответ
         if not result or not result.strip():
@@ -61,7 +71,20 @@ class LLMtrol:
         
         return {"summary": result}
 
-bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
+    def _complete(self, model: str, prompt: str):
+        started_at = time.perf_counter()
+        response = self.client.chat.completions.create(
+            model=model,
+            messages=[{"role": "system", "content": "Ты AI-троль. Ты жесткий циник, можешь прямо стебаться и троллить человека. Но информацию должен давать всегда настоящую и проверенную. Отвечай коротко, много текста не нужно. Ты сидишь в чате, и развлекаешь его членов."},
+                      {"role": "user", "content": prompt}],
+            timeout=stage_timeout("answer", get_settings().llm_timeout)
+        )
+        accountant.record_openai(response, time.perf_counter() - started_at)
+        # Объект ответа целиком — только на уровне DEBUG и в сокращённом виде
+        logger.debug("Ответ API: %s", response)
+        return response
+
+bot = telebot.TeleBot(settings.telegram_bot_token)
 llm_agent = LLMtrol()
 
 
@@ -70,13 +93,22 @@ def handle_start(message):
     bot.send_message(message.chat.id, "Привет! Я бот. Отправь мне сообщение, и я передам его нейросети.")
 
 
+# /stats регистрируется раньше обработчика всех сообщений
+register_stats_command(bot)
+
+
 @bot.message_handler(func=lambda message: True)
 def handle_message(message):
-    print("ok")
-    analysis = llm_agent.analyze_task(message.text)
+    try:
+        with usage_scope(message.from_user.id, message.chat.id, "openroute_troll"), \
+                request_deadline():
+            analysis = llm_agent.analyze_task(message.text)
+    except BudgetExceeded as e:
+        bot.reply_to(message, f"⛔ {e}")
+        return
     summary = analysis["summary"]
     # Отправляем текстовый ответ
-    bot.reply_to(message, summary)
+    deliver(bot, message.chat.id, summary, message.message_id)
 
 
 def main():
@@ -92,6 +124,9 @@ def signal_handler(sig, frame):
 
 
 if __name__ == "__main__":
+    setup_logging()
+    recorder.install()  # Запись/воспроизведение внешних вызовов (RECORDER_MODE)
     signal.signal(signal.SIGINT, signal_handler)  # Обработка SIGINT
+    install_reload_handler()  # Перечитывание настроек по SIGHUP
     main()
 
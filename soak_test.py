@@ -0,0 +1,425 @@
+"""
+Нагрузочный прогон (soak test) ботов с поиском утечек памяти.
+
+Поднимает локальные заглушки внешних сервисов — OpenAI-совместимый
+/v1/chat/completions, Telegram Bot API, Tavily /search и страницы для
+WebRetriever — и часами прогоняет через обработчики ботов (main /task,
+agent_claude, openroute_troll, trololo) синтетический трафик от многих
+пользователей. Код приложения работает как в продакшене, заменены только
+адреса внешних API.
+
+С интервалом снимаются RSS процесса, снимок tracemalloc и размеры
+накопительных структур (истории диалогов, память LangChain, чекпоинты
+графа, кеши, счётчики). В конце печатается отчёт о росте памяти по
+подсистемам; код выхода 1, если RSS устойчиво растёт быстрее
+--max-growth МБ/ч (и на всём прогоне после прогрева, и на его второй половине).
+
+    python soak_test.py --duration 3600 --users 200 --report soak_report.json
+    python soak_test.py --duration 120 --interval 10      # быстрая проверка
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+_WORDS = ("агент", "память", "поиск", "задача", "ответ", "модель", "сервер",
+          "очередь", "токен", "кеш", "граф", "пользователь", "сообщение")
+
+
+def _text(words: int) -> str:
+    return " ".join(random.choice(_WORDS) for _ in range(words)).capitalize() + "."
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Заглушки OpenAI, Telegram Bot API, Tavily и веб-страниц."""
+
+    latency = 0.05
+    message_id = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, payload, content_type="application/json"):
+        body = payload if isinstance(payload, bytes) else json.dumps(
+            payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_GET(self):
+        if self.path.startswith("/page/"):
+            paragraphs = "".join(f"<p>{_text(40)}</p>" for _ in range(20))
+            return self._reply(
+                f"<html><head><title>Страница</title></head><body>{paragraphs}</body></html>"
+                .encode("utf-8"), "text/html; charset=utf-8")
+        self._reply({"ok": True, "result": {}})
+
+    def do_POST(self):
+        raw = self._body()
+        time.sleep(self.latency)
+        if self.path.endswith("/chat/completions"):
+            request = json.loads(raw)
+            if request.get("stream"):
+                include_usage = (request.get("stream_options") or {}).get("include_usage")
+                return self._stream(self._completion(request), include_usage)
+            return self._reply(self._completion(request))
+        if self.path.endswith("/search"):
+            host = f"http://{self.headers['Host']}"
+            return self._reply({"query": "", "results": [
+                {"url": f"{host}/page/{random.randint(0, 500)}", "title": _text(4),
+                 "content": _text(30)} for _ in range(5)]})
+        # Telegram Bot API: /bot<token>/<method>
+        StandInHandler.message_id += 1
+        self._reply({"ok": True, "result": {
+            "message_id": StandInHandler.message_id, "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"}}})
+
+    def _stream(self, completion: dict, include_usage: bool = False):
+        """Ответ в виде SSE-потока (stream=true, например ReAct-агент trololo)."""
+        message = completion["choices"][0]["message"]
+        chunks = [{"role": "assistant", "content": message["content"]}, {}]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for idx, delta in enumerate(chunks):
+            chunk = {key: completion[key] for key in ("id", "created", "model")}
+            chunk.update(object="chat.completion.chunk", choices=[{
+                "index": 0, "delta": delta,
+                "finish_reason": "stop" if idx == len(chunks) - 1 else None}])
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                             .encode("utf-8"))
+        if include_usage:
+            # Как у OpenAI: usage — отдельным последним чанком с пустым choices
+            chunk = {key: completion[key] for key in ("id", "created", "model")}
+            chunk.update(object="chat.completion.chunk", choices=[],
+                         usage=completion["usage"])
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    @staticmethod
+    def _completion(request: dict) -> dict:
+        prompt = "\n".join(str(message.get("content", ""))
+                           for message in request.get("messages", []))
+        if "Определи, какие инструменты" in prompt or "какие инструменты" in prompt:
+            tools = random.choice([[], ["tavily"], ["telegram"], ["tavily", "telegram"]])
+            content = json.dumps({"summary": _text(8), "tools": tools}, ensure_ascii=False)
+        elif "Final Answer" in prompt:
+            content = f"Thought: ответ готов\nFinal Answer: {_text(random.randint(5, 40))}"
+        else:
+            # Иногда длинный ответ — чтобы проверить доставку частями и файлом
+            words = random.choice([20, 60, 200, 900, 2500])
+            content = "\n\n".join(_text(20) for _ in range(max(words // 20, 1)))
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(content) // 4
+        return {
+            "id": "soak", "object": "chat.completion", "created": int(time.time()),
+            "model": request.get("model", "stand-in"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+
+def start_stand_ins(latency: float) -> str:
+    """Запускает заглушки в фоновом потоке и возвращает базовый адрес."""
+    StandInHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stand-ins", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def configure_environment(base_url: str, workdir: str) -> None:
+    """Адреса заглушек и временные файлы — до импорта модулей приложения."""
+    os.environ.update({
+        "OPENAI_API_KEY": "soak", "OPENAI_API_BASE_URL": f"{base_url}/v1",
+        "TELEGRAM_BOT_TOKEN": "1:soak", "TELEGRAM_CHAT_ID": "1",
+        "TAVILY_API_KEY": "soak", "TAVILY_API_BASE_URL": base_url,
+        "GITHUB_TOKEN": "soak",
+        "TASK_LEDGER_PATH": os.path.join(workdir, "task_ledger.db"),
+        "WORKFLOW_CHECKPOINT_PATH": os.path.join(workdir, "workflow_checkpoints.db"),
+        "USAGE_STATS_DIR": os.path.join(workdir, "usage_stats"),
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+    })
+
+
+def subsystem(filename: str) -> str:
+    """Имя подсистемы по файлу аллокации: модуль проекта, пакет или stdlib."""
+    if filename.startswith(ROOT):
+        relative = os.path.relpath(filename, ROOT)
+        return os.path.splitext(relative)[0].replace(os.sep, ".")
+    for marker in ("site-packages", "dist-packages"):
+        if marker in filename:
+            return filename.split(marker, 1)[1].strip(os.sep).split(os.sep)[0]
+    return "stdlib:" + os.path.splitext(os.path.basename(filename))[0]
+
+
+def rss_mb() -> float:
+    """Текущий RSS процесса, МБ (на Linux из /proc, иначе пиковый)."""
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def slope_per_hour(samples: list[dict], key: str) -> float:
+    """Наклон линейной регрессии значения key по времени, единиц в час."""
+    import numpy as np
+    if len(samples) < 3:
+        return 0.0
+    times = np.array([sample["t"] for sample in samples])
+    values = np.array([sample[key] for sample in samples])
+    return float(np.polyfit(times, values, 1)[0] * 3600)
+
+
+class Traffic:
+    """Синтетические пользователи, отправляющие сообщения разным ботам."""
+
+    def __init__(self, users: int) -> None:
+        import main
+        import agent_claude
+        import openroute_troll
+        import trololo
+        from telebot import types
+
+        self._types = types
+        self.users = [100000 + idx for idx in range(users)]
+        self.counter = 0
+        self.errors = defaultdict(int)
+        self.sent = defaultdict(int)
+        self._lock = threading.Lock()
+        self.entry_points = [
+            ("task", 3, main.handle_task_command,
+             lambda n: f"/task {random.choice(['Найди новости', 'Объясни', 'Сообщи в чат'])} "
+                       f"{_text(6)} #{n}"),
+            ("agent_claude", 4, agent_claude.handle_message,
+             lambda n: "/clear" if n % 50 == 0 else _text(12)),
+            ("openroute_troll", 3, openroute_troll.handle_message, lambda n: _text(8)),
+            ("trololo", 1, trololo.handle_message, lambda n: _text(8)),
+        ]
+
+    def message(self, user_id: int, text: str):
+        with self._lock:
+            self.counter += 1
+            message_id = self.counter
+        return self._types.Message.de_json({
+            "message_id": message_id, "date": int(time.time()), "text": text,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "chat": {"id": user_id, "type": "private"},
+        })
+
+    def step(self) -> None:
+        name, _, handler, make_text = random.choices(
+            self.entry_points, weights=[entry[1] for entry in self.entry_points])[0]
+        message = self.message(random.choice(self.users), make_text(self.counter))
+        try:
+            handler(message)
+            self.sent[name] += 1
+        except Exception as e:
+            self.errors[f"{name}: {type(e).__name__}"] += 1
+
+
+def session_messages(manager, size) -> int:
+    """Суммарный размер сессий SessionManager (снимок без блокировок)."""
+    return sum(size(entry.value) for entry in list(manager._sessions.values()))
+
+
+def probes() -> dict:
+    """Размеры накопительных структур приложения."""
+    import main
+    import agent_claude
+    import trololo
+    from agents import langchain_agent, web_retriever, prefetch
+    from utils.accounting import accountant
+
+    checkpointer = main.agent_graph.checkpointer
+    storage = getattr(checkpointer, "storage", None)
+    ledger_path = os.environ["TASK_LEDGER_PATH"]
+    return {
+        "agent_claude.sessions": len(agent_claude.conversation_history),
+        "agent_claude.messages": session_messages(
+            agent_claude.conversation_history, len),
+        "langchain_agent.sessions": len(langchain_agent.sessions),
+        "langchain_agent.messages": session_messages(
+            langchain_agent.sessions, lambda memory: len(memory.chat_memory.messages)),
+        "trololo.sessions": len(trololo.sessions),
+        "trololo.messages": session_messages(
+            trololo.sessions, lambda memory: len(memory.chat_memory.messages)),
+        "workflow.checkpoint_threads": len(storage) if storage is not None else 0,
+        "task_ledger.db_kb": os.path.getsize(ledger_path) // 1024
+        if os.path.exists(ledger_path) else 0,
+        "accounting.keys": len(accountant._totals),
+        "web_retriever.content_cache": len(web_retriever.content_cache._data),
+        "prefetch.search_cache": len(prefetch.prefetcher.cache._data),
+    }
+
+
+def traced_by_subsystem(snapshot) -> dict:
+    sizes: dict[str, int] = defaultdict(int)
+    for stat in snapshot.statistics("filename"):
+        sizes[subsystem(stat.traceback[0].filename)] += stat.size
+    return sizes
+
+
+def run(args, workdir: str) -> int:
+    base_url = start_stand_ins(args.backend_latency)
+    configure_environment(base_url, workdir)
+
+    from telebot import apihelper
+    apihelper.API_URL = f"{base_url}/bot{{0}}/{{1}}"
+    from utils.logger import setup_logging
+    setup_logging()
+
+    tracemalloc.start(1)
+    traffic = Traffic(args.users)
+    print(f"🏁 Заглушки на {base_url}, рабочий каталог {workdir}", file=sys.stderr)
+
+    stop = threading.Event()
+
+    def worker():
+        delay = args.concurrency / args.rate if args.rate else 0
+        while not stop.is_set():
+            traffic.step()
+            if delay:
+                stop.wait(random.uniform(0, 2 * delay))
+
+    workers = [threading.Thread(target=worker, name=f"soak-{idx}", daemon=True)
+               for idx in range(args.concurrency)]
+    started_at = time.monotonic()
+    for thread in workers:
+        thread.start()
+
+    samples, baseline, baseline_probes = [], None, None
+    while True:
+        elapsed = time.monotonic() - started_at
+        if elapsed >= args.duration:
+            break
+        stop.wait(min(args.interval, args.duration - elapsed))
+        snapshot = tracemalloc.take_snapshot()
+        current = traced_by_subsystem(snapshot)
+        sample = {"t": time.monotonic() - started_at, "rss_mb": rss_mb(),
+                  "traced_mb": sum(current.values()) / 2 ** 20,
+                  "requests": sum(traffic.sent.values()), "probes": probes()}
+        samples.append(sample)
+        if baseline is None and sample["t"] >= args.warmup:
+            baseline, baseline_probes = current, sample["probes"]
+        print(f"⏱️ {sample['t']:.0f} с: RSS {sample['rss_mb']:.1f} МБ, "
+              f"tracemalloc {sample['traced_mb']:.1f} МБ, запросов {sample['requests']}",
+              file=sys.stderr)
+
+    stop.set()
+    for thread in workers:
+        thread.join(timeout=30)
+
+    final = traced_by_subsystem(tracemalloc.take_snapshot())
+    baseline = baseline or final
+    baseline_probes = baseline_probes or (samples[0]["probes"] if samples else {})
+    steady = [sample for sample in samples if sample["t"] >= args.warmup]
+    second_half = steady[len(steady) // 2:]
+
+    report = {
+        "duration": args.duration,
+        "requests": dict(traffic.sent),
+        "errors": dict(traffic.errors),
+        "rss_start_mb": steady[0]["rss_mb"] if steady else None,
+        "rss_end_mb": steady[-1]["rss_mb"] if steady else None,
+        "rss_slope_mb_per_hour": slope_per_hour(steady, "rss_mb"),
+        "rss_slope_second_half_mb_per_hour": slope_per_hour(second_half, "rss_mb"),
+        "traced_slope_mb_per_hour": slope_per_hour(steady, "traced_mb"),
+        "subsystems": sorted(
+            ({"subsystem": name, "growth_kb": (final.get(name, 0) - baseline.get(name, 0)) / 1024,
+              "size_kb": final.get(name, 0) / 1024}
+             for name in set(final) | set(baseline)),
+            key=lambda row: row["growth_kb"], reverse=True)[:args.top],
+        "probes": {name: {"start": baseline_probes.get(name), "end": value}
+                   for name, value in (samples[-1]["probes"] if samples else {}).items()},
+        "samples": samples,
+    }
+    failed = (report["rss_slope_mb_per_hour"] > args.max_growth
+              and report["rss_slope_second_half_mb_per_hour"] > args.max_growth)
+    report["failed"] = failed
+
+    print_report(report, args.max_growth)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    return 1 if failed else 0
+
+
+def print_report(report: dict, max_growth: float) -> None:
+    print(f"\nЗапросы: {report['requests']}")
+    if report["errors"]:
+        print(f"Ошибки: {report['errors']}")
+    print(f"RSS: {report['rss_start_mb'] or 0:.1f} → {report['rss_end_mb'] or 0:.1f} МБ, "
+          f"рост {report['rss_slope_mb_per_hour']:.1f} МБ/ч "
+          f"(вторая половина {report['rss_slope_second_half_mb_per_hour']:.1f} МБ/ч, "
+          f"порог {max_growth} МБ/ч); tracemalloc {report['traced_slope_mb_per_hour']:.1f} МБ/ч")
+
+    print("\nРост по подсистемам (tracemalloc после прогрева):")
+    for row in report["subsystems"]:
+        print(f"  {row['subsystem']:<45}{row['growth_kb']:>+10.0f} КБ{row['size_kb']:>10.0f} КБ")
+
+    print("\nНакопительные структуры:")
+    for name, values in report["probes"].items():
+        print(f"  {name:<45}{values['start']!s:>10} → {values['end']}")
+
+    print("\n❌ Память устойчиво растёт" if report["failed"] else "\n✅ Устойчивого роста нет")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--duration", type=float, default=3600, help="секунды прогона")
+    parser.add_argument("--interval", type=float, default=60, help="период замеров, с")
+    parser.add_argument("--warmup", type=float, default=None,
+                        help="прогрев без учёта роста, с (по умолчанию 10%% прогона)")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4, help="параллельных потоков")
+    parser.add_argument("--rate", type=float, default=20,
+                        help="запросов в секунду на все потоки (0 — без пауз)")
+    parser.add_argument("--backend-latency", type=float, default=0.05,
+                        help="задержка заглушек, с")
+    parser.add_argument("--max-growth", type=float, default=20, help="порог роста RSS, МБ/ч")
+    parser.add_argument("--top", type=int, default=15, help="подсистем в отчёте")
+    parser.add_argument("--report", help="JSON-файл с отчётом и замерами")
+    parser.add_argument("--keep-workdir", action="store_true",
+                        help="не удалять рабочий каталог (журнал, чекпоинты, статистика)")
+    args = parser.parse_args()
+    if args.warmup is None:
+        args.warmup = args.duration * 0.1
+    if args.keep_workdir:
+        sys.exit(run(args, tempfile.mkdtemp(prefix="soak-")))
+
+    # Журнал задач, чекпоинты и статистика прогона удаляются вместе с каталогом
+    with tempfile.TemporaryDirectory(prefix="soak-", ignore_cleanup_errors=True) as workdir:
+        code = run(args, workdir)
+        # Иначе запись статистики при выходе (atexit) создаст каталог заново
+        from utils.accounting import accountant
+        accountant.flush()
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,11 @@
 from openai import OpenAI
-from dotenv import load_dotenv
-import os
+from config.settings import get_settings
 
-# Загружаем переменные окружения
-load_dotenv()
-
-# Загружаем ключи API
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_API_BASE_URL = os.getenv("OPENAI_API_BASE_URL")
-DEEPSEEK_MODEL = os.getenv("OPENAI_API_MODEL")
+# Загружаем настройки
+settings = get_settings()
+OPENAI_API_KEY = settings.openai_api_key
+OPENAI_API_BASE_URL = settings.openai_api_base_url or None
+DEEPSEEK_MODEL = settings.openai_api_model
 
 print(OPENAI_API_BASE_URL)
 print(OPENAI_API_KEY)
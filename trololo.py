@@ -1,17 +1,25 @@
 import time
+import logging
 import signal
 import sys
 import telebot
-from dotenv import load_dotenv
-import os
 from langchain_deepseek import ChatDeepSeek
-from langchain.memory import ConversationSummaryMemory
+from langchain.memory import ConversationBufferMemory
 from langchain.agents import AgentExecutor, create_react_agent
 from langchain_core.prompts import PromptTemplate
 from langchain.agents.format_scratchpad import format_log_to_messages
 from langchain.tools.render import render_text_description
+from config.settings import DEEPSEEK_API_BASE, get_settings, install_reload_handler
+from utils.logger import setup_logging
+from utils.recorder import recorder
+from utils.delivery import deliver
+from utils.accounting import (
+    BudgetExceeded, accountant, register_stats_command, usage_callback, usage_scope)
+from agents.session_manager import SessionManager, trim_memory
+from utils.deadline import request_deadline, run_stage, stage_timeout
 
-load_dotenv()
+settings = get_settings()
+logger = logging.getLogger(__name__)
 
 # Конфигурация
 CONFIG = {
@@ -23,11 +31,15 @@ CONFIG = {
 
 # Инициализация модели
 llm = ChatDeepSeek(
-    model=os.getenv("OPENAI_API_MODEL"),
+    model=settings.openai_api_model,
     max_tokens=CONFIG["MAX_TOKENS"],
-    api_key=os.getenv("OPENAI_API_KEY"),
+    api_key=settings.openai_api_key,
     temperature=CONFIG["TEMPERATURE"],
-    api_base=os.getenv("OPENAI_API_BASE_URL"),
+    api_base=settings.openai_api_base_url or DEEPSEEK_API_BASE,
+    request_timeout=settings.llm_timeout,
+    max_retries=settings.llm_max_retries,
+    stream_usage=True,  # AgentExecutor стримит: без этого usage в ответе нет
+    callbacks=[usage_callback],
 )
 
 # Промпт для агента
@@ -38,46 +50,111 @@ SYSTEM_PROMPT = """Ты AI-троль. Ты жесткий циник. Собл
 4. Не используй форматирование
 5. Если вопрос требует серьезного ответа - скажи об этом саркастично"""
 
-prompt = PromptTemplate.from_template(SYSTEM_PROMPT + "\n\nВопрос: {input}")
-
-# Инициализация агента
-agent = AgentExecutor(
-    agent=create_react_agent(
-        llm=llm,
-        tools=[],  # Добавьте инструменты, если нужно
-        prompt=prompt,
-        # output_parser=ReActOutputParser(),
-        stop_sequence=["\nObservation:"],
-    ),
-    memory=ConversationSummaryMemory(llm=llm),
-    handle_parsing_errors=True,
-    max_iterations=3,
-    verbose=True
-)
+# create_react_agent требует {tools}, {tool_names} и {agent_scratchpad} в промпте
+REACT_FORMAT = """
+
+Инструменты: {tools}
+
+Формат ответа:
+Thought: твоя мысль
+Action: инструмент из [{tool_names}] (только если он нужен)
+Action Input: ввод для инструмента
+Observation: результат инструмента
+... (Thought/Action/Observation можно повторить)
+Final Answer: ответ пользователю
+
+Предыдущий разговор:
+{history}
+
+Вопрос: {input}
+{agent_scratchpad}"""
+
+prompt = PromptTemplate.from_template(SYSTEM_PROMPT + REACT_FORMAT)
+
+
+def build_agent(timeout: float) -> AgentExecutor:
+    """
+    ReAct-агент, уложенный в timeout: каждый вызов модели прерывается
+    таймаутом клиента, новые итерации после timeout не начинаются.
+    Иначе брошенный по дедлайну агент занимал бы поток пула стадий
+    на полный llm_timeout (см. utils.deadline.stage_timeout).
+    """
+    return AgentExecutor(
+        agent=create_react_agent(
+            llm=llm.bind(timeout=timeout),
+            tools=[],  # Добавьте инструменты, если нужно
+            prompt=prompt,
+            # output_parser=ReActOutputParser(),
+            stop_sequence=["\nObservation:"],
+        ),
+        tools=[],  # должны совпадать с инструментами create_react_agent
+        handle_parsing_errors=True,
+        max_iterations=3,
+        max_execution_time=timeout,
+        verbose=True
+    )
+
+
+def answer(text: str, history: str) -> dict:
+    """Ответ агента в пределах бюджета стадии answer текущего запроса."""
+    agent = build_agent(stage_timeout("answer", get_settings().llm_timeout))
+    return agent.invoke({"input": text, "history": history})
 
-bot = telebot.TeleBot(os.getenv("TELEGRAM_BOT_TOKEN"))
+
+# Память разговора — своя у каждого пользователя, последние session_max_turns обменов
+sessions = SessionManager(ConversationBufferMemory, trim=trim_memory(), name="trololo")
+
+bot = telebot.TeleBot(settings.telegram_bot_token)
 
 @bot.message_handler(commands=['start'])
 def handle_start(message):
     bot.send_message(message.chat.id, "Привет! Задай вопрос, попробую ответить с сарказмом.")
 
+# /stats регистрируется раньше обработчика всех сообщений
+register_stats_command(bot)
+
 @bot.message_handler(func=lambda message: True)
 def handle_message(message):
-    for attempt in range(CONFIG["MAX_RETRIES"]):
-        try:
-            response = agent.invoke({"input": message.text})
-            if response and 'output' in response:
-                return bot.reply_to(message, response['output'][:4000])
-            
+    try:
+        # Агент собран с одной моделью, поэтому здесь бюджет только ограничивает
+        accountant.choose_model(settings.openai_api_model, message.from_user.id)
+    except BudgetExceeded as e:
+        return bot.reply_to(message, f"⛔ {e}")
+
+    with usage_scope(message.from_user.id, message.chat.id, "trololo"), \
+            request_deadline() as deadline:
+        for attempt in range(CONFIG["MAX_RETRIES"]):
+            try:
+                with sessions.session(message.from_user.id) as memory:
+                    history = memory.buffer_as_str or "нет"
+                    response = run_stage(
+                        "answer",
+                        lambda: answer(message.text, history),
+                        fallback=lambda: None)
+                    if response and 'output' in response:
+                        memory.save_context({"input": message.text},
+                                            {"output": response['output']})
+            except Exception as e:
+                # Повтор при 429 — только если пауза укладывается в дедлайн
+                pause = CONFIG["DELAY_BETWEEN_REQUESTS"] ** (attempt + 1)
+                if '429' in str(e) and pause < deadline.remaining():
+                    time.sleep(pause)
+                    continue
+                if '429' in str(e):
+                    break
+
+                logger.error("⚠️ Ошибка: %s", e)
+                return bot.reply_to(message, f"Ошибка: {str(e)[:1000]}")
+
+            if response is None:
+                return bot.reply_to(message, "⏱️ Не успел придумать колкость, спроси ещё раз")
+
+            if 'output' in response:
+                # Длинный ответ уходит частями или файлом, без обрезки; ошибки
+                # отправки обрабатываются в deliver и не ведут к повторной генерации
+                return deliver(bot, message.chat.id, response['output'], message.message_id)
+
             return bot.reply_to(message, "Чёт не могу придумать ответ...")
-        
-        except Exception as e:
-            if '429' in str(e):
-                time.sleep(CONFIG["DELAY_BETWEEN_REQUESTS"] ** (attempt + 1))
-                continue
-                
-            print(f"⚠️ Ошибка: {str(e)}")
-            return bot.reply_to(message, f"Ошибка: {str(e)[:1000]}")
 
     bot.reply_to(message, "Слишком много запросов, попробуй позже")
 
@@ -86,9 +163,12 @@ def main():
         try:
             bot.polling(none_stop=True, timeout=25)
         except Exception as e:
-            print(f"Ошибка polling: {str(e)}")
+            logger.error("Ошибка polling: %s", e)
             time.sleep(5)
 
 if __name__ == "__main__":
+    setup_logging()
+    recorder.install()  # Запись/воспроизведение внешних вызовов (RECORDER_MODE)
     signal.signal(signal.SIGINT, lambda s, f: sys.exit(0))
+    install_reload_handler()
     main()
\ No newline at end of file
@@ -0,0 +1,321 @@
+"""
+Учёт токенов и стоимости вызовов LLM по пользователям.
+
+Каждый вызов модели записывается в контексте текущего запроса
+(usage_scope: пользователь, чат, точка входа). Счётчики хранятся в
+словаре {(user_id, chat_id, entry_point): array('d')} — по пять чисел
+на ключ — и периодически сбрасываются на диск в фоновом потоке.
+
+Дневной бюджет токенов на пользователя: после usage_downgrade_ratio
+от бюджета запросы идут на дешёвую модель (usage_cheap_model), после
+исчерпания — отклоняются исключением BudgetExceeded.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+from array import array
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import date
+from typing import Any, Iterator, Optional
+from langchain_core.callbacks import BaseCallbackHandler
+from config.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Порядок счётчиков в array
+CALLS, PROMPT, COMPLETION, REASONING, LATENCY = range(5)
+
+
+@dataclass(frozen=True)
+class UsageContext:
+    user_id: Optional[int] = None
+    chat_id: Optional[int] = None
+    entry_point: str = "unknown"
+
+
+_context: ContextVar[UsageContext] = ContextVar("usage_context", default=UsageContext())
+
+
+class BudgetExceeded(Exception):
+    """Пользователь исчерпал дневной бюджет токенов."""
+
+
+@contextmanager
+def usage_scope(user_id: Optional[int] = None, chat_id: Optional[int] = None,
+                entry_point: str = "unknown") -> Iterator[UsageContext]:
+    """
+    Привязывает вызовы LLM внутри блока к пользователю и точке входа.
+
+    :param user_id: ID пользователя Telegram
+    :param chat_id: ID чата
+    :param entry_point: Имя бота или команды
+    """
+    token = _context.set(UsageContext(user_id, chat_id, entry_point))
+    try:
+        yield _context.get()
+    finally:
+        _context.reset(token)
+
+
+def _admin_ids() -> set[int]:
+    raw = get_settings().admin_user_ids
+    return {int(item) for item in raw.split(",") if item.strip()}
+
+
+def is_admin(user_id: Optional[int]) -> bool:
+    """Входит ли пользователь в admin_user_ids."""
+    return user_id in _admin_ids()
+
+
+class UsageAccountant:
+    """Счётчики токенов и задержек, бюджеты и периодическая запись на диск."""
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        settings = get_settings()
+        script = os.path.splitext(os.path.basename(sys.argv[0] or ""))[0] or "app"
+        self.path = path or os.path.join(settings.usage_stats_dir, f"{script}.json")
+        self._totals: dict[tuple, array] = {}
+        # user_id -> [номер дня, токены за день]
+        self._daily: dict[Any, list] = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._stop = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self._load()
+
+    # --- Учёт ---
+    def record(self, model: str, prompt_tokens: int, completion_tokens: int,
+               reasoning_tokens: int = 0, latency: float = 0.0) -> None:
+        """
+        Записывает один вызов модели в текущем контексте usage_scope.
+
+        :param model: Имя модели
+        :param prompt_tokens: Токены запроса
+        :param completion_tokens: Токены ответа
+        :param reasoning_tokens: Токены рассуждений (входят в completion)
+        :param latency: Время вызова, секунды
+        """
+        ctx = _context.get()
+        key = (ctx.user_id, ctx.chat_id, ctx.entry_point)
+        today = date.today().toordinal()
+        with self._lock:
+            counters = self._totals.get(key)
+            if counters is None:
+                counters = self._totals[key] = array("d", [0.0] * 5)
+            counters[CALLS] += 1
+            counters[PROMPT] += prompt_tokens
+            counters[COMPLETION] += completion_tokens
+            counters[REASONING] += reasoning_tokens
+            counters[LATENCY] += latency
+
+            day = self._daily.setdefault(ctx.user_id, [today, 0])
+            if day[0] != today:
+                day[:] = [today, 0]
+            day[1] += prompt_tokens + completion_tokens
+            self._dirty = True
+        self._ensure_flusher()
+        logger.debug("💰 %s: %s+%s токенов (%s reasoning) за %.2f с, %s",
+                     model, prompt_tokens, completion_tokens, reasoning_tokens,
+                     latency, ctx)
+
+    def record_openai(self, response: Any, latency: float) -> None:
+        """Учитывает ответ openai.chat.completions.create."""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        details = getattr(usage, "completion_tokens_details", None)
+        self.record(
+            getattr(response, "model", "") or "",
+            usage.prompt_tokens or 0,
+            usage.completion_tokens or 0,
+            getattr(details, "reasoning_tokens", 0) or 0,
+            latency)
+
+    # --- Бюджеты ---
+    def tokens_today(self, user_id: Optional[int]) -> int:
+        """Токены пользователя за сегодня."""
+        with self._lock:
+            day = self._daily.get(user_id)
+            return int(day[1]) if day and day[0] == date.today().toordinal() else 0
+
+    def choose_model(self, model: str, user_id: Any = ...) -> str:
+        """
+        Выбирает модель с учётом бюджета пользователя.
+
+        :param model: Модель по умолчанию
+        :param user_id: Пользователь (по умолчанию — из usage_scope)
+        :return: model или дешёвая модель при приближении к лимиту
+        :raises BudgetExceeded: Бюджет исчерпан
+        """
+        settings = get_settings()
+        budget = settings.usage_daily_token_budget
+        user_id = _context.get().user_id if user_id is ... else user_id
+        if not budget or user_id is None or is_admin(user_id):
+            return model
+
+        used = self.tokens_today(user_id)
+        if used >= budget:
+            raise BudgetExceeded(
+                f"Дневной лимит токенов исчерпан ({used} из {budget})")
+        if settings.usage_cheap_model and used >= budget * settings.usage_downgrade_ratio:
+            logger.info("💸 Пользователь %s израсходовал %s из %s токенов, "
+                        "переключаем на %s", user_id, used, budget,
+                        settings.usage_cheap_model)
+            return settings.usage_cheap_model
+        return model
+
+    # --- Отчёты ---
+    def top_consumers(self, limit: int = 10) -> list[dict]:
+        """
+        Пользователи с наибольшим расходом токенов.
+
+        :param limit: Сколько пользователей вернуть
+        :return: Список: user_id, calls, prompt, completion, reasoning, latency, entry_points
+        """
+        per_user: dict[Any, dict] = {}
+        with self._lock:
+            items = [(key, list(counters)) for key, counters in self._totals.items()]
+        for (user_id, _chat_id, entry_point), counters in items:
+            row = per_user.setdefault(user_id, {
+                "user_id": user_id, "calls": 0, "prompt": 0, "completion": 0,
+                "reasoning": 0, "latency": 0.0, "entry_points": set()})
+            row["calls"] += int(counters[CALLS])
+            row["prompt"] += int(counters[PROMPT])
+            row["completion"] += int(counters[COMPLETION])
+            row["reasoning"] += int(counters[REASONING])
+            row["latency"] += counters[LATENCY]
+            row["entry_points"].add(entry_point)
+        rows = sorted(per_user.values(),
+                      key=lambda row: row["prompt"] + row["completion"], reverse=True)
+        return rows[:limit]
+
+    def format_stats(self, limit: int = 10) -> str:
+        """Текст для команды /stats."""
+        rows = self.top_consumers(limit)
+        if not rows:
+            return "📊 Вызовов LLM пока не было."
+        lines = ["📊 Топ потребителей токенов:"]
+        for idx, row in enumerate(rows, 1):
+            avg = row["latency"] / row["calls"] if row["calls"] else 0
+            lines.append(
+                f"{idx}. {row['user_id']}: {row['prompt'] + row['completion']} токенов "
+                f"({row['prompt']}→{row['completion']}, reasoning {row['reasoning']}), "
+                f"{row['calls']} вызовов, ~{avg:.1f} с, "
+                f"сегодня {self.tokens_today(row['user_id'])} "
+                f"[{', '.join(sorted(row['entry_points']))}]")
+        return "\n".join(lines)
+
+    # --- Запись на диск ---
+    def flush(self) -> None:
+        """Атомарно записывает счётчики в файл, если они изменились."""
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = {
+                "totals": [[*key, *counters] for key, counters in self._totals.items()],
+                "daily": [[user_id, *day] for user_id, day in self._daily.items()],
+            }
+            self._dirty = False
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(snapshot, file)
+        os.replace(tmp_path, self.path)
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            return
+        for user_id, chat_id, entry_point, *counters in snapshot.get("totals", []):
+            self._totals[(user_id, chat_id, entry_point)] = array("d", counters)
+        for user_id, day, tokens in snapshot.get("daily", []):
+            self._daily[user_id] = [day, tokens]
+
+    def _ensure_flusher(self) -> None:
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name="usage-flush", daemon=True)
+            self._flusher.start()
+        atexit.register(self.flush)
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(get_settings().usage_flush_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error("❌ Не удалось записать статистику: %s", e)
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """Callback LangChain: учитывает токены и задержку каждого вызова ChatModel."""
+
+    def __init__(self, accountant: UsageAccountant) -> None:
+        self.accountant = accountant
+        self._started: dict[Any, float] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs) -> None:
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        started_at = self._started.pop(run_id, None)
+        latency = time.perf_counter() - started_at if started_at else 0.0
+        llm_output = response.llm_output or {}
+        usage = llm_output.get("token_usage") or {}
+        details = usage.get("completion_tokens_details") or {}
+        model = llm_output.get("model_name", "")
+        prompt = usage.get("prompt_tokens", 0) or 0
+        completion = usage.get("completion_tokens", 0) or 0
+        reasoning = details.get("reasoning_tokens", 0) or 0
+        if not usage:
+            # При стриминге llm_output пуст: usage приходит в usage_metadata сообщения
+            for generation in (g for gens in response.generations for g in gens):
+                message = getattr(generation, "message", None)
+                metadata = getattr(message, "usage_metadata", None) or {}
+                if not metadata:
+                    continue
+                model = model or message.response_metadata.get("model_name", "")
+                prompt += metadata.get("input_tokens", 0) or 0
+                completion += metadata.get("output_tokens", 0) or 0
+                output_details = metadata.get("output_token_details") or {}
+                reasoning += output_details.get("reasoning", 0) or 0
+        self.accountant.record(model, prompt, completion, reasoning, latency)
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        self._started.pop(run_id, None)
+
+
+accountant = UsageAccountant()
+usage_callback = UsageCallbackHandler(accountant)
+
+
+def register_stats_command(bot) -> None:
+    """
+    Добавляет боту команду /stats (только для admin_user_ids).
+
+    Вызывайте до регистрации обработчика всех сообщений, иначе тот
+    перехватит команду.
+
+    :param bot: Экземпляр telebot.TeleBot
+    """
+    @bot.message_handler(commands=["stats"])
+    def stats_command(message):
+        if not is_admin(message.from_user.id):
+            bot.reply_to(message, "⛔ Команда доступна только администраторам")
+            return
+        bot.send_message(message.chat.id, accountant.format_stats())
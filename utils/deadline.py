@@ -0,0 +1,181 @@
+"""
+Сквозной дедлайн запроса и бюджеты стадий.
+
+Ни один вызов не был ограничен по времени: LLM, Tavily, GitHub и
+Telegram могли ждать столько, сколько позволяют умолчания библиотек,
+и время ответа не имело верхней границы. Теперь у запроса есть
+дедлайн request_deadline (SLO), а у каждой стадии — свой бюджет
+deadline_<стадия>, урезанный до остатка дедлайна:
+
+    analysis — выбор инструментов; запасной вариант — локальный маршрутизатор;
+    search   — поиск и загрузка страниц; запасной вариант — ответ без поиска;
+    tools    — инструменты с побочными эффектами; запасной вариант — отчёт
+               о том, что результат не дождались;
+    answer   — ответ LLM; запасной вариант — прошлый ответ на ту же задачу
+               или частичный результат (найденные источники).
+
+Стадия, не уложившаяся в бюджет, больше не ждётся: запрос продолжается
+с запасным результатом, а сам вызов прерывается таймаутом клиента
+(см. stage_timeout). Время каждой стадии записывается в Deadline.timings,
+итог логируется при выходе из request_deadline — видно, какая стадия
+израсходовала бюджет.
+
+Использование:
+
+    with request_deadline() as deadline:
+        result = process_task(...)
+    # deadline.report() — «analysis 0.8/10.0 с ok, search 15.0/15.0 с timeout, ...»
+"""
+
+import time
+import logging
+import threading
+import contextvars
+from dataclasses import dataclass
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Iterator, Optional
+from config.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Стадии запроса — у каждой настройка deadline_<стадия>
+STAGES = ("analysis", "search", "tools", "answer")
+
+
+@dataclass
+class StageTiming:
+    stage: str
+    seconds: float
+    budget: float
+    outcome: str  # ok, timeout, error или skipped (дедлайн уже истёк)
+
+
+class Deadline:
+    """Дедлайн одного запроса и учёт времени его стадий."""
+
+    def __init__(self, total: Optional[float] = None) -> None:
+        """
+        :param total: Дедлайн, с (по умолчанию request_deadline)
+        """
+        self.total = get_settings().request_deadline if total is None else total
+        self.started_at = time.monotonic()
+        self.timings: list[StageTiming] = []
+        self._lock = threading.Lock()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def remaining(self) -> float:
+        return max(self.total - self.elapsed(), 0.0)
+
+    def budget(self, stage: str) -> float:
+        """Бюджет стадии: её настройка, но не больше остатка дедлайна."""
+        return min(getattr(get_settings(), f"deadline_{stage}"), self.remaining())
+
+    def record(self, stage: str, seconds: float, budget: float, outcome: str) -> None:
+        with self._lock:
+            self.timings.append(StageTiming(stage, seconds, budget, outcome))
+
+    @property
+    def degraded(self) -> bool:
+        """Хотя бы одна стадия заменена запасным результатом."""
+        return any(timing.outcome in ("timeout", "skipped") for timing in self.timings)
+
+    def slowest(self) -> Optional[StageTiming]:
+        """Стадия, израсходовавшая больше всего времени."""
+        return max(self.timings, key=lambda timing: timing.seconds, default=None)
+
+    def report(self) -> str:
+        stages = ", ".join(
+            f"{timing.stage} {timing.seconds:.1f}/{timing.budget:.1f} с {timing.outcome}"
+            for timing in self.timings)
+        return f"{stages or 'нет стадий'}; всего {self.elapsed():.1f} из {self.total:.1f} с"
+
+
+_current: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar(
+    "request_deadline", default=None)
+
+# Стадии выполняются в отдельных потоках, чтобы их можно было не дожидаться
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="stage")
+
+
+@contextmanager
+def request_deadline(total: Optional[float] = None) -> Iterator[Deadline]:
+    """
+    Устанавливает дедлайн для всех стадий внутри блока (в том числе в узлах графа).
+
+    :param total: Дедлайн, с (по умолчанию request_deadline)
+    :return: Deadline с временем стадий
+    """
+    deadline = Deadline(total)
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+        slowest = deadline.slowest()
+        log = logger.warning if deadline.degraded else logger.info
+        log("⏱️ Стадии запроса: %s; дольше всех — %s", deadline.report(),
+            slowest.stage if slowest else "—")
+
+
+def current_deadline() -> Optional[Deadline]:
+    """Дедлайн текущего запроса (None вне request_deadline)."""
+    return _current.get()
+
+
+def stage_timeout(stage: str, limit: float) -> float:
+    """
+    Таймаут вызова клиента внутри стадии.
+
+    :param stage: Стадия из STAGES
+    :param limit: Таймаут клиента из настроек
+    :return: limit, урезанный до бюджета стадии текущего запроса
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return limit
+    return max(min(limit, deadline.budget(stage)), 0.1)
+
+
+def run_stage(stage: str, func: Callable[[], Any], fallback: Callable[[], Any]) -> Any:
+    """
+    Выполняет стадию в пределах её бюджета.
+
+    Вне request_deadline функция вызывается как есть. Если бюджет
+    исчерпан, результат не ждётся: возвращается fallback(), а вызов
+    завершится сам по таймауту клиента. Исключения func пробрасываются.
+
+    :param stage: Стадия из STAGES
+    :param func: Функция без аргументов
+    :param fallback: Запасной результат без аргументов
+    :return: Результат func или fallback
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return func()
+
+    budget = deadline.budget(stage)
+    if budget <= 0:
+        logger.warning("⏭️ Стадия %s пропущена: дедлайн запроса истёк", stage)
+        deadline.record(stage, 0.0, 0.0, "skipped")
+        return fallback()
+
+    started_at = time.monotonic()
+    # Контекст (дедлайн, учёт токенов) передаётся в поток стадии
+    future = _executor.submit(contextvars.copy_context().run, func)
+    outcome = "ok"
+    try:
+        return future.result(timeout=budget)
+    except FutureTimeoutError:
+        outcome = "timeout"
+        future.cancel()
+        logger.warning("⏱️ Стадия %s не уложилась в %.1f с, используем запасной вариант",
+                       stage, budget)
+        return fallback()
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        deadline.record(stage, time.monotonic() - started_at, budget, outcome)
@@ -0,0 +1,185 @@
+"""
+Доставка длинных ответов в Telegram.
+
+Сообщение в Telegram ограничено 4096 символами: длинный ответ падал
+с ошибкой или обрезался. Теперь ответ режется по границам абзацев и
+блоков кода (```), части уходят по порядку через одно keep-alive
+соединение бота. Ответ длиннее delivery_document_threshold отправляется
+файлом из буфера в памяти — без временных файлов на диске.
+
+При 429 (Too Many Requests) часть отправляется повторно после
+retry_after — ответ не генерируется заново. Запросы к Bot API
+ограничены telegram_timeout.
+"""
+
+import io
+import re
+import time
+import logging
+from typing import Optional
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+from config.settings import get_settings, on_reload
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+_FENCE = re.compile(r"^```(\w*)\s*$")
+
+
+def apply_timeouts(settings=None) -> None:
+    """Таймауты запросов telebot (по умолчанию ответ ждётся до 30 с)."""
+    timeout = (settings or get_settings()).telegram_timeout
+    apihelper.CONNECT_TIMEOUT = min(timeout, 5)
+    apihelper.READ_TIMEOUT = timeout
+
+
+apply_timeouts()
+on_reload(apply_timeouts)
+
+
+def _blocks(text: str) -> list[tuple[str, Optional[str]]]:
+    """
+    Делит текст на абзацы и блоки кода.
+
+    :return: Пары (текст блока, язык) — язык None для обычных абзацев
+    """
+    blocks: list[tuple[str, Optional[str]]] = []
+    paragraph: list[str] = []
+    code: Optional[list[str]] = None
+    language = ""
+
+    def flush_paragraph():
+        if paragraph:
+            blocks.append(("\n".join(paragraph), None))
+            paragraph.clear()
+
+    for line in text.split("\n"):
+        fence = _FENCE.match(line.strip())
+        if code is not None:
+            code.append(line)
+            if fence and not fence.group(1):
+                blocks.append(("\n".join(code), language))
+                code = None
+        elif fence:
+            flush_paragraph()
+            code, language = [line], fence.group(1)
+        elif not line.strip():
+            flush_paragraph()
+        else:
+            paragraph.append(line)
+    flush_paragraph()
+    if code is not None:
+        # Незакрытый блок кода — оставляем как есть
+        blocks.append(("\n".join(code), language))
+    return blocks
+
+
+def _cut(text: str, limit: int) -> list[str]:
+    """
+    Режет слишком длинный блок по строкам, затем по пробелам.
+
+    Удаляется только сам разделитель: отступы в начале следующей части
+    (строки кода) сохраняются.
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit)
+        skip = 1
+        if cut <= 0:
+            cut, skip = limit, 0
+        parts.append(text[:cut])
+        text = text[cut + skip:]
+    if text:
+        parts.append(text)
+    return parts
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> list[str]:
+    """
+    Разбивает текст на сообщения не длиннее limit.
+
+    Границы выбираются между абзацами и блоками кода; блок кода, который
+    не помещается целиком, режется по строкам, и каждая часть получает
+    свои открывающий и закрывающий ```.
+
+    :param text: Исходный текст
+    :param limit: Максимальная длина сообщения
+    :return: Части по порядку
+    """
+    text = text.strip()
+    if len(text) <= limit:
+        return [text] if text else []
+
+    pieces = []
+    for block, language in _blocks(text):
+        if len(block) <= limit:
+            pieces.append(block)
+        elif language is None:
+            pieces.extend(_cut(block, limit))
+        else:
+            opening, closing = f"```{language}\n", "\n```"
+            body = block.split("\n", 1)[1] if "\n" in block else ""
+            body = body[:-3].rstrip("\n") if body.endswith("```") else body
+            for part in _cut(body, limit - len(opening) - len(closing)):
+                pieces.append(f"{opening}{part}{closing}")
+
+    parts, current = [], ""
+    for piece in pieces:
+        candidate = f"{current}\n\n{piece}" if current else piece
+        if len(candidate) <= limit:
+            current = candidate
+        else:
+            parts.append(current)
+            current = piece
+    if current:
+        parts.append(current)
+    return parts
+
+
+def _call(func, *args, **kwargs):
+    """Вызов Telegram API с повтором после retry_after при 429."""
+    for attempt in range(get_settings().delivery_max_retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except ApiTelegramException as e:
+            if e.error_code != 429 or attempt == get_settings().delivery_max_retries:
+                raise
+            delay = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+            logger.warning("⏳ Лимит Telegram, повтор через %s с", delay)
+            time.sleep(delay)
+
+
+def deliver(bot, chat_id: int, text: str, reply_to_message_id: Optional[int] = None,
+            file_name: str = "answer.md") -> None:
+    """
+    Отправляет ответ любой длины.
+
+    :param bot: Экземпляр telebot.TeleBot
+    :param chat_id: ID чата
+    :param text: Текст ответа
+    :param reply_to_message_id: Ответить на это сообщение (первой частью или файлом)
+    :param file_name: Имя файла, если ответ уйдёт документом
+    """
+    text = text or ""
+    if len(text) > get_settings().delivery_document_threshold:
+        # Превью — первый абзац, остальное во вложении
+        caption = _cut(text.strip().split("\n\n", 1)[0], 1000)[0]
+        document = io.BytesIO(text.encode("utf-8"))
+        _call(bot.send_document, chat_id, document,
+              reply_to_message_id=reply_to_message_id,
+              caption=caption, visible_file_name=file_name)
+        logger.info("📎 Ответ %s символов отправлен файлом %s", len(text), file_name)
+        return
+
+    parts = split_message(text) or ["…"]
+    for idx, part in enumerate(parts):
+        _call(bot.send_message, chat_id, part,
+              reply_to_message_id=reply_to_message_id if idx == 0 else None,
+              disable_notification=idx > 0)
+    if len(parts) > 1:
+        logger.info("✉️ Ответ %s символов отправлен %s сообщениями", len(text), len(parts))
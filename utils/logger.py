@@ -0,0 +1,151 @@
+"""
+Неблокирующее структурированное логирование.
+
+Обработчики логгеров только кладут запись в очередь (QueueHandler),
+форматирование в JSON и запись в поток выполняет фоновый QueueListener.
+Поэтому ввод-вывод логов не добавляет задержку к обработке запросов.
+
+В вызывающем потоке остаётся только подстановка аргументов в сообщение,
+и она ограничена: словари, списки и длинные строки в аргументах
+сокращаются через reprlib, который не обходит большие структуры целиком.
+Пишите логи в ленивом стиле — logger.info("Результат: %s", result), —
+тогда для отключённых уровней форматирование не выполняется вовсе.
+"""
+
+import sys
+import copy
+import json
+import atexit
+import logging
+import reprlib
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Any, Optional
+from config.settings import Settings, get_settings, on_reload
+
+# Стандартные атрибуты LogRecord — всё остальное попадает в JSON как extra
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_listener: Optional[QueueListener] = None
+_lock = threading.Lock()
+
+
+def _make_repr(max_chars: int) -> reprlib.Repr:
+    limits = reprlib.Repr()
+    limits.maxlevel = 3
+    limits.maxdict = limits.maxlist = limits.maxtuple = limits.maxset = 10
+    limits.maxstring = limits.maxother = max_chars
+    return limits
+
+
+_repr = _make_repr(get_settings().log_max_chars)
+
+
+def compact(value: Any, max_chars: Optional[int] = None) -> Any:
+    """
+    Сокращает большое значение для лога.
+
+    :param value: Аргумент сообщения
+    :param max_chars: Максимальная длина строки (по умолчанию из настроек)
+    :return: Исходное значение, если оно небольшое, иначе сокращённая строка
+    """
+    limit = get_settings().log_max_chars if max_chars is None else max_chars
+    if isinstance(value, str):
+        return value if len(value) <= limit else f"{value[:limit]}… [+{len(value) - limit}]"
+    if isinstance(value, (dict, list, tuple, set, frozenset)):
+        return _repr.repr(value)
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    text = str(value)
+    return text if len(text) <= limit else f"{text[:limit]}… [+{len(text) - limit}]"
+
+
+class CompactQueueHandler(QueueHandler):
+    """QueueHandler, который сокращает аргументы, а не форматирует их целиком."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        if record.args:
+            msg = str(record.msg)
+            if isinstance(record.args, dict) and "%(" in msg:
+                args = {key: compact(value) for key, value in record.args.items()}
+            else:
+                # logging передаёт единственный аргумент-словарь без кортежа
+                raw = record.args if isinstance(record.args, tuple) else (record.args,)
+                args = tuple(compact(arg) for arg in raw)
+            try:
+                record.msg = msg % args
+            except (TypeError, ValueError, KeyError):
+                record.msg = f"{record.msg} {args!r}"
+            record.args = None
+        else:
+            record.msg = compact(str(record.msg))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, логгер, сообщение и extra-поля."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = compact(value)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _apply_levels(settings: Settings) -> None:
+    """Общий уровень и уровни отдельных модулей из log_levels ("agents=DEBUG,...")."""
+    global _repr
+    _repr = _make_repr(settings.log_max_chars)
+    logging.getLogger().setLevel(settings.log_level.upper())
+    for item in filter(None, (part.strip() for part in settings.log_levels.split(","))):
+        name, _, level = item.partition("=")
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+
+def setup_logging() -> None:
+    """
+    Настраивает логирование процесса (повторные вызовы ничего не делают).
+
+    Формат — log_format ("json" или "text"), уровни — log_level и log_levels.
+    Уровни применяются заново при перезагрузке настроек.
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        settings = get_settings()
+
+        stream = logging.StreamHandler(sys.stderr)
+        if settings.log_format == "json":
+            stream.setFormatter(JsonFormatter())
+        else:
+            stream.setFormatter(logging.Formatter(
+                "%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+        log_queue: SimpleQueue = SimpleQueue()
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(CompactQueueHandler(log_queue))
+
+        _listener = QueueListener(log_queue, stream, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        _apply_levels(settings)
+        on_reload(_apply_levels)
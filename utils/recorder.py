@@ -0,0 +1,394 @@
+"""
+Запись и воспроизведение внешних вызовов (кассеты).
+
+Все внешние вызовы ботов проходят через два HTTP-клиента: httpx
+(openai — chat.completions.create, в том числе ChatDeepSeek) и requests
+(TavilyClient.search, PyGithub, telebot, загрузка страниц поиска).
+Recorder перехватывает отправку запроса на этой границе:
+
+  * record — запрос уходит в сеть, пара «запрос — ответ» с реальным
+    временем ответа дописывается в кассету;
+  * replay — сеть не используется: ответ берётся из кассеты и отдаётся
+    через записанное время, умноженное на recorder_speed.
+
+Кассета — gzip JSONL, строка на вызов: время начала, метод, адрес,
+хеш тела запроса, статус, нужные заголовки и тело ответа, длительность
+или ошибка (таймаут, обрыв соединения — они воспроизводятся так же).
+Токены и ключи в кассету не попадают: токен бота вырезается из адреса,
+api_key — из тела запроса, заголовки запроса не сохраняются.
+
+Ответ подбирается по методу, адресу и телу запроса; если точного
+совпадения нет (например, изменился текст задачи), — по методу и адресу
+без параметров, затем по методу и пути без хоста (кассета, записанная
+с другим OPENAI_API_BASE_URL или на заглушках). Приблизительный подбор
+учитывает форму запроса (см. _shape): ответ стадии анализа не
+подменяется ответом стадии answer и наоборот. Повторяющиеся запросы
+получают записанные ответы по кругу.
+Запрос, которого нет в кассете, завершается ошибкой соединения.
+
+По умолчанию каждый процесс пишет свою кассету
+(cassette-<скрипт>-<pid>.jsonl.gz), так что боты, записывающие
+одновременно, не перемешивают вызовы. Кассета закрывается при выходе
+и по SIGTERM; если процесс всё же убит посреди записи, load() читает
+всё, что успело записаться до обрыва.
+
+    RECORDER_MODE=record python main.py                # записать сессию
+    python bench_replay.py cassette-main-1234.jsonl.gz # прогнать её без сети
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import gzip
+import time
+import atexit
+import signal
+import base64
+import hashlib
+import logging
+import threading
+from datetime import timedelta
+from collections import defaultdict
+from typing import Optional
+from urllib.parse import urlsplit
+import httpx
+import requests
+from requests.structures import CaseInsensitiveDict
+from config.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Токен бота в адресе Bot API и ключи в теле запроса
+_BOT_TOKEN = re.compile(r"/bot[^/]+/")
+_SECRET_FIELDS = ("api_key",)
+
+# Сколько символов начала промпта (шаблона стадии) входит в форму запроса
+_PROMPT_PREFIX = 64
+
+# Заголовки ответа, которые нужны клиентам (тип содержимого и лимиты API)
+_KEPT_HEADERS = ("content-type", "retry-after")
+_KEPT_PREFIXES = ("x-ratelimit",)
+
+
+class CassetteMiss(Exception):
+    """В кассете нет ответа на запрос."""
+
+
+def default_cassette() -> str:
+    """Файл кассеты процесса: cassette-<скрипт>-<pid>.jsonl.gz."""
+    script = os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0] or "python"
+    return f"cassette-{script}-{os.getpid()}.jsonl.gz"
+
+
+def _redact_url(url: str) -> str:
+    return _BOT_TOKEN.sub("/bot<token>/", url)
+
+
+def _route(method: str, url: str) -> str:
+    parts = urlsplit(_redact_url(url))
+    return f"{method.upper()} {parts.scheme}://{parts.netloc}{parts.path}"
+
+
+def _path(route: str) -> str:
+    method, url = route.split(" ", 1)
+    return f"{method} {urlsplit(url).path}"
+
+
+def _json_body(body) -> Optional[dict]:
+    try:
+        payload = json.loads(body) if body else None
+    except (ValueError, TypeError):
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def _body_hash(body) -> str:
+    """Хеш тела запроса без ключей API."""
+    if body is None:
+        body = b""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if not isinstance(body, bytes):
+        return "stream"
+    payload = _json_body(body)
+    if payload is not None and any(key in payload for key in _SECRET_FIELDS):
+        body = json.dumps({key: value for key, value in payload.items()
+                           if key not in _SECRET_FIELDS}, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(body).hexdigest()
+
+
+def _shape(body) -> str:
+    """
+    Форма запроса для приблизительного подбора: потоковый ли ответ
+    (stream=true), модель, температура, max_tokens и начало первого
+    сообщения — шаблона стадии («Определи, какие инструменты...»,
+    «Ответь на запрос...»). Запросы разной формы друг друга не подменяют.
+    """
+    payload = _json_body(body) if isinstance(body, (str, bytes)) else None
+    if not payload:
+        return ""
+    messages = payload.get("messages")
+    first = messages[0] if isinstance(messages, list) and messages else {}
+    content = first.get("content", "") if isinstance(first, dict) else ""
+    prompt = " ".join(str(content).split())[:_PROMPT_PREFIX]
+    shape = ["stream" if payload.get("stream") else "", payload.get("model"),
+             payload.get("temperature"), payload.get("max_tokens"), prompt]
+    if not any(shape):
+        return ""
+    return hashlib.sha1(json.dumps(shape, ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+
+
+def _keep_headers(headers) -> dict:
+    return {name.lower(): value for name, value in headers.items()
+            if name.lower() in _KEPT_HEADERS or name.lower().startswith(_KEPT_PREFIXES)}
+
+
+class Recorder:
+    """Запись и воспроизведение HTTP-вызовов requests и httpx."""
+
+    def __init__(self) -> None:
+        self.mode = ""
+        self.path = ""
+        self._speed: Optional[float] = None
+        self._file = None
+        self._lock = threading.Lock()
+        self._exact: dict[str, list[dict]] = defaultdict(list)
+        self._routes: dict[str, list[dict]] = defaultdict(list)
+        self._paths: dict[str, list[dict]] = defaultdict(list)
+        self._cursors: dict[str, int] = defaultdict(int)
+        self.entries: list[dict] = []
+        self.metrics = {"recorded": 0, "replayed": 0, "fuzzy": 0, "misses": 0}
+
+    @property
+    def speed(self) -> float:
+        return self._speed if self._speed is not None else get_settings().recorder_speed
+
+    def install(self, mode: Optional[str] = None, path: Optional[str] = None,
+                speed: Optional[float] = None) -> None:
+        """
+        Включает запись или воспроизведение (по умолчанию — из настроек recorder_*).
+
+        :param mode: "record", "replay" или "" (ничего не делать)
+        :param path: Файл кассеты (для записи по умолчанию — default_cassette())
+        :param speed: Множитель пауз при воспроизведении
+        """
+        settings = get_settings()
+        mode = settings.recorder_mode if mode is None else mode
+        if not mode:
+            return
+        path = path or settings.recorder_cassette
+        if mode == "replay":
+            if not path:
+                raise ValueError("не указан файл кассеты для воспроизведения")
+            self.load(path)
+        else:
+            path = path or default_cassette()
+            self._file = gzip.open(path, "at", encoding="utf-8")
+            atexit.register(self.close)
+            self._close_on_sigterm()
+        self.mode, self.path, self._speed = mode, path, speed
+        requests.Session.send = _requests_send
+        httpx.Client.send = _httpx_send
+        logger.info("📼 Внешние вызовы: %s, кассета %s", mode, self.path)
+
+    def uninstall(self) -> None:
+        requests.Session.send = _original_requests_send
+        httpx.Client.send = _original_httpx_send
+        self.close()
+        self.mode = ""
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _close_on_sigterm(self) -> None:
+        """
+        Закрывает кассету по SIGTERM: atexit при нём не вызывается, и у gzip
+        не было бы завершающего блока. Затем срабатывает прежний обработчик.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def handle(signum, frame):
+            self.close()
+            if callable(previous):
+                previous(signum, frame)
+            elif previous != signal.SIG_IGN:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(signal.SIGTERM, handle)
+
+    def load(self, path: str) -> None:
+        """
+        Читает кассету для воспроизведения.
+
+        Кассета процесса, убитого посреди записи, обрывается без конца
+        gzip-потока: читается всё, что успело записаться до обрыва.
+        """
+        entries = []
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            try:
+                for line in file:
+                    if line.strip():
+                        entries.append(json.loads(line))
+            except (EOFError, gzip.BadGzipFile, ValueError) as e:
+                logger.warning("📼 Кассета %s оборвана (%s), загружено %s вызовов",
+                               path, e, len(entries))
+        entries.sort(key=lambda entry: entry["at"])
+        with self._lock:
+            self.entries = entries
+            self._exact.clear()
+            self._routes.clear()
+            self._paths.clear()
+            self._cursors.clear()
+            for entry in entries:
+                shape = entry.get("shape", "")
+                self._exact[f"{entry['route']} {entry['url']} {entry['body']}"].append(entry)
+                self._routes[f"{entry['route']} {shape}"].append(entry)
+                self._paths[f"{_path(entry['route'])} {shape}"].append(entry)
+        logger.info("📼 Загружено %s вызовов из %s", len(entries), path)
+
+    def write(self, method: str, url: str, body, started_at: float, seconds: float,
+              status: int = 0, headers=None, content: bytes = b"",
+              error: str = "") -> None:
+        entry = {
+            "at": started_at, "route": _route(method, url), "url": _redact_url(url),
+            "body": _body_hash(body), "shape": _shape(body),
+            "seconds": round(seconds, 4), "status": status,
+            "headers": _keep_headers(headers or {}), "error": error,
+        }
+        try:
+            entry["content"] = content.decode("utf-8")
+        except UnicodeDecodeError:
+            entry["content"], entry["base64"] = base64.b64encode(content).decode("ascii"), True
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + "\n")
+            self._file.flush()
+            self.metrics["recorded"] += 1
+
+    def lookup(self, method: str, url: str, body) -> dict:
+        """
+        Записанный ответ на запрос.
+
+        :raises CassetteMiss: Ответа нет в кассете
+        """
+        route = _route(method, url)
+        exact_key = f"{route} {_redact_url(url)} {_body_hash(body)}"
+        shape = _shape(body)
+        route_key = f"{route} {shape}"
+        path_key = f"{_path(route)} {shape}"
+        with self._lock:
+            for key, candidates, metric in ((exact_key, self._exact.get(exact_key), "replayed"),
+                                            (route_key, self._routes.get(route_key), "fuzzy"),
+                                            (path_key, self._paths.get(path_key), "fuzzy")):
+                if candidates:
+                    entry = candidates[self._cursors[key] % len(candidates)]
+                    self._cursors[key] += 1
+                    self.metrics[metric] += 1
+                    return entry
+            self.metrics["misses"] += 1
+        logger.warning("📼 Нет в кассете: %s", route)
+        raise CassetteMiss(route)
+
+    def pause(self, entry: dict) -> None:
+        """Ждёт записанное время ответа с учётом скорости воспроизведения."""
+        delay = entry["seconds"] * self.speed
+        if delay > 0:
+            time.sleep(delay)
+
+    @staticmethod
+    def content(entry: dict) -> bytes:
+        if entry.get("base64"):
+            return base64.b64decode(entry["content"])
+        return entry["content"].encode("utf-8")
+
+
+recorder = Recorder()
+
+_original_requests_send = requests.Session.send
+_original_httpx_send = httpx.Client.send
+
+
+def _requests_send(session, request, **kwargs):
+    if recorder.mode == "replay":
+        try:
+            entry = recorder.lookup(request.method, request.url, request.body)
+        except CassetteMiss as e:
+            raise requests.ConnectionError(f"нет в кассете: {e}", request=request)
+        recorder.pause(entry)
+        if entry["error"] == "timeout":
+            raise requests.Timeout("записанный таймаут", request=request)
+        if entry["error"]:
+            raise requests.ConnectionError("записанная ошибка соединения", request=request)
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response._content = Recorder.content(entry)
+        response._content_consumed = True
+        response.raw = io.BytesIO(response._content)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url, response.request, response.reason = request.url, request, ""
+        response.elapsed = timedelta(seconds=entry["seconds"])
+        return response
+
+    wall_clock, started_at = time.time(), time.perf_counter()
+    try:
+        response = _original_requests_send(session, request, **kwargs)
+        content = response.content  # поток читается целиком, чтобы попасть в кассету
+    except requests.Timeout:
+        recorder.write(request.method, request.url, request.body, wall_clock,
+                       time.perf_counter() - started_at, error="timeout")
+        raise
+    except requests.ConnectionError:
+        recorder.write(request.method, request.url, request.body, wall_clock,
+                       time.perf_counter() - started_at, error="connection")
+        raise
+    recorder.write(request.method, request.url, request.body, wall_clock,
+                   time.perf_counter() - started_at, response.status_code,
+                   response.headers, content)
+    return response
+
+
+def _httpx_send(client, request, **kwargs):
+    try:
+        body = request.content
+    except httpx.RequestNotRead:
+        body = None
+    if recorder.mode == "replay":
+        try:
+            entry = recorder.lookup(request.method, str(request.url), body)
+        except CassetteMiss as e:
+            raise httpx.ConnectError(f"нет в кассете: {e}", request=request)
+        recorder.pause(entry)
+        if entry["error"] == "timeout":
+            raise httpx.ReadTimeout("записанный таймаут", request=request)
+        if entry["error"]:
+            raise httpx.ConnectError("записанная ошибка соединения", request=request)
+        return httpx.Response(entry["status"], headers=entry["headers"],
+                              content=Recorder.content(entry), request=request)
+
+    wall_clock, started_at = time.time(), time.perf_counter()
+    try:
+        response = _original_httpx_send(client, request, **kwargs)
+        content = response.read()  # в том числе потоковый ответ (stream=True)
+    except httpx.TimeoutException:
+        recorder.write(request.method, str(request.url), body, wall_clock,
+                       time.perf_counter() - started_at, error="timeout")
+        raise
+    except httpx.TransportError:
+        recorder.write(request.method, str(request.url), body, wall_clock,
+                       time.perf_counter() - started_at, error="connection")
+        raise
+    recorder.write(request.method, str(request.url), body, wall_clock,
+                   time.perf_counter() - started_at, response.status_code,
+                   response.headers, content)
+    return response